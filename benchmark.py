@@ -0,0 +1,721 @@
+'''Benchmarks for the blockchain emulation. run w: python benchmark.py <name> [args]
+each benchmark prints one line per measurement so runs are easy to diff'''
+import asyncio
+import bisect
+import gc
+from itertools import accumulate
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from hashmap import HashMapping, OpenHashMapping
+from blockchain import Transaction, Block, ColumnarBlock, Blockchain
+from chainlog import ChainLog
+from history import LedgerHistory
+from validation import ValidationPipeline, simulated_signature_check
+from mining import Miner
+from mempool import Mempool
+from blocktree import BlockTree
+from chainindex import ChainIndex
+from export import export_csv, export_jsonl, export_binary
+import replay
+from codec import encode_block, decode_block, BlockView
+from workload import Workload, run_suite, compare
+from service import BlockchainService, ServiceClient, load_test
+from sharedledger import SharedLedger, LedgerReplica
+from stake import StakeSelector
+from lightclient import FullNode, LightClient, Header, merkle_levels, merkle_proof, verify_merkle_proof
+from metrics import profile
+from blockchain import Ledger
+from blockchain import _search_nonces, _target
+import network
+from network import Network, percentile
+
+def _timed(fn, *args):
+    '''returns how many seconds fn(*args) took'''
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+def bench_hashmap(max_exp=6):
+    '''compares the chained HashMapping w OpenHashMapping at 10^4 ... 10^max_exp keys: insert time, lookup time 
+    (the has_funds pattern: __contains__ then __getitem__) and bytes per key. 10^7 needs a few GB of RAM'''
+    def insert(hmap, keys):
+        for i, key in enumerate(keys): hmap[key] = i
+
+    def lookup(hmap, keys):
+        for key in keys:
+            if key in hmap: hmap[key]
+
+    for exp in range(4, int(max_exp)+1):
+        n = 10**exp
+        keys = [f'user{i}' for i in range(n)]
+        for cls in (HashMapping, OpenHashMapping):
+            hmap = cls()
+            t_insert = _timed(insert, hmap, keys)
+            t_lookup = _timed(lookup, hmap, keys)
+
+            tracemalloc.start()
+            hmap = cls()
+            insert(hmap, keys)
+            mem = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del hmap
+
+            print(f'{cls.__name__:16} n=10^{exp}  insert {n/t_insert:12,.0f} keys/s  '
+                  f'lookup {n/t_lookup:12,.0f} keys/s  {mem/n:6.1f} bytes/key')
+
+def bench_validate(num_blocks=5000, txs_per_block=10):
+    '''the auditor pattern: validate_chain after every add_block. incremental validation should stay flat per call 
+    while full=True grows w the chain'''
+    num_blocks, txs_per_block = int(num_blocks), int(txs_per_block)
+    for full in (False, True):
+        chain = Blockchain()
+        chain.distribute_mining_reward('alice')
+        start = time.perf_counter()
+        for i in range(num_blocks):
+            chain.add_block(Block([Transaction('alice', 'bob', 0) for j in range(txs_per_block)]))
+            chain.validate_chain(full=full)
+        elapsed = time.perf_counter() - start
+        print(f'full={full!s:5}  {num_blocks} blocks  {elapsed:8.3f}s  {num_blocks/elapsed:10,.0f} add+validate/s')
+
+def _ingest_blocks(num_blocks, txs_per_block, num_users, seed=1):
+    '''makes num_blocks random blocks of transfers between num_users users (who all get funded first)'''
+    rng = random.Random(seed)
+    users = [f'user{i}' for i in range(num_users)]
+    blocks = [Block([Transaction('ROOT', user, 1) for user in users])]
+    for i in range(num_blocks):
+        blocks.append(Block([Transaction(rng.choice(users), rng.choice(users), 0) for j in range(txs_per_block)]))
+    return blocks
+
+def bench_ingest(num_blocks=2000, txs_per_block=100, num_users=10000):
+    '''blocks/s and transactions/s of Blockchain.add_blocks vs a loop over add_block'''
+    num_blocks, txs_per_block, num_users = int(num_blocks), int(txs_per_block), int(num_users)
+    for name in ('add_block loop', 'add_blocks'):
+        blocks = _ingest_blocks(num_blocks, txs_per_block, num_users)
+        chain = Blockchain()
+        start = time.perf_counter()
+        if name == 'add_blocks': chain.add_blocks(blocks)
+        else:
+            for block in blocks: chain.add_block(block)
+        elapsed = time.perf_counter() - start
+        print(f'{name:15} {len(blocks)/elapsed:10,.0f} blocks/s  {num_blocks*txs_per_block/elapsed:12,.0f} txs/s')
+
+def bench_hashing(num_blocks=200, txs_per_block=1000):
+    '''cost of building a block's Merkle root: fresh transactions appended one at a time (the add_transaction path), 
+    then digest() of a block whose root is already cached'''
+    num_blocks, txs_per_block = int(num_blocks), int(txs_per_block)
+    txs = [[Transaction(f'user{i}', f'user{j}', j) for j in range(txs_per_block)] for i in range(num_blocks)]
+    start = time.perf_counter()
+    blocks = [Block(block_txs) for block_txs in txs]
+    for block in blocks: block.digest()
+    build = time.perf_counter() - start
+    cached = _timed(lambda: [block.digest() for block in blocks])
+    print(f'build+digest  {build/num_blocks*1e6:10.1f} us/block  {build/(num_blocks*txs_per_block)*1e6:6.2f} us/tx')
+    print(f'cached digest {cached/num_blocks*1e6:10.3f} us/block')
+
+def bench_memory(num_blocks=100, txs_per_block=1000, num_users=10000):
+    '''tracemalloc bytes per transaction held by Block (list of Transaction objects) vs ColumnarBlock (typed arrays)'''
+    num_blocks, txs_per_block, num_users = int(num_blocks), int(txs_per_block), int(num_users)
+    rng = random.Random(1)
+    users = [f'user{i}' for i in range(num_users)]
+    rows = [[(rng.choice(users), rng.choice(users), rng.randrange(10**6)) for j in range(txs_per_block)] for i in range(num_blocks)]
+    for cls in (Block, ColumnarBlock):
+        tracemalloc.start()
+        blocks = [cls([Transaction(*row) for row in block_rows]) for block_rows in rows]
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del blocks
+        print(f'{cls.__name__:14} {mem/(num_blocks*txs_per_block):7.1f} bytes/tx')
+
+def bench_coldstart(num_blocks=100000, txs_per_block=1, fsync='none'):
+    '''time to reopen a Blockchain from its ChainLog, w and w/o ledger snapshots. pass 1000000 for the 1M block chain. 
+    also reports the write rate under the chosen fsync policy'''
+    num_blocks, txs_per_block = int(num_blocks), int(txs_per_block)
+    for snapshot_interval in (10**12, 10000):
+        with tempfile.TemporaryDirectory() as directory:
+            blocks = _ingest_blocks(num_blocks - 2, txs_per_block, 1000)
+            with ChainLog(directory, fsync=fsync, snapshot_interval=snapshot_interval) as log:
+                chain = Blockchain(log=log)
+                t_write = _timed(chain.add_blocks, blocks)
+            del chain, blocks
+            size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+            with ChainLog(directory) as log:
+                start = time.perf_counter()
+                chain = Blockchain(log=log)
+                t_load = time.perf_counter() - start
+            print(f'snapshots={snapshot_interval < 10**12!s:5}  {len(chain._blockchain):,} blocks  {size/2**20:7.1f} MB  '
+                  f'write {num_blocks/t_write:10,.0f} blocks/s  cold start {t_load:7.2f}s')
+            del chain
+
+def bench_history(num_blocks=20000, interval=1000, num_users=10000, queries=200):
+    '''historical balance lookups thru LedgerHistory vs replaying the chain from genesis, and the memory the 
+    checkpoints + change records take'''
+    num_blocks, interval, num_users, queries = int(num_blocks), int(interval), int(num_users), int(queries)
+    blocks = _ingest_blocks(num_blocks, 10, num_users)
+    chain = Blockchain()
+    tracemalloc.start()
+    history = LedgerHistory(chain, interval=interval)
+    before = tracemalloc.get_traced_memory()[0]
+    chain.add_blocks(blocks)
+    history_mem = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    rng = random.Random(2)
+    asks = [(f'user{rng.randrange(num_users)}', rng.randrange(2, len(chain._blockchain) + 1)) for i in range(queries)]
+
+    def replay(user, height):
+        bal = None
+        for block in chain._blockchain[1:height]:
+            for trans in block:
+                if trans.from_user == user: bal -= trans.amount
+                if trans.to_user == user: bal = (bal or 0) + trans.amount
+        return bal
+
+    t_history = _timed(lambda: [history.balance_at(user, height) for user, height in asks])
+    t_replay = _timed(lambda: [replay(user, height) for user, height in asks[:max(1, queries//20)]]) * 20
+    print(f'balance_at  {t_history/queries*1e6:10.1f} us/query   replay from genesis {t_replay/queries*1e6:10.1f} us/query')
+    print(f'ledger + checkpoints + change records {history_mem/2**20:.1f} MB over {len(history._checkpoints)} checkpoints')
+
+def bench_prevalidate(num_blocks=400, txs_per_block=50, max_workers=None):
+    '''ValidationPipeline throughput w a simulated signature check, for 1, 2, 4 ... max_workers processes 
+    (default: the number of cpus), and w the stateless stage run inline'''
+    num_blocks, txs_per_block = int(num_blocks), int(txs_per_block)
+    max_workers = int(max_workers) if max_workers else os.cpu_count()
+    counts = [0] + [2**i for i in range(max_workers.bit_length()) if 2**i <= max_workers]
+    for workers in counts:
+        blocks = _ingest_blocks(num_blocks, txs_per_block, 1000)
+        with ValidationPipeline(Blockchain(), workers=workers, verifier=simulated_signature_check, batch_size=8) as pipeline:
+            elapsed = _timed(pipeline.add_blocks, blocks)
+        print(f'workers={workers if workers else "inline":6}  {num_blocks*txs_per_block/elapsed:10,.0f} txs/s')
+
+def bench_hashrate(nonces=2000000, max_workers=None):
+    '''proof of work hash rate: inline, then w Miner on 1, 2, 4 ... max_workers processes (default: the number of 
+    cpus). searches an impossible target so every nonce gets tried'''
+    nonces = int(nonces)
+    max_workers = int(max_workers) if max_workers else os.cpu_count()
+    prefix = Block([Transaction('ROOT', 'miner', 1000)]).header_prefix()
+    elapsed = _timed(_search_nonces, prefix, _target(256), 0, nonces)
+    print(f'inline     {nonces/elapsed:12,.0f} hashes/s')
+    for workers in [2**i for i in range(max_workers.bit_length()) if 2**i <= max_workers]:
+        with Miner(workers) as miner:
+            elapsed = _timed(miner.search, prefix, 256, nonces)
+        print(f'workers={workers:<3} {nonces/elapsed:12,.0f} hashes/s total  {nonces/elapsed/workers:12,.0f} hashes/s per core')
+
+def bench_network(num_nodes=2000, num_blocks=5, txs_per_block=100, degree=8, loss=0.01):
+    '''block propagation thru a simulated network: p50/p90/p99/max seconds for a block to reach every node, and bytes 
+    sent per block, w 10-100ms links at 1 MB/s upload'''
+    num_nodes, num_blocks, txs_per_block, degree, loss = int(num_nodes), int(num_blocks), int(txs_per_block), int(degree), float(loss)
+    async def run():
+        start = time.perf_counter()
+        net = Network(num_nodes, degree=degree, latency=(0.01, 0.1), bandwidth=1e6, loss=loss, seed=1)
+        print(f'{num_nodes} nodes built in {time.perf_counter() - start:.1f}s')
+        rng = random.Random(1)
+        for i in range(num_blocks):
+            block = Block([Transaction('ROOT', f'user{rng.randrange(10**6)}', 1) for j in range(txs_per_block)])
+            net.nodes[rng.randrange(num_nodes)].submit_block(block)
+            start = time.perf_counter()
+            await net.wait_for(block, timeout=120)
+            stats = net.stats(block)
+            print(f'block {i}  reached {stats["reached"]:6}  p50 {stats["p50"]:.3f}s  p90 {stats["p90"]:.3f}s  '
+                  f'p99 {stats["p99"]:.3f}s  max {stats["max"]:.3f}s  {stats["bytes"]/2**20:8.2f} MB  '
+                  f'(ran in {time.perf_counter() - start:.1f}s)')
+        await net.close()
+    network.run(run())
+
+def bench_mempool(num_txs=200000, block_size=1000, num_users=10000):
+    '''Mempool throughput: admitting num_txs random transfers w random priorities, assembling block templates of 
+    block_size transactions out of the full pool, and mining the pool empty w template -> add_block'''
+    num_txs, block_size, num_users = int(num_txs), int(block_size), int(num_users)
+    rng = random.Random(1)
+    chain = Blockchain()
+    chain.add_blocks([Block([Transaction('ROOT', f'user{i}', 50) for i in range(j, min(j + 1000, num_users))])
+                      for j in range(0, num_users, 1000)])
+    txs = [(Transaction(f'user{rng.randrange(num_users)}', f'user{rng.randrange(num_users)}', rng.randrange(1, 5)),
+            rng.random()) for i in range(num_txs)]
+    pool = Mempool(chain)
+    elapsed = _timed(lambda: [pool.add(trans, priority) for trans, priority in txs])
+    print(f'add       {num_txs/elapsed:12,.0f} txs/s   ({len(pool):,} admitted)')
+    reps = 20
+    elapsed = _timed(lambda: [pool.block_template(block_size) for i in range(reps)])
+    print(f'template  {elapsed/reps*1e3:12.2f} ms per {block_size} tx block from {len(pool):,} pending')
+    pending, blocks = len(pool), 0
+    def drain():
+        nonlocal blocks
+        while len(pool):
+            assert chain.add_block(pool.block_template(block_size))
+            blocks += 1
+    elapsed = _timed(drain)
+    print(f'drain     {pending/elapsed:12,.0f} txs/s   ({blocks} blocks, none rejected)')
+
+def bench_reorg(max_length=100000, txs_per_block=10, max_depth=1000):
+    '''reorg latency (time to add the block that makes a competing branch heavier) for depths 1, 10 ... max_depth on 
+    chains of 1000, 10000 ... max_length blocks. should grow w depth and stay flat w chain length'''
+    max_length, txs_per_block, max_depth = int(max_length), int(txs_per_block), int(max_depth)
+    def branch(parent, count, tag):
+        blocks = []
+        for i in range(count):
+            block = Block([Transaction('ROOT', f'{tag}{i}-{j}', 0) for j in range(txs_per_block)])
+            block._prev_hash = parent.pow_hash()
+            blocks.append(block)
+            parent = block
+        return blocks
+
+    length = 1000
+    while length <= max_length:
+        chain = Blockchain()
+        tree = BlockTree(chain)
+        for block in branch(chain._blockchain[0], length, 'main'): tree.add(block)
+        depth = 1
+        while depth <= min(max_depth, length - 1):
+            fork = chain._blockchain[-depth - 1]
+            side = branch(fork, depth + 1, f'side{depth}-')
+            for block in side[:-1]: tree.add(block)
+            elapsed = _timed(tree.add, side[-1])
+            assert chain._blockchain[-1] is side[-1]
+            print(f'length {length:8}  depth {depth:6}  {elapsed*1e3:10.2f} ms  {elapsed/depth*1e6:8.1f} us/block undone')
+            depth *= 10
+        length *= 10
+
+def bench_index(num_blocks=2000, txs_per_block=100, num_users=10000, queries=200):
+    '''ChainIndex lookups (a page of 50 of a user's transactions, locating a transaction) vs scanning every block, 
+    the cost of maintaining the index in add_blocks, and the index's tracemalloc bytes per transaction'''
+    num_blocks, txs_per_block, num_users, queries = int(num_blocks), int(txs_per_block), int(num_users), int(queries)
+    blocks = _ingest_blocks(num_blocks, txs_per_block, num_users)
+    chain = Blockchain()
+    t_plain = _timed(chain.add_blocks, blocks)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    index = ChainIndex(chain)
+    index_mem = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    num_txs = sum(len(block) for block in chain._blockchain)
+    print(f'index memory {index_mem/num_txs:8.1f} bytes per transaction ({num_txs:,} transactions)')
+
+    chain = Blockchain()
+    ChainIndex(chain)
+    t_indexed = _timed(chain.add_blocks, _ingest_blocks(num_blocks, txs_per_block, num_users))
+    print(f'add_blocks  {num_txs/t_plain:10,.0f} txs/s w/o index  {num_txs/t_indexed:10,.0f} txs/s w index')
+
+    rng = random.Random(2)
+    users = [f'user{rng.randrange(num_users)}' for i in range(queries)]
+    txs = [rng.choice(rng.choice(blocks)._block) for i in range(queries)]
+    def scan_user(user):
+        return [t for block in chain._blockchain for t in block if user in (t.from_user, t.to_user)][:50]
+    def scan_tx(trans):
+        digest = trans.digest()
+        return next((h, p) for h, block in enumerate(chain._blockchain, 1) for p, t in enumerate(block) if t.digest() == digest)
+    few = max(1, queries // 20)
+    t_page = _timed(lambda: [list(index.transactions(user, limit=50)) for user in users]) / queries
+    t_scan = _timed(lambda: [scan_user(user) for user in users[:few]]) / few
+    print(f'user page   {t_page*1e6:10.1f} us w index   {t_scan*1e6:12.1f} us scanning')
+    t_locate = _timed(lambda: [index.locate(trans) for trans in txs]) / queries
+    t_scan = _timed(lambda: [scan_tx(trans) for trans in txs[:few]]) / few
+    print(f'locate      {t_locate*1e6:10.1f} us w index   {t_scan*1e6:12.1f} us scanning')
+
+def bench_export(num_blocks=10000, txs_per_block=1000, num_users=10000):
+    '''streaming export of every transaction to CSV, JSON Lines and binary files: MB/s, how much the process's peak 
+    RSS grows while exporting and the tracemalloc peak (both should stay flat however long the chain is). the default 
+    chain is 10M transactions of ColumnarBlocks'''
+    num_blocks, txs_per_block, num_users = int(num_blocks), int(txs_per_block), int(num_users)
+    rng = random.Random(1)
+    chain = Blockchain()
+    for i in range(num_blocks):     #0 COIN transfers from ROOT, so every block is valid w/o funding anyone
+        chain.add_block(ColumnarBlock([Transaction('ROOT', f'user{rng.randrange(num_users)}', 0) for j in range(txs_per_block)]))
+    count = num_blocks * txs_per_block
+    print(f'{count:,} transactions  peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10:,.0f} MB after building the chain')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, exporter, mode in (('csv', export_csv, 'w'), ('jsonl', export_jsonl, 'w'), ('binary', export_binary, 'wb')):
+            path = os.path.join(directory, 'export.' + name)
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            with open(path, mode) as f: elapsed = _timed(exporter, chain.iter_transactions(), f)
+            grew = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            size = os.path.getsize(path)
+            tracemalloc.start()     #tracing is slow, so the traced peak comes from a second pass over the first 10%
+            with open(path, mode) as f: exporter(chain.iter_transactions(stop=max(1, num_blocks // 10)), f)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{name:7} {size/2**20:9.1f} MB  {size/2**20/elapsed:7.1f} MB/s  {count/elapsed:12,.0f} txs/s  '
+                  f'peak RSS +{grew/2**10:.1f} MB  traced peak {peak/2**10:8.1f} KB')
+            os.remove(path)
+
+def bench_replay(num_blocks=2000, txs_per_block=500, num_users=10000):
+    '''rebuilding every balance from the chain: Ledger.deposit/transfer per transaction vs replay.replay_balances 
+    (w NumPy if installed, then w its fallback loop), for Blocks and ColumnarBlocks. checks all of them agree'''
+    num_blocks, txs_per_block, num_users = int(num_blocks), int(txs_per_block), int(num_users)
+    def per_transaction(chain):
+        ledger = Ledger()
+        for height, block in chain.iter_blocks():
+            for trans in block:
+                if height > 1: ledger.transfer(trans.from_user, trans.amount)
+                ledger.deposit(trans.to_user, trans.amount)
+        return dict(ledger.balances())
+
+    for cls in (Block, ColumnarBlock):
+        blocks = [cls(list(block)) for block in _ingest_blocks(num_blocks, txs_per_block, num_users)]
+        chain = Blockchain()
+        chain.add_blocks(blocks)
+        count = sum(len(block) for block in chain._blockchain)
+        expected = dict(chain._bc_ledger.balances())
+        start = time.perf_counter()
+        assert per_transaction(chain) == expected
+        t_ledger = time.perf_counter() - start
+        print(f'{cls.__name__:13} Ledger per transaction  {count/t_ledger:12,.0f} txs/s')
+        replay._columns(chain, 1, None)     #interns every user once, so the first engine timed doesn't pay for it
+        np = replay.np
+        for engine in ([np] if np is not None else []) + [None]:
+            replay.np = engine
+            start = time.perf_counter()
+            assert replay.replay_balances(chain) == expected
+            elapsed = time.perf_counter() - start
+            print(f'{cls.__name__:13} replay {"numpy" if engine else "loop":16} {count/elapsed:12,.0f} txs/s  {t_ledger/elapsed:5.1f}x')
+        replay.np = np
+
+def bench_strict(num_blocks=2000, txs_per_block=100, num_users=10000):
+    '''cost of strict mode (running balances within a block) vs the default check, thru add_block and add_blocks'''
+    num_blocks, txs_per_block, num_users = int(num_blocks), int(txs_per_block), int(num_users)
+    count = num_blocks * txs_per_block
+    for how in ('add_block', 'add_blocks'):
+        for strict in (False, True):
+            blocks = chain = None
+            gc.collect()    #so the previous run's garbage isn't collected on this one's time
+            blocks = _ingest_blocks(num_blocks, txs_per_block, num_users)
+            chain = Blockchain(strict=strict)
+            if how == 'add_block': elapsed = _timed(lambda: [chain.add_block(block) for block in blocks])
+            else: elapsed = _timed(chain.add_blocks, blocks)
+            print(f'{how:10} strict={strict!s:5}  {count/elapsed:12,.0f} txs/s')
+
+def bench_metrics(num_blocks=1000, txs_per_block=100, num_users=100000):
+    '''add_block throughput w metrics off and on, then the profile of the run: per operation latencies and the 
+    rehash pauses of the Ledger's hash map as it grows to num_users accounts'''
+    num_blocks, txs_per_block, num_users = int(num_blocks), int(txs_per_block), int(num_users)
+    count = num_blocks * txs_per_block
+    def run():
+        blocks = _ingest_blocks(num_blocks, txs_per_block, num_users)
+        chain = Blockchain()
+        return _timed(lambda: [chain.add_block(block) for block in blocks])
+    t_off = run()
+    with profile() as metrics: t_on = run()
+    print(f'metrics off {count/t_off:12,.0f} txs/s   on {count/t_on:12,.0f} txs/s')
+    stats = metrics.as_dict()
+    for op, s in sorted(stats['operations'].items()):
+        print(f'{op:18} {s["count"]:10,}  mean {s["mean"]*1e6:9.2f} us  p99 <= {s["p99"]*1e6:9.2f} us  max {s["max"]*1e6:10.1f} us')
+    for e in stats['rehashes']['events']:
+        print(f'rehash {e["map"]:15} {e["old_buckets"]:>9,} -> {e["new_buckets"]:>9,} buckets  {e["entries"]:>9,} entries  '
+              f'{e["seconds"]*1e3:8.2f} ms pause')
+
+def bench_rehash(num_keys=10000000):
+    '''per insert latency while a HashMapping grows from 0 to num_keys keys: p50/p99/max and the worst pause, for the 
+    default stop-the-world rehash, incremental=True and pre-sized w capacity=num_keys. 10M keys needs a few GB of RAM'''
+    num_keys = int(num_keys)
+    clock = time.perf_counter
+    for name, make in (('rehash', lambda: HashMapping()), ('incremental', lambda: HashMapping(incremental=True)),
+                       ('capacity', lambda: HashMapping(capacity=num_keys))):
+        hmap = latencies = None
+        gc.collect()
+        hmap, latencies = make(), [0.0] * num_keys
+        gc.disable()    #so collections don't show up as insert pauses
+        start = clock()
+        for i in range(num_keys):
+            key = f'user{i}'
+            t = clock()
+            hmap[key] = i
+            latencies[i] = clock() - t
+        total = clock() - start
+        gc.enable()
+        print(f'{name:12} {num_keys/total:12,.0f} inserts/s  p50 {percentile(latencies, 50)*1e6:7.2f} us  '
+              f'p99 {percentile(latencies, 99)*1e6:7.2f} us  max {max(latencies)*1e3:9.2f} ms')
+
+def bench_codec(num_blocks=200, txs_per_block=1000, num_users=10000):
+    '''encode and decode throughput (MB/s of the encoded form and transactions/s) and bytes per transaction of the 
+    binary codec vs JSON and pickle of the same fields, then checking just the header hash of an encoded block'''
+    num_blocks, txs_per_block, num_users = int(num_blocks), int(txs_per_block), int(num_users)
+    blocks = _ingest_blocks(num_blocks, txs_per_block, num_users)[1:]
+    rng = random.Random(2)
+    for block in blocks:    #random amounts, so they aren't all 1 byte varints
+        for trans in block._block: trans.amount = rng.randrange(10**6)
+    count = num_blocks * txs_per_block
+
+    def fields(block):
+        return (block._previous_block_hash, block._timestamp, block._difficulty, block._nonce,
+                [(t.from_user, t.to_user, t.amount) for t in block])
+    def from_fields(prev, timestamp, difficulty, nonce, rows):
+        return Block._restore([Transaction(*row) for row in rows], prev, nonce, timestamp, difficulty)
+    def json_encode(block):
+        prev, timestamp, difficulty, nonce, rows = fields(block)
+        return json.dumps([prev and prev.hex(), timestamp, difficulty, nonce, rows]).encode()
+    def json_decode(data):
+        prev, timestamp, difficulty, nonce, rows = json.loads(data)
+        return from_fields(prev and bytes.fromhex(prev), timestamp, difficulty, nonce, rows)
+
+    formats = (('codec', encode_block, decode_block),
+               ('json', json_encode, json_decode),
+               ('pickle', lambda block: pickle.dumps(fields(block), pickle.HIGHEST_PROTOCOL),
+                lambda data: from_fields(*pickle.loads(data))))
+    for block in blocks: block.digest()     #so the codec's encode time doesn't include building Merkle roots
+    for name, encode, decode in formats:
+        encoded = []
+        t_enc = _timed(lambda: encoded.extend(encode(block) for block in blocks))
+        t_dec = _timed(lambda: [decode(data) for data in encoded])
+        size = sum(map(len, encoded))
+        print(f'{name:7} {size/count:6.1f} bytes/tx  encode {size/t_enc/1e6:7.1f} MB/s {count/t_enc:11,.0f} txs/s  '
+              f'decode {size/t_dec/1e6:7.1f} MB/s {count/t_dec:11,.0f} txs/s')
+        if name == 'codec':
+            t_hdr = _timed(lambda: [BlockView(data).pow_hash() for data in encoded])
+            print(f'{"":7} header check (BlockView.pow_hash) {num_blocks/t_hdr:11,.0f} blocks/s')
+
+def bench_suite(out='-', num_accounts=10000, txs_per_block=100, num_blocks=1000, skew=1.0, invalid_fraction=0.0, seed=0):
+    '''runs the workload.py suite on a seeded synthetic workload and writes the results as JSON to out (- for 
+    stdout), w a summary line per operation. keep the JSON files of 2 runs to diff them w the compare benchmark'''
+    workload = Workload(int(num_accounts), int(txs_per_block), int(num_blocks), float(skew), float(invalid_fraction),
+                        seed=int(seed))
+    results = run_suite(workload)
+    for op, s in results['operations'].items():
+        print(f'{op:25} {s["count"]:9,}  {s["per_second"]:12,.0f}/s  p50 {s["p50"]*1e6:9.2f} us  '
+              f'p99 {s["p99"]*1e6:9.2f} us  max {s["max"]*1e6:10.1f} us', file=sys.stderr)
+    text = json.dumps(results, indent=2)
+    if out == '-': print(text)
+    else:
+        with open(out, 'w') as f: f.write(text + '\n')
+
+def bench_compare(old, new, threshold=0.1):
+    '''compares 2 JSON files from the suite benchmark and lists every throughput drop or p99 latency/peak memory 
+    rise past threshold (default 10%). exits w status 1 if there is one'''
+    with open(old) as f: before = json.load(f)
+    with open(new) as f: after = json.load(f)
+    regressions = compare(before, after, float(threshold))
+    for op, metric, a, b, change in regressions:
+        print(f'REGRESSION {op:25} {metric:12} {a:14.6g} -> {b:14.6g}  ({change:+.1%})')
+    if regressions: sys.exit(1)
+    print(f'no regressions past {float(threshold):.0%}')
+
+def bench_light(num_blocks=1000, txs_per_block=100, num_users=10000, queries=1000):
+    '''memory of a full node (Blockchain and a lightclient.FullNode's state tree) vs a LightClient w the same 
+    headers, then proof size and verification time for transactions in blocks of 10 ... 10^4 and for balances. the
+    blocks are mined at difficulty 1 (the chain itself doesn't check work, so it isn't retargeted up) w the state
+    root the FullNode commits'''
+    num_blocks, txs_per_block, num_users, queries = int(num_blocks), int(txs_per_block), int(num_users), int(queries)
+    tracemalloc.start()
+    blocks = _ingest_blocks(num_blocks, txs_per_block, num_users)     #made under tracing: the chain keeps them
+    chain = Blockchain()
+    node = FullNode(chain)
+    for block in blocks:
+        block._prev_hash, block._difficulty = chain._blockchain[-1].pow_hash(), 1
+        node.commit_state(chain, block)
+        block._nonce = _search_nonces(block.header_prefix(), _target(1), 0, 2**64)
+        chain.add_block(block)
+    del blocks
+    full = tracemalloc.get_traced_memory()[0]
+    encoded = [header.encode() for header in node.headers()]
+    before = tracemalloc.get_traced_memory()[0]
+    client = LightClient()
+    assert client.add_headers([Header.decode(data) for data in encoded]) == len(chain._blockchain)
+    light = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'full node {full/1e6:9.1f} MB   light client {light/1e6:7.2f} MB '
+          f'({light/len(client):.0f} bytes/header, {full/max(light, 1):,.0f}x less than the full node)')
+
+    rng = random.Random(3)
+    for exp in range(1, 5):
+        block = Block([Transaction(f'user{i}', f'user{i+1}', i) for i in range(10**exp)])
+        levels, root = merkle_levels(block), block.digest()
+        picks = [rng.randrange(len(block)) for i in range(queries)]
+        proofs = [(block[pos].digest(), pos, merkle_proof(levels, pos)) for pos in picks]
+        elapsed = _timed(lambda: [verify_merkle_proof(leaf, pos, proof, root) for leaf, pos, proof in proofs])
+        print(f'transaction proof  block of 10^{exp}  {len(proofs[0][2]):3} hashes {32*len(proofs[0][2]):5} bytes  '
+              f'verify {elapsed/queries*1e6:7.2f} us')
+    height = len(client)
+    users = [f'user{rng.randrange(num_users)}' for i in range(queries)]
+    proofs = [(user,) + node.balance_proof(user)[1:] for user in users]
+    elapsed = _timed(lambda: [client.verify_balance(user, balance, height, proof) for user, balance, proof in proofs])
+    hashes = sum(len(proof[0]) for user, balance, proof in proofs) / queries
+    print(f'balance proof      {len(node._state):,} accounts  {hashes:5.1f} hashes {32*hashes:5.0f} bytes (avg)  '
+          f'verify {elapsed/queries*1e6:7.2f} us')
+
+def _serve_chain(path, num_users, max_batch, ready):
+    '''child process of bench_service: serves a chain w num_users funded users on path until it is terminated'''
+    async def main():
+        chain = Blockchain()
+        chain.add_blocks(Workload(num_users).funding())
+        await BlockchainService(chain, max_batch=max_batch).start(path)
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(main())
+
+def bench_service(max_clients=64, requests=200, num_users=10000, max_batch=1000):
+    '''requests/s and latency of the service.py front end (in its own process, over a Unix socket) w 1, 4, 16 ... 
+    max_clients concurrent clients, half balance reads and half transfers, and how many transfers each add_block 
+    carried on average'''
+    max_clients, requests, num_users, max_batch = int(max_clients), int(requests), int(num_users), int(max_batch)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'chain.sock')
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=_serve_chain, args=(path, num_users, max_batch, ready), daemon=True)
+        server.start()
+        ready.wait()
+        async def height():
+            client = await ServiceClient.connect(path)
+            result = (await client.request('height'))['height']
+            await client.close()
+            return result
+        try:
+            clients = 1
+            while clients <= max_clients:
+                before = asyncio.run(height())
+                stats = asyncio.run(load_test(path, clients, requests, num_users))
+                blocks = asyncio.run(height()) - before
+                writes = stats['requests'] / 2
+                print(f'{clients:4} clients  {stats["per_second"]:9,.0f} req/s  p50 {stats["p50"]*1e3:7.2f} ms  '
+                      f'p99 {stats["p99"]*1e3:7.2f} ms  max {stats["max"]*1e3:8.2f} ms  '
+                      f'~{writes/max(blocks, 1):6.1f} txs/add_block  errors {stats["errors"] or 0}')
+                clients *= 4
+        finally:
+            server.terminate()
+            server.join()
+
+def _memory_kb():
+    '''(anonymous, shared memory) parts of this process' proportional set size in kB: shared pages are split
+    between the processes mapping them, so summing over processes counts the shared ledger once'''
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if rest.strip().endswith('kB'): fields[name] = int(rest.split()[0])
+    return fields.get('Pss_Anon', 0), fields.get('Pss_Shmem', 0)
+
+def _ledger_reader(mode, name, num_users, seconds, barrier, results):
+    '''child process of bench_shared: w a LedgerReplica of the shared ledger called name ("shared") or its own
+    Ledger copy of num_users balances ("copy"), does random has_funds/balance lookups for seconds after the barrier
+    ("idle": no ledger and no lookups, for the interpreter's own memory). puts (lookups/s, anonymous kB, shared
+    memory kB) on results'''
+    if mode == 'shared': ledger = LedgerReplica(name)
+    elif mode == 'idle': seconds = 0
+    else:
+        ledger = Ledger()
+        ledger.set_balances({f'user{i}': 1000 for i in range(num_users)})
+    rng = random.Random(os.getpid())
+    users = [f'user{rng.randrange(num_users)}' for i in range(4096)]
+    barrier.wait()
+    count, end = 0, time.perf_counter() + seconds
+    while mode != 'idle' and time.perf_counter() < end:
+        for user in users:
+            ledger.has_funds(user, 1)
+            ledger.balance(user)
+        count += 2 * len(users)
+    results.put((count / seconds if seconds else 0, *_memory_kb()))
+    barrier.wait()      #everyone measured before anyone exits and frees pages
+    if mode == 'shared': ledger.close()
+
+def bench_shared(max_readers=16, num_users=100000, seconds=2, write=1):
+    '''lookups/s of 1, 2, 4 ... max_readers reader processes on a SharedLedger (while this process applies blocks
+    of 100 transfers, unless write=0) vs readers w their own Ledger copy, and the memory the readers' ledgers take
+    in total: private memory over an idle interpreter's, plus their proportional share of the shared table'''
+    max_readers, num_users, seconds, write = int(max_readers), int(num_users), float(seconds), int(write)
+    ctx = multiprocessing.get_context('spawn')
+    ledger = SharedLedger(num_users + 1)
+    chain = Blockchain(ledger=ledger)
+    chain.add_blocks(Workload(num_users).funding())
+    blocks = Workload(num_users, 100, 1000000).blocks()
+    try:
+        idle = None
+        for mode in ('idle', 'shared', 'copy'):
+            readers = 1
+            while readers <= max_readers:
+                barrier, results = ctx.Barrier(readers + 1), ctx.Queue()
+                procs = [ctx.Process(target=_ledger_reader, args=(mode, ledger.name, num_users, seconds, barrier, results))
+                         for i in range(readers)]
+                for proc in procs: proc.start()
+                barrier.wait()
+                height, end = len(chain._blockchain), time.perf_counter() + seconds
+                while write and mode == 'shared' and time.perf_counter() < end: chain.add_block(next(blocks)[0])
+                stats = [results.get() for proc in procs]
+                barrier.wait()
+                for proc in procs: proc.join()
+                if mode == 'idle':
+                    idle = stats[0]
+                    break
+                print(f'{mode:6}  {readers:2} readers  {sum(s[0] for s in stats):11,.0f} lookups/s  '
+                      f'ledger memory {sum(s[1] - idle[1] + s[2] for s in stats)/1024:7.1f} MB '
+                      f'(shared {sum(s[2] for s in stats)/1024:5.1f} MB)  '
+                      f'{len(chain._blockchain) - height:4} blocks written')
+                readers *= 2
+    finally:
+        ledger.close()
+        ledger.unlink()
+    print(f'shared table {ledger._ledger_hashmap._shm.size/2**20:.1f} MB for {num_users:,} accounts, idle reader '
+          f'{idle[1]/1024:.1f} MB private')
+
+def bench_stake(num_stakers=1000000, selections=100000, num_blocks=200, txs_per_block=100):
+    '''StakeSelector w num_stakers stakes (random, 1 to 10000 tokens, seeded straight into the ledger): building the
+    Fenwick tree, proposer selections/s vs rebuilding cumulative stakes for every slot, the cost of each stake update,
+    and add_block throughput w the selector listening vs w/o it'''
+    num_stakers, selections, num_blocks, txs_per_block = int(num_stakers), int(selections), int(num_blocks), int(txs_per_block)
+    rng = random.Random(1)
+    users = [f'user{i}' for i in range(num_stakers)]
+    chain = Blockchain()
+    chain._bc_ledger.set_balances({user: rng.randint(1, 10000) for user in users})
+    start = time.perf_counter()
+    stakes = StakeSelector(chain)
+    elapsed = time.perf_counter() - start
+    print(f'build         {num_stakers:10,} stakers  {elapsed:8.3f} s')
+    elapsed = _timed(lambda: [stakes.proposer(slot) for slot in range(selections)])
+    print(f'select        {selections/elapsed:14,.0f} selections/s  {elapsed/selections*1e6:8.2f} us')
+    balances = list(chain._bc_ledger.balances())
+    def rebuild(slot):     #what selection costs w/o an incremental structure: cumulative stakes redone every slot
+        cum = list(accumulate(balance for user, balance in balances if user != 'ROOT'))
+        return bisect.bisect_right(cum, slot % cum[-1])
+    slots = 5
+    elapsed = _timed(lambda: [rebuild(slot) for slot in range(slots)])
+    print(f'rebuild       {slots/elapsed:14,.2f} selections/s  {elapsed/slots*1e6:8.0f} us')
+    updates = [(users[rng.randrange(num_stakers)], rng.randint(0, 10000)) for i in range(selections)]
+    elapsed = _timed(lambda: [stakes._update(user, balance) for user, balance in updates])
+    print(f'update        {selections/elapsed:14,.0f} updates/s     {elapsed/selections*1e6:8.2f} us')
+    blocks = [Block([Transaction(users[rng.randrange(num_stakers)], users[rng.randrange(num_stakers)], 1)
+                     for j in range(txs_per_block)]) for i in range(num_blocks)]
+    half = num_blocks // 2
+    elapsed = _timed(lambda: [chain.add_block(block) for block in blocks[:half]])
+    print(f'add_block     {half*txs_per_block/elapsed:14,.0f} txs/s w the selector listening')
+    chain._listeners.remove(stakes)
+    elapsed = _timed(lambda: [chain.add_block(block) for block in blocks[half:]])
+    print(f'add_block     {(num_blocks-half)*txs_per_block/elapsed:14,.0f} txs/s w/o it')
+
+BENCHMARKS = {
+    'hashmap': bench_hashmap,
+    'validate': bench_validate,
+    'ingest': bench_ingest,
+    'hashing': bench_hashing,
+    'memory': bench_memory,
+    'coldstart': bench_coldstart,
+    'history': bench_history,
+    'prevalidate': bench_prevalidate,
+    'hashrate': bench_hashrate,
+    'network': bench_network,
+    'mempool': bench_mempool,
+    'reorg': bench_reorg,
+    'index': bench_index,
+    'export': bench_export,
+    'replay': bench_replay,
+    'strict': bench_strict,
+    'metrics': bench_metrics,
+    'rehash': bench_rehash,
+    'codec': bench_codec,
+    'suite': bench_suite,
+    'compare': bench_compare,
+    'light': bench_light,
+    'service': bench_service,
+    'shared': bench_shared,
+    'stake': bench_stake,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        sys.exit(f'usage: python benchmark.py <{"|".join(BENCHMARKS)}> [args]')
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -1,9 +1,132 @@
+from array import array
+import ast
+from hashlib import sha256
+from itertools import islice
+import math
+import struct
+import time
+import weakref
+
 from hashmap import HashMapping
 
+_EMPTY_ROOT = sha256(b'').digest()     # Merkle root of a block w no transactions
+
+def _varint(n):
+    '''encodes a non-negative int in 7 bit groups, low group first (1 byte for anything under 128)'''
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+_SMALL_LENGTHS = [bytes((n,)) for n in range(128)]    # 1 byte varints
+
+def _encode_value(value):
+    '''canonical bytes for a user or an amount: a 1 byte type tag, a varint length, then the body. floats that are 
+    whole numbers are encoded as ints, so Transactions that are == always get the same bytes'''
+    cls = value.__class__
+    if cls is str:  #fast paths for the usual user names and amounts: same bytes as below
+        body = value.encode()
+        return b's' + (_SMALL_LENGTHS[len(body)] if len(body) < 128 else _varint(len(body))) + body
+    if cls is int:
+        body = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+        return b'i' + (_SMALL_LENGTHS[len(body)] if len(body) < 128 else _varint(len(body))) + body
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    if isinstance(value, str): tag, body = b's', value.encode()
+    elif isinstance(value, int): tag, body = b'i', int(value).to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+    elif isinstance(value, float): tag, body = b'f', struct.pack('>d', value)
+    else: tag, body = b'r', repr(value).encode()
+    return tag + _varint(len(body)) + body
+
+def _read_varint(buf, pos):
+    '''decodes a varint from buf starting at pos. returns (value, position after it)'''
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80: return n, pos
+        shift += 7
+
+def _decode_value(buf, pos):
+    '''decodes one value written by _encode_value from buf (bytes or memoryview) at pos. returns (value, position after it)'''
+    tag = buf[pos]
+    length, pos = _read_varint(buf, pos + 1)
+    body, end = buf[pos:pos+length], pos + length
+    if tag == 0x73: return bytes(body).decode(), end    # b's'
+    if tag == 0x69: return int.from_bytes(body, 'big', signed=True), end     # b'i'
+    if tag == 0x66: return struct.unpack('>d', body)[0], end     # b'f'
+    if tag == 0x72: return _decode_repr(bytes(body).decode()), end      # b'r'
+    raise ValueError(f'cannot decode value w tag {chr(tag)!r} at {pos}')
+
+def _decode_repr(text):
+    '''rebuilds a value _encode_value wrote as its repr (ie: a tuple or None as a user). only literals come back:
+    nothing is eval'ed, so any other repr raises ValueError'''
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        raise ValueError(f'cannot decode value from its repr {text!r}') from None
+
+_HEADER_TAIL = struct.Struct('<dB')    # timestamp and difficulty, after the prev hash and Merkle root in a block header
+
+def _target(difficulty):
+    '''largest header hash (as 32 big-endian bytes) that meets difficulty: the hash must start w difficulty zero bits'''
+    return ((1 << (256 - difficulty)) - 1).to_bytes(32, 'big')
+
+def _search_nonces(prefix, target, start, stop):
+    '''returns the first nonce in range(start, stop) whose header hash is <= target, or None. hashes the header prefix 
+    once and copies that sha256 state for each nonce, so only the 8 nonce bytes are hashed per try'''
+    midstate = sha256(prefix)
+    for nonce in range(start, stop):
+        h = midstate.copy()
+        h.update(nonce.to_bytes(8, 'little'))
+        if h.digest() <= target: return nonce
+    return None
+
+def retarget(difficulty, actual_time, expected_time, max_step=2):
+    '''new difficulty (in bits) after blocks took actual_time seconds instead of expected_time: each bit doubles the 
+    work, so it moves by log2(expected/actual), at most max_step bits either way and never below 1'''
+    step = round(math.log2(expected_time / max(actual_time, 1e-9)))
+    return max(1, difficulty + max(-max_step, min(max_step, step)))
+
+def _merkle_node(left, right):
+    '''hash of an inner Merkle node. leaves are prefixed w 0x00 and inner nodes w 0x01 so they can never collide'''
+    return sha256(b'\x01' + left + right).digest()
+
+def _merkle_push(peaks, leaf):
+    '''appends a leaf to a Merkle frontier. peaks[k] is the root of a full subtree of 2^k leaves that is still waiting 
+    for its right sibling (or None), so each append hashes at most log2(n) nodes'''
+    node = leaf
+    for k, peak in enumerate(peaks):
+        if peak is None:
+            peaks[k] = node
+            return
+        node = _merkle_node(peak, node)     #carry the finished subtree up a level
+        peaks[k] = None
+    peaks.append(node)
+
+def _merkle_root(peaks):
+    '''folds a Merkle frontier into the root. a node w/o a right sibling is paired w itself, like Bitcoin'''
+    if not peaks: return _EMPTY_ROOT
+    top, node = len(peaks) - 1, None
+    for k, peak in enumerate(peaks):
+        if node is None:
+            if peak is None: continue
+            if k == top: return peak    #number of leaves is a power of 2
+            node = _merkle_node(peak, peak)
+        elif peak is None: node = _merkle_node(node, node)
+        else: node = _merkle_node(peak, node)
+    return node
+
 class Transaction():
     '''A single transaction of COIN'''
+    __slots__ = ('from_user', 'to_user', 'amount', '_digest', '_blocks')   # no per-instance __dict__
+
     def __init__(self, from_user, to_user, amount):
         '''inits Transaction that contain: from-user, to-user, and how much'''
+        self._digest = None     # cached SHA-256 digest, filled in by digest()
+        self._blocks = None     # weakref (or list of them) to the Blocks holding this Transaction, see _own
         self.from_user = from_user
         self.to_user = to_user
         
@@ -22,48 +145,304 @@ class Transaction():
     def __hash__(self):
         '''returns the hash of the tuple of the from_user, to_user, and amount of this Transaction'''
         return hash((self.from_user, self.to_user, self.amount))
+
+    def __reduce__(self):
+        '''pickles as the 3 fields (as a plain Transaction, whatever blocks it was in)'''
+        return (Transaction, (self.from_user, self.to_user, self.amount))
+
+    def encode(self):
+        '''canonical bytes of from_user, to_user and amount. the same fields give the same bytes in every process'''
+        return _encode_value(self.from_user) + _encode_value(self.to_user) + _encode_value(self.amount)
+
+    @classmethod
+    def decode(cls, buf, pos=0):
+        '''rebuilds a Transaction from bytes made by encode(). returns (transaction, position after it)'''
+        from_user, pos = _decode_value(buf, pos)
+        to_user, pos = _decode_value(buf, pos)
+        amount, pos = _decode_value(buf, pos)
+        return cls(from_user, to_user, amount), pos
+
+    def digest(self):
+        '''returns the SHA-256 digest (32 bytes) of this Transaction, used as its Merkle leaf. cached until a field changes'''
+        if self._digest is None: self._digest = sha256(b'\x00' + self.encode()).digest()
+        return self._digest
+
+_FIELDS = frozenset(('from_user', 'to_user', 'amount'))
+
+class _HeldTransaction(Transaction):
+    '''class a Transaction is switched to once it is added to a Block. fields can still be edited (ie: fixing a typo), 
+    but an edit clears the cached digest and tells the blocks holding it, so only their Merkle roots get recomputed. 
+    plain Transactions don't have this hook, so making them stays fast'''
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        '''sets the field, then drops the digest of this Transaction and of the blocks holding it'''
+        object.__setattr__(self, name, value)
+        if name in _FIELDS:
+            object.__setattr__(self, '_digest', None)
+            owners = self._blocks
+            if owners is None: return
+            for ref in (owners if isinstance(owners, list) else (owners,)):
+                block = ref()
+                if block is not None: block._stale()
+
+def _own(transaction, block):
+    '''records that block holds transaction (a weakref, so blocks are still freed w/o the cycle collector)'''
+    ref, owners = block._ref, transaction._blocks
+    if owners is None:
+        if transaction.__class__ is Transaction:
+            transaction._blocks = ref   #before the switch, while setting it still skips the hook
+            transaction.__class__ = _HeldTransaction
+        else: object.__setattr__(transaction, '_blocks', ref)
+    elif owners is ref: return
+    elif isinstance(owners, list):
+        if ref not in owners: owners[:] = [r for r in owners if r() is not None] + [ref]
+    elif owners() is None: object.__setattr__(transaction, '_blocks', ref)    #the block it was in is gone
+    else: object.__setattr__(transaction, '_blocks', [owners, ref])
  
 class Block():
-    '''Block is a collection of Transaction objects. each block is linked with the previous one by containing the prev's hash'''
+    '''Block is a collection of Transaction objects. each block is linked with the previous one by containing the prev's 
+    header hash (pow_hash), which covers the Merkle root of its transactions and its own prev hash'''
+    __slots__ = ('_prev_hash', '_block', '_len', '_peaks', '_peaks_key', '_root', '_chain', '_nonce', '_timestamp', 
+                 '_difficulty', '_state_root', '_ref', '__weakref__')
+
     def __init__(self, transactions=None, previous_block_hash=None):
         '''inits block w a prev hash var and _block, which is the list of Transactions'''
-        self._previous_block_hash = previous_block_hash
-        self._block = []
+        self._prev_hash = previous_block_hash
+        self._ref = weakref.ref(self)   # what the block's Transactions point back at
+        self._init_storage()
         self._len = 0
-        if transactions is not None:    #adds all transactions to _block if there are any upon initilization
-            for trans in transactions: self.add_transaction(trans)
+        self._peaks = []        # Merkle frontier of the first _peaks_key transactions, see _merkle_push
+        self._peaks_key = 0
+        self._root = None       # cached Merkle root
+        self._chain = None      # the Blockchain the block is in, set by it once the block is added
+        self._nonce = 0         # proof of work fields, set by Blockchain.mine
+        self._timestamp = 0.0
+        self._difficulty = 0
+        self._state_root = None # ledger state root after the block, committed in the header if set (see lightclient)
+        if transactions is not None: self._add_transactions(transactions)   #adds all transactions to _block if there are any upon initilization
 
     def __repr__(self):
         '''String representation of Block'''
         return f'Block: {self._block}'
+
+    def __len__(self):
+        '''returns how many Transactions are in the block'''
+        return self._len
     
     def __eq__(self, other):
         '''returns true if the list of Transactions in each block is the same'''
         return self._block == other._block
     
     def __hash__(self):
-        '''returns the hash of the string of the list of Transactions'''
-        return hash(tuple(self._block))
+        '''returns the first 8 bytes of the block's digest as an int, so it is the same in every process'''
+        return int.from_bytes(self.digest()[:8], 'big')
+
+    def digest(self):
+        '''returns the Merkle root (32 bytes) of the block's transactions. transactions added since the last call are 
+        pushed onto the cached frontier; it is only rebuilt from scratch after one of this block's Transactions was 
+        edited'''
+        block, done = self._block, self._peaks_key
+        if done is None or done > len(block): self._peaks, done = [], 0
+        if done < len(block):
+            peaks = self._peaks
+            for trans in islice(block, done, None): _merkle_push(peaks, trans.digest())
+            self._peaks_key, self._root = len(block), None
+        if self._root is None: self._root = _merkle_root(self._peaks)
+        return self._root
+
+    def _rehash(self):
+        '''recomputes the Merkle root from the transactions' fields, w/o any cached digest, and recaches it (used by 
+        validate_chain(full=True), so even edits that bypassed the hooks are caught)'''
+        peaks, count = [], 0
+        for trans in self:
+            _merkle_push(peaks, sha256(b'\x00' + trans.encode()).digest())
+            count += 1
+        self._peaks, self._peaks_key, self._root = peaks, count, _merkle_root(peaks)
+        return self._root
+
+    def _stale(self):
+        '''called when one of the block's Transactions is edited: drops the cached Merkle root'''
+        self._peaks, self._peaks_key, self._root = [], 0, None
+        if self._chain is not None: self._chain._edits += 1
+
+    def header_prefix(self):
+        '''block header w/o the nonce: prev header hash (zeros if None), Merkle root, timestamp, difficulty and the state root
+        (only if the block has one)'''
+        prefix = (self._prev_hash or bytes(32)) + self.digest() + _HEADER_TAIL.pack(self._timestamp, self._difficulty)
+        return prefix if self._state_root is None else prefix + self._state_root
+
+    def pow_hash(self):
+        '''SHA-256 of the full block header (prefix + 8 byte nonce)'''
+        return sha256(self.header_prefix() + self._nonce.to_bytes(8, 'little')).digest()
+
+    @classmethod
+    def _restore(cls, transactions, previous_block_hash, nonce=0, timestamp=0.0, difficulty=0, state_root=None):
+        '''builds a block w/o digesting its transactions (used when reloading a chain from disk: the caller sets _chain
+        once the block is in one). the Merkle frontier is built the first time digest() is called'''
+        block = cls.__new__(cls)
+        block._prev_hash = previous_block_hash
+        block._ref = weakref.ref(block)
+        block._init_storage()
+        block._len = 0
+        for trans in transactions:
+            block._store(trans)
+            block._len += 1
+        block._peaks, block._peaks_key, block._root, block._chain = [], None, None, None
+        block._nonce, block._timestamp, block._difficulty = nonce, timestamp, difficulty
+        block._state_root = state_root
+        return block
+
+    @property
+    def _previous_block_hash(self):
+        '''header hash (pow_hash) of the previous block in the chain (None for the genesis block or a block not in a chain yet)'''
+        return self._prev_hash
+
+    @_previous_block_hash.setter
+    def _previous_block_hash(self, value):
+        '''changing the prev hash of a chained block counts as an edit, so its Blockchain's validate_chain rechecks 
+        everything'''
+        self._prev_hash = value
+        if self._chain is not None: self._chain._edits += 1
     
     def __iter__(self):
         '''makes Block iterable by iterating through the list: self._block'''
         return iter(self._block)
+
+    def __getitem__(self, i):
+        '''returns the Transaction at position i'''
+        return self._block[i]
     
     def add_transaction(self, transaction):
-        '''adds an input Transaction to self._block'''
+        '''adds an input Transaction to self._block. it is digested into the Merkle frontier by the next digest()'''
+        self._store(transaction)
+        self._len += 1
+        self._root = None
+        if self._chain is not None: self._chain._edits += 1
+
+    def _add_transactions(self, transactions):
+        '''add_transaction for many Transactions, w _store inlined for the common case of new Transactions'''
+        block, ref = self._block, self._ref
+        for trans in transactions:
+            block.append(trans)
+            if trans._blocks is None and trans.__class__ is Transaction:   #same as _own
+                trans._blocks = ref
+                trans.__class__ = _HeldTransaction
+            else: _own(trans, self)
+        self._len = len(block)
+        self._root = None
+        if self._chain is not None: self._chain._edits += 1
+
+    def _init_storage(self):
+        '''sets up the empty storage for the block's transactions: a plain list of Transaction objects'''
+        self._block = []
+
+    def _store(self, transaction):
+        '''appends a Transaction to the block's storage'''
         self._block.append(transaction)
+        _own(transaction, self)
+
+_user_ids = {}      # user -> interned id, shared by every ColumnarBlock
+_user_names = []    # interned id -> user
+
+def _intern_user(user):
+    '''returns the interned int id of user, adding it if it is new'''
+    uid = _user_ids.get(user)
+    if uid is None:
+        uid = _user_ids[user] = len(_user_names)
+        _user_names.append(user)
+    return uid
+
+class ColumnarBlock(Block):
+    '''A Block that stores its transactions as columns instead of Transaction objects: interned from/to user ids in 
+    typed arrays and amounts in an int64 array (a float64 array once a fractional amount shows up, or a plain list for 
+    ints too big for either). iterating yields new Transaction objects built on demand, so editing them does not 
+    change the block. same digest, __eq__ and __hash__ as a Block w the same transactions'''
+    __slots__ = ('_from_ids', '_to_ids', '_amounts')
+
+    @property
+    def _block(self):
+        '''list of the block's transactions, built on demand (same as Block._block)'''
+        return list(self)
+
+    def __iter__(self):
+        '''yields a new Transaction for each row of the columns'''
+        names = _user_names
+        for frm, to, amt in zip(self._from_ids, self._to_ids, self._amounts):
+            yield Transaction(names[frm], names[to], amt)
+
+    def __getitem__(self, i):
+        '''returns a new Transaction built from row i of the columns'''
+        return Transaction(_user_names[self._from_ids[i]], _user_names[self._to_ids[i]], self._amounts[i])
+
+    def digest(self):
+        '''returns the Merkle root of the block's transactions. columns can't be edited, so the frontier is only built 
+        once for a block reloaded from disk and never rebuilt after that'''
+        if self._peaks_key is None: return Block.digest(self)
+        if self._root is None: self._root = _merkle_root(self._peaks)
+        return self._root
+
+    def _add_transactions(self, transactions):
+        '''adds copies of many Transactions to the columns'''
+        for trans in transactions: self.add_transaction(trans)
+
+    def add_transaction(self, transaction):
+        '''adds a copy of an input Transaction to the columns'''
+        if self._peaks_key is not None:
+            _merkle_push(self._peaks, transaction.digest())
+            self._peaks_key += 1
+        self._store(transaction)
         self._len += 1
+        self._root = None
+        if self._chain is not None: self._chain._edits += 1
+
+    def _init_storage(self):
+        '''sets up the empty columns'''
+        self._from_ids = array('I')
+        self._to_ids = array('I')
+        self._amounts = array('q')
+
+    def _store(self, transaction):
+        '''appends a Transaction's fields to the columns, widening the amount column if it can't hold the amount exactly'''
+        amt, amounts = transaction.amount, self._amounts
+        if isinstance(amounts, array):
+            if amounts.typecode == 'q': fits = isinstance(amt, int) and -2**63 <= amt < 2**63
+            else: fits = isinstance(amt, float) or abs(amt) <= 2**53     #ints past 2**53 would lose precision as floats
+            if not fits:
+                if isinstance(amt, float) and all(abs(a) <= 2**53 for a in amounts): amounts = array('d', amounts.tolist())
+                else: amounts = amounts.tolist()
+                self._amounts = amounts
+        amounts.append(amt)
+        self._from_ids.append(_intern_user(transaction.from_user))
+        self._to_ids.append(_intern_user(transaction.to_user))
 
 class Ledger():
     '''Keeps track of all user balances using HashMapping'''
-    def __init__(self):
-        '''inits with an empty HashMapping'''
-        self._ledger_hashmap = HashMapping()
+    def __init__(self, hashmap_cls=HashMapping):
+        '''inits with an empty HashMapping. pass hashmap_cls=OpenHashMapping for the compact open-addressing engine'''
+        self._ledger_hashmap = hashmap_cls()
 
     def __repr__(self):
         '''returns a simple print statement of the hashmap'''
         return f'Ledger: {self._ledger_hashmap}'
     
+    def balance(self, user):
+        '''returns the user's balance, or None if the user is not in the ledger'''
+        return self._ledger_hashmap.get(user)
+
+    def set_balances(self, balances):
+        '''sets the balance of every user in the balances dict'''
+        hmap = self._ledger_hashmap
+        for user, amount in balances.items(): hmap[user] = amount
+
+    def balances(self):
+        '''iterates thru every (user, balance) pair'''
+        return self._ledger_hashmap.items()
+
+    def remove(self, user):
+        '''removes a user's account from the ledger (used when undoing the block that created it)'''
+        del self._ledger_hashmap[user]
+
     def has_funds(self, user, amount):
         '''checks if the user has enough funds to make the transaciton'''
         if user not in self._ledger_hashmap: return False
@@ -78,29 +457,103 @@ class Ledger():
         #no need to check if user has enough in this method: has funds is always called before this
         self._ledger_hashmap[user] -= amount
 
+    def apply(self, transactions, strict=False):
+        '''applies a block's transactions if every sender has the funds for their transaction (each checked vs the 
+        balance before the block, like add_block always has; strict=True checks them w check_running instead). 
+        returns False, w/o changing anything, if one doesn't'''
+        if strict:
+            if not self.check_running(transactions): return False
+        else:
+            for trans in transactions:
+                if not self.has_funds(trans.from_user, trans.amount): return False
+        for trans in transactions:
+            frm, to, amt = trans.from_user, trans.to_user, trans.amount
+            self.transfer(frm, amt)     #subtracts COIN from the from_user
+            self.deposit(to, amt)       #adds COIN to the to_user
+        return True
+
+    def check_running(self, transactions):
+        '''checks a block's transactions in order vs each sender's running balance: the balance before the block plus 
+        what the block already sent and paid them, so several spends that each fit the old balance can't overdraw it 
+        together. only the block's users are tracked (in a scratch dict), so it costs O(transactions)'''
+        running = {}    #user -> net change of the block so far
+        for trans in transactions:
+            frm, to, amt = trans.from_user, trans.to_user, trans.amount
+            bal = self.balance(frm)
+            if bal is None and frm not in running: return False     #no account yet, same as has_funds
+            spend = running.get(frm, 0) - amt
+            if (bal or 0) + spend < 0: return False
+            running[frm] = spend
+            running[to] = running.get(to, 0) + amt
+        return True
+
 class Blockchain():
     '''Contains the chain of blocks.''' 
     _ROOT_BC_USER = "ROOT"            # Name of root user account.  
     _BLOCK_REWARD = 1000              # Amount of COIN given as a reward for mining a block
     _TOTAL_AVAILABLE_TOKENS = 999999  # Total balance of COIN that the ROOT user receives in block0
+    _RETARGET_INTERVAL = 10           # Proof of work difficulty is retargeted every this many blocks...
+    _TARGET_BLOCK_TIME = 10.0         # ...so that blocks take about this many seconds to mine
 
-    def __init__(self):
-        '''initilizes Blockchain with a list of blocks and an instance of Ledger, along with the genesis block'''
+    def __init__(self, hashmap_cls=HashMapping, log=None, difficulty=0, ledger=None, strict=False):
+        '''initilizes Blockchain with a list of blocks and an instance of Ledger, along with the genesis block.
+        hashmap_cls picks the Ledger's hash map engine. if log (a chainlog.ChainLog) is given, every accepted block 
+        is appended to it, and a log that already has blocks is replayed instead of making a new genesis block.
+        difficulty > 0 turns on proof of work: blocks need a header hash w that many leading zero bits (see mine).
+        ledger is an empty Ledger to use instead of a new one (ie: a sharedledger.SharedLedger); hashmap_cls is ignored then.
+        strict=True also rejects blocks where a sender's spends add up to more than they have (see Ledger.check_running)'''
         self._blockchain = list()     # Use list for  chain of blocks
-        self._bc_ledger = Ledger()    # The ledger of COIN balances
-        self._create_genesis_block()    # Create the initial block0 of the blockchain (genesis block)
+        self._bc_ledger = ledger if ledger is not None else Ledger(hashmap_cls)    # The ledger of COIN balances
+        self._validated = 0           # watermark: the links of blocks [0, _validated) have been checked by validate_chain
+        self._edits = 0               # changes to blocks already in this chain (new or edited transactions, a new prev hash)
+        self._validated_edits = None  # _edits when the watermark was set
+        self._invalid_blocks = []     # invalid blocks found below the watermark
+        self._log = log               # optional on-disk ChainLog
+        self._listeners = []          # objects told about every accepted block, see add_listener
+        self._difficulty = difficulty # proof of work difficulty in bits (0 = off)
+        self._strict = strict         # check each sender's running balance within a block, not just the balance before it
+        if log is not None and not log.is_empty(): log.replay(self)   # restart: reload the chain and ledger from disk
+        else: self._create_genesis_block()    # Create the initial block0 of the blockchain (genesis block)
 
     def __repr__(self):
         '''makes a simple string representation of the blockchain and its blocks (and the blocks' transactions)'''
         return f'Blockchain: {self._blockchain}'
 
+    def iter_blocks(self, start=1, stop=None):
+        '''lazily yields (height, block) for the blocks from height start thru stop (default: the last block). the 
+        genesis block is height 1, like LedgerHistory'''
+        stop = len(self._blockchain) if stop is None else min(stop, len(self._blockchain))
+        return zip(range(max(start, 1), stop + 1), islice(self._blockchain, max(start, 1) - 1, stop))
+
+    def iter_transactions(self, start=1, stop=None, user=None, min_amount=None, max_amount=None):
+        '''lazily yields (height, position, Transaction) for the transactions in the blocks from height start thru 
+        stop. user keeps only transactions it sends or receives; min_amount/max_amount keep only amounts in that range'''
+        for height, block in self.iter_blocks(start, stop):
+            for pos, trans in enumerate(block):
+                if user is not None and trans.from_user != user and trans.to_user != user: continue
+                if min_amount is not None and trans.amount < min_amount: continue
+                if max_amount is not None and trans.amount > max_amount: continue
+                yield height, pos, trans
+
     def _create_genesis_block(self):
         '''Creates the initial block in the chain. Process is simplified to
         facilitate the transaction of COIN easily.'''
         trans0 = Transaction(self._ROOT_BC_USER, self._ROOT_BC_USER, self._TOTAL_AVAILABLE_TOKENS)
         block0 = Block([trans0])
+        block0._chain = self
         self._blockchain.append(block0)
         self._bc_ledger.deposit(self._ROOT_BC_USER, self._TOTAL_AVAILABLE_TOKENS)
+        if self._log is not None:
+            self._log.append(block0)
+            self._log.commit(self)
+
+    def add_listener(self, listener):
+        '''registers listener to be called as listener.block_added(chain, block, changes) right after each block is 
+        appended, where changes maps every user the block touched to (balance before, balance after). balance before 
+        is None for a new account. listeners should use changes instead of reading the Ledger, which add_blocks only 
+        updates at the end of the batch. a listener can also have a block_removed(chain, block, changes) method, called 
+        when a block is undone by a reorg (see blocktree.BlockTree)'''
+        self._listeners.append(listener)
 
     def distribute_mining_reward(self, user):
         '''
@@ -108,33 +561,162 @@ class Blockchain():
         to solve the nonce in order to mine more COIN'''
         trans = Transaction(self._ROOT_BC_USER, user, self._BLOCK_REWARD)
         block = Block([trans])
+        if self._difficulty: self.mine(block)   #w proof of work on, the reward block has to be mined
         self.add_block(block)
 
+    def mine(self, block, miner=None):
+        '''does the proof of work for block on top of the current last block, so add_block will accept it: sets its 
+        prev hash, timestamp and difficulty, lets listeners w a commit_state hook fill in the block's state root (see 
+        lightclient.FullNode), then searches for a nonce. miner (a mining.Miner) spreads the search over several 
+        processes; w/o one the search runs here. raises RuntimeError (and leaves the nonce as it was) if no nonce meets 
+        the difficulty'''
+        block._prev_hash = self._blockchain[-1].pow_hash()
+        block._timestamp = time.time()
+        block._difficulty = self._difficulty
+        for listener in self._listeners:
+            commit_state = getattr(listener, 'commit_state', None)
+            if commit_state is not None: commit_state(self, block)
+        if miner is not None: nonce = miner.search(block.header_prefix(), block._difficulty)
+        else: nonce = _search_nonces(block.header_prefix(), _target(block._difficulty), 0, 2**64)
+        if nonce is None: raise RuntimeError(f'no nonce meets difficulty {block._difficulty} for this block')
+        block._nonce = nonce
+
+    def _has_work(self, block):
+        '''checks a block's proof of work: mined at the current difficulty on top of the current last block (its prev 
+        hash is the last block's header hash)'''
+        return (block._difficulty == self._difficulty and block._prev_hash == self._blockchain[-1].pow_hash()
+                and block.pow_hash() <= _target(block._difficulty))
+
     def add_block(self, block):
         '''adds a block to the blockchain if it is valid; if any transaction is invalid (user doesnt have enough COIN) 
         then block is not added and returns false'''
-        for trans in block:         #iterates thru curr Block
-            frm, amt = trans.from_user, trans.amount
-            if not self._bc_ledger.has_funds(frm, amt): return False    #returns false if any user does not have enough COIN to complete transaction
+        if self._difficulty and not self._has_work(block): return False     #proof of work is missing or wrong
 
-        for trans in block:         #reiterates thru the Block
-            frm, to, amt = trans.from_user, trans.to_user, trans.amount
-            self._bc_ledger.transfer(frm, amt)  #subtracts COIN from the from_user; updates ledger
-            self._bc_ledger.deposit(to, amt)    #adds COIN to the to_user; updates ledger
-        
-        block._previous_block_hash = hash(self._blockchain[len(self._blockchain)-1]) #sets prev block hash using the hash of the previous block in _blockchain
-        
-        self._blockchain.append(block)  #appends the block to the end of the chain
+        changes = None
+        if self._listeners:     #remembers the balances before the block so listeners can be told what changed
+            changes = {user: self._bc_ledger.balance(user) for trans in block for user in (trans.from_user, trans.to_user)}
+
+        if not self._bc_ledger.apply(block, self._strict): return False   #returns false if any user does not have enough COIN to complete transaction
+
+        if changes is not None:
+            changes = {user: (old, self._bc_ledger.balance(user)) for user, old in changes.items()}
+        self._link(block, changes)   #sets prev block hash and appends the block to the end of the chain
+        if self._log is not None: self._log.commit(self)
         return True #returns true if the block was successfully added
 
-    def validate_chain(self):
-        '''if a block's prev hash is not the hash of the block in front of it, the block with the incorrect prev hash value is 
-        returned in a list of other blocks that have been tampered with'''
-        invalid_blocks = [] #inits the list of invalid blocks
-        if self._blockchain[0]._previous_block_hash != None: invalid_blocks.append(self._blockchain[0])  #checks that the genesis block's prev is None
+    def add_blocks(self, blocks):
+        '''adds many blocks in one call and returns a list w True/False for each block (same result as calling add_block 
+        on each one). each account's balance is read from the Ledger once for the whole batch and kept in a local dict, 
+        transactions are applied to that dict in block order (the same float operations as Ledger.apply, so balances 
+        come out bit for bit the same), and every changed account is written back to the Ledger once at the end'''
+        ledger = self._bc_ledger
+        listening, strict = bool(self._listeners), self._strict
+        balances = {}       #user -> balance as of the last accepted block in this batch (None if not in the ledger)
+        changed = set()     #users whose balance has to be written back
+        results = []
+
+        try:
+            for block in blocks:
+                if self._difficulty and not self._has_work(block):
+                    results.append(False)
+                    continue
+
+                running = {}    #user -> net change of this block so far (for the strict check)
+                for trans in block:
+                    frm, to, amt = trans.from_user, trans.to_user, trans.amount
+                    if frm in balances: bal = balances[frm]
+                    else: bal = balances[frm] = ledger.balance(frm)
+                    if to not in balances: balances[to] = ledger.balance(to)
+                    if strict:  #same check as check_running: vs the running balance
+                        spend = running.get(frm, 0) - amt
+                        if (bal is None and frm not in running) or (bal or 0) + spend < 0: break
+                        running[frm] = spend
+                        running[to] = running.get(to, 0) + amt
+                    elif bal is None or bal < amt: break  #same check as has_funds: vs the balance before the block
+                else:   #every transaction is valid: apply them in order, like Ledger.transfer and deposit
+                    before = {user: balances[user] for trans in block for user in (trans.from_user, trans.to_user)} \
+                        if listening else None
+                    for trans in block:
+                        frm, to, amt = trans.from_user, trans.to_user, trans.amount
+                        balances[frm] = (balances[frm] or 0) - amt
+                        balances[to] = (balances[to] or 0) + amt     #new users start at 0, like deposit
+                        changed.add(frm)
+                        changed.add(to)
+                    changes = {user: (old, balances[user]) for user, old in before.items()} if listening else None
+                    self._link(block, changes)
+                    results.append(True)
+                    continue
+
+                results.append(False)
+        finally:    #write back even if a bad block raised, so the ledger matches the blocks that were linked
+            ledger.set_balances({user: balances[user] for user in changed})
+            if self._log is not None: self._log.commit(self)
+
+        return results
+
+    def _link(self, block, changes=None):
+        '''sets block's prev hash to the header hash of the last block in _blockchain, appends it to the chain and tells 
+        the log and listeners about it. changes is the block's balance changes (only needed when there are listeners)'''
+        block._prev_hash = self._blockchain[len(self._blockchain)-1].pow_hash() #sets prev block hash using the header hash of the previous block in _blockchain
+        block._chain = self
+        self._blockchain.append(block)
+        if self._log is not None: self._log.append(block)
+        if self._difficulty and len(self._blockchain) % self._RETARGET_INTERVAL == 0: self._retarget()
+        for listener in self._listeners: listener.block_added(self, block, changes)
+
+    def _unlink(self, changes):
+        '''removes the last block from the chain, restores the balances it changed from changes (as recorded when it 
+        was added: new accounts are removed) and tells listeners that have a block_removed hook. returns the block'''
+        if self._log is not None: raise ValueError('cannot unlink a block from a Blockchain that has a ChainLog')
+        block = self._blockchain.pop()
+        block._chain = None
+        ledger = self._bc_ledger
+        ledger.set_balances({user: old for user, (old, new) in changes.items() if old is not None})
+        for user, (old, new) in changes.items():
+            if old is None: ledger.remove(user)
+        self._validated_edits = None    #next validate_chain starts over
+        for listener in self._listeners:
+            block_removed = getattr(listener, 'block_removed', None)
+            if block_removed is not None: block_removed(self, block, changes)
+        return block
+
+    def _retarget(self):
+        '''adjusts the difficulty from how long the last _RETARGET_INTERVAL blocks took to mine'''
+        first, last = self._blockchain[-self._RETARGET_INTERVAL], self._blockchain[-1]
+        if first._timestamp and last._timestamp:    #blocks from before proof of work was turned on have no timestamp
+            expected = self._TARGET_BLOCK_TIME * (self._RETARGET_INTERVAL - 1)
+            self._difficulty = retarget(self._difficulty, last._timestamp - first._timestamp, expected)
+
+    def validate_chain(self, full=False):
+        '''if a block's prev hash is not the header hash (pow_hash) of the block in front of it, or a block mined w proof 
+        of work doesn't meet its difficulty, the block is returned in a list of other blocks that have been tampered 
+        with. the header hash covers the Merkle root and the prev hash, so rewriting a block means redoing the work of 
+        every block after it.
+        only blocks added since the last call are checked, unless a chained block or one of its Transactions has been 
+        edited since then (then every link is rechecked, but only the edited blocks are rehashed). full=True always 
+        rechecks the whole chain, recomputing every Merkle root from the transactions themselves'''
+        chain = self._blockchain
+        edits = self._edits
+        if full or edits != self._validated_edits:     #something may have been tampered with: drop the watermark
+            self._validated, self._invalid_blocks = 0, []
+
+        invalid_blocks = self._invalid_blocks   #invalid blocks below the watermark are still invalid
+        if self._validated == 0:
+            if chain[0]._previous_block_hash != None: invalid_blocks.append(chain[0])  #checks that the genesis block's prev is None
+            start = 0
+        else:
+            start = self._validated - 1     #the last validated block still has to be compared w the first new one
 
-        for i in range(len(self._blockchain)-1):    #iterates thru the blockchain
-            if hash(self._blockchain[i]) != self._blockchain[i+1]._previous_block_hash: #compares the hash of the block and the next block's prev_block_hash
-                invalid_blocks.append(self._blockchain[i+1])    #if the prev_hash is incorrect, the block w the incorrect prev hash is appended to the list
+        prev = None
+        for i in range(start, len(chain)):    #iterates thru the unchecked part of the blockchain
+            block = chain[i]
+            if full: block._rehash()
+            header = block.pow_hash()
+            if prev is not None and block._previous_block_hash != prev: #compares the header hash of the block before w this block's prev_block_hash
+                invalid_blocks.append(block)    #if the prev_hash is incorrect, the block w the incorrect prev hash is appended to the list
+            elif (i > start or start == 0) and block._difficulty and header > _target(block._difficulty):
+                invalid_blocks.append(block)    #its proof of work doesn't meet its difficulty
+            prev = header
 
-        return invalid_blocks   #returns list of blocks that have been tampered with
+        self._validated, self._validated_edits = len(chain), edits
+        return list(invalid_blocks)   #returns list of blocks that have been tampered with
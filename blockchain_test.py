@@ -1,5 +1,35 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
-from blockchain import Transaction, Block, Ledger, Blockchain
+from hashlib import sha256
+from blockchain import Transaction, Block, ColumnarBlock, Ledger, Blockchain
+from hashmap import HashMapping, OpenHashMapping
+from chainlog import ChainLog
+from history import LedgerHistory
+from validation import ValidationPipeline, check_transaction
+from mining import Miner
+from mempool import Mempool
+from blocktree import BlockTree
+from chainindex import ChainIndex
+from export import export_csv, export_jsonl, export_binary, read_binary
+import replay
+from codec import encode_block, decode_block, BlockView, encode_transaction, decode_transaction, VERSION
+from metrics import Metrics, profile
+from workload import Workload, run_suite, compare
+from service import BlockchainService, ServiceClient, BUSY, load_test
+from sharedledger import SharedHashMapping, SharedLedger, LedgerReplica
+from stake import FenwickTree, StakeSelector
+from lightclient import FullNode, LightClient, Header, StateTree, verify_balance, merkle_levels
+from blockchain import retarget, _search_nonces, _target
+import network
+from network import Network, percentile
 
 class Test_Transaction(unittest.TestCase):
     '''Test cases to ensure Transaction is initilized and functions properly'''
@@ -146,6 +176,99 @@ class Test_Block(unittest.TestCase):
         self.assertNotEqual(hash(block1), hash(block4)) #blocks do not hold the same vals
         self.assertNotEqual(hash(block2), hash(block3)) #blocks do not hold the same vals
 
+    def test_block_hash_cache(self):
+        '''the cached block hash is recomputed when the block's transactions change'''
+        trans = Transaction('me', 'you', 100)
+        block = Block([trans])
+        before = hash(block)
+        self.assertEqual(hash(block), before)   #cached
+        trans.amount = 50
+        self.assertEqual(hash(block), hash(Block([Transaction('me', 'you', 50)])))
+        block.add_transaction(Transaction('you', 'me', 1))
+        self.assertEqual(hash(block), hash(Block([Transaction('me', 'you', 50), Transaction('you', 'me', 1)])))
+
+    def test_digest(self):
+        '''digests are SHA-256 and the same in every process (unlike hash(), which python salts per process)'''
+        trans = Transaction('me', 'you', 100)
+        self.assertEqual(len(trans.digest()), 32)
+        self.assertEqual(trans.digest(), Transaction('me', 'you', 100.0).digest())  #== transactions get the same digest
+        self.assertNotEqual(trans.digest(), Transaction('me', 'you', 101).digest())
+        self.assertNotEqual(trans.digest(), Transaction('you', 'me', 100).digest())
+        self.assertNotEqual(Transaction('ab', 'c', 1).digest(), Transaction('a', 'bc', 1).digest())  #fields are length prefixed
+
+        code = "from blockchain import *; print(Block([Transaction('me', 'you', 100), Transaction('a', 'b', 2.5)]).digest().hex())"
+        outputs = {subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                  env={'PYTHONHASHSEED': seed}, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+                   for seed in ('1', '2')}
+        self.assertEqual(outputs, {Block([trans, Transaction('a', 'b', 2.5)]).digest().hex() + '\n'})
+
+    def test_merkle_root(self):
+        '''the incremental Merkle root matches a tree built level by level, for every block size up to 33'''
+        def naive_root(leaves):
+            if not leaves: return sha256(b'').digest()
+            while len(leaves) > 1:
+                if len(leaves) % 2: leaves = leaves + [leaves[-1]]  #odd node is paired w itself
+                leaves = [sha256(b'\x01' + leaves[i] + leaves[i+1]).digest() for i in range(0, len(leaves), 2)]
+            return leaves[0]
+
+        block = Block()
+        for n in range(34):
+            with self.subTest(n=n):
+                self.assertEqual(block.digest(), naive_root([trans.digest() for trans in block]))
+                block.add_transaction(Transaction(f'user{n}', 'you', n))
+
+        #editing a transaction rebuilds the root
+        before = block.digest()
+        block._block[7].amount = 1234
+        self.assertNotEqual(block.digest(), before)
+        self.assertEqual(block.digest(), naive_root([trans.digest() for trans in block]))
+        self.assertEqual(hash(block), int.from_bytes(block.digest()[:8], 'big'))
+
+    def test_slots(self):
+        '''Transactions and Blocks have no per-instance __dict__'''
+        trans = Transaction('me', 'you', 1)
+        with self.assertRaises(AttributeError):
+            trans.note = 'typo'
+        self.assertFalse(hasattr(trans, '__dict__'))
+        self.assertFalse(hasattr(Block(), '__dict__'))
+        self.assertFalse(hasattr(ColumnarBlock(), '__dict__'))
+
+    def test_columnar_block(self):
+        '''a ColumnarBlock holds the same transactions as a Block, w the same __iter__, __eq__, digest and __hash__'''
+        txs = [Transaction('from_user', 'to_user', 999), Transaction('from_user', 'person2', 23), Transaction('person2', 'me', 0)]
+        block, columnar = Block(txs), ColumnarBlock(txs)
+        self.assertEqual(list(columnar), txs)
+        self.assertEqual(columnar._block, txs)
+        self.assertEqual(len(columnar), 3)
+        self.assertTrue(columnar == block)
+        self.assertTrue(block == columnar)
+        self.assertEqual(columnar.digest(), block.digest())
+        self.assertEqual(hash(columnar), hash(block))
+
+        #editing a yielded transaction does not change the block
+        next(iter(columnar)).amount = 5
+        self.assertEqual(columnar.digest(), block.digest())
+
+        #amounts column is widened when needed
+        columnar.add_transaction(Transaction('me', 'you', 2.5))
+        self.assertEqual(columnar._amounts.typecode, 'd')
+        columnar.add_transaction(Transaction('me', 'you', 2**80))
+        self.assertIsInstance(columnar._amounts, list)
+        block.add_transaction(Transaction('me', 'you', 2.5))
+        block.add_transaction(Transaction('me', 'you', 2**80))
+        self.assertEqual(list(columnar), list(block))
+        self.assertEqual(columnar.digest(), block.digest())
+
+    def test_columnar_block_in_chain(self):
+        '''ColumnarBlocks can be added to a Blockchain and mixed w regular Blocks'''
+        chain = Blockchain()
+        chain.distribute_mining_reward('bill')
+        self.assertTrue(chain.add_block(ColumnarBlock([Transaction('bill', 'jane', 100)])))
+        self.assertEqual(chain.add_blocks([ColumnarBlock([Transaction('jane', 'bob', 50)]), ColumnarBlock([Transaction('bob', 'x', 51)])]), [True, False])
+        self.assertTrue(chain.add_block(Block([Transaction('jane', 'bill', 50)])))
+        self.assertEqual(chain._bc_ledger._ledger_hashmap['bill'], 950)
+        self.assertEqual(chain.validate_chain(full=True), [])
+
 class Test_Ledger(unittest.TestCase):
     '''Tests to be sure ledger is initilized and stores values properly. tests the functions in the Ledger class'''
     
@@ -275,6 +398,1361 @@ class Test_Ledger(unittest.TestCase):
 
                 ledge.deposit('carl', i)
 
+class Test_HashMapping(unittest.TestCase):
+    '''Tests that both hash map engines (chained HashMapping and OpenHashMapping) behave the same'''
+
+    def test_set_get_contains(self):
+        '''adds, updates and reads back a bunch of keys in both engines, thru several resizes'''
+        for cls in (HashMapping, OpenHashMapping):
+            with self.subTest(cls=cls.__name__):
+                hmap = cls()
+                for i in range(1000):
+                    hmap[f'user{i}'] = i
+                for i in range(1000):
+                    hmap[f'user{i}'] += 1   #updates should not add new keys
+                self.assertEqual(len(hmap), 1000)
+                for i in range(1000):
+                    self.assertTrue(f'user{i}' in hmap)
+                    self.assertEqual(hmap[f'user{i}'], i+1)
+                self.assertFalse('DNE' in hmap)
+                self.assertFalse(hmap['DNE'])   #missing keys return False, same as the original HashMapping
+                self.assertIsNone(hmap.get('DNE'))
+                self.assertEqual(hmap.get('user5', 0), 6)
+
+    def test_delitem_and_iter(self):
+        '''deletes every other key and makes sure the rest can still be found and iterated over'''
+        for cls in (HashMapping, OpenHashMapping):
+            with self.subTest(cls=cls.__name__):
+                hmap = cls()
+                for i in range(500): hmap[i] = str(i)
+                for i in range(0, 500, 2): del hmap[i]
+                self.assertEqual(len(hmap), 250)
+                self.assertEqual(sorted(hmap), list(range(1, 500, 2)))
+                self.assertEqual(dict(hmap.items()), {i: str(i) for i in range(1, 500, 2)})
+                for i in range(500):
+                    self.assertEqual(i in hmap, i % 2 == 1)
+                with self.assertRaises(KeyError):
+                    del hmap[0]
+                hmap[0] = 'back'     #deleted keys can be added again
+                self.assertEqual(hmap[0], 'back')
+                self.assertEqual(len(hmap), 251)
+
+    def test_load_factor(self):
+        '''checks that load_factor controls when the table grows, and that bad load factors are rejected'''
+        hmap = HashMapping(load_factor=1)
+        for i in range(9): hmap[i] = i
+        self.assertEqual(hmap._num_buckets, 16)    #9 keys > 1*8 buckets
+        ohmap = OpenHashMapping(load_factor=0.5)
+        for i in range(5): ohmap[i] = i
+        self.assertEqual(len(ohmap._keys), 16)      #5 keys > 0.5*8 slots
+        with self.assertRaises(ValueError):
+            OpenHashMapping(load_factor=1.5)
+        with self.assertRaises(ValueError):
+            HashMapping(load_factor=0)
+
+    def test_incremental_rehash(self):
+        '''grows an incremental HashMapping thru several rehashes, reading, updating and deleting keys while old and 
+        new buckets are both in use, and checks it ends up the same as the default one'''
+        hmap, plain = HashMapping(incremental=True), HashMapping()
+        mid_rehash = 0
+        for i in range(5000):
+            hmap[i] = plain[i] = i
+            if hmap._old is not None:
+                mid_rehash += 1
+                self.assertEqual(hmap.get(i // 2), plain.get(i // 2))   #keys in both moved and unmoved buckets
+                hmap[i // 3] = plain[i // 3] = -i
+            if i % 7 == 0:
+                del hmap[i]
+                del plain[i]
+        self.assertTrue(mid_rehash > 0)
+        self.assertEqual(len(hmap), len(plain))
+        self.assertEqual(dict(hmap.items()), dict(plain.items()))
+        self.assertFalse(0 in hmap)
+        self.assertEqual(hmap.get(1), plain.get(1))
+        hmap._finish()
+        self.assertIsNone(hmap._old)
+        self.assertEqual(hmap._num_buckets, plain._num_buckets)
+        self.assertTrue(all(bucket is not None for bucket in hmap._L))
+
+        chain = Blockchain(lambda: HashMapping(incremental=True))
+        for user in ('bill', 'bob', 'jane'): chain.distribute_mining_reward(user)
+        self.assertTrue(chain.add_block(Block([Transaction('bill', 'jane', 100), Transaction('bob', 'kyle', 5)])))
+        self.assertEqual(chain._bc_ledger.balance('jane'), chain._bc_ledger.balance('bill') + 200)
+
+    def test_capacity_and_shrink(self):
+        '''checks that capacity pre-sizes the buckets so growing to it never rehashes, and that shrink gives the 
+        buckets back after deletes'''
+        hmap = HashMapping(capacity=100)
+        self.assertEqual(hmap._num_buckets, 64)     #100 keys > 2*32 buckets
+        for i in range(100): hmap[i] = i
+        self.assertEqual(hmap._num_buckets, 64)
+        self.assertEqual(HashMapping(capacity=0)._num_buckets, 8)
+        with self.assertRaises(ValueError):
+            HashMapping(capacity=-1)
+
+        for cls in (HashMapping, lambda: HashMapping(incremental=True)):
+            hmap = cls()
+            for i in range(1000): hmap[i] = i
+            for i in range(990): del hmap[i]
+            hmap.shrink()
+            self.assertEqual(hmap._num_buckets, 8)
+            self.assertIsNone(hmap._old)
+            self.assertEqual(dict(hmap.items()), {i: i for i in range(990, 1000)})
+            hmap.shrink()   #already as small as it gets
+            self.assertEqual(len(hmap._L), 8)
+
+    def test_open_ledger(self):
+        '''runs a small chain on the open addressing engine and compares balances w the default engine'''
+        chains = [Blockchain(), Blockchain(OpenHashMapping)]
+        for chain in chains:
+            for user in ('bill', 'bob', 'jane'): chain.distribute_mining_reward(user)
+            self.assertTrue(chain.add_block(Block([Transaction('bill', 'jane', 100), Transaction('bob', 'kyle', 5)])))
+            self.assertFalse(chain.add_block(Block([Transaction('kyle', 'jane', 100)])))
+        self.assertEqual(dict(chains[0]._bc_ledger._ledger_hashmap.items()), dict(chains[1]._bc_ledger._ledger_hashmap.items()))
+
+class Test_ChainLog(unittest.TestCase):
+    '''Tests that a Blockchain w a ChainLog can be reloaded from disk w the same blocks and balances'''
+
+    def setUp(self):
+        '''every test gets its own temp directory for the log'''
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def make_chain(self, log):
+        '''builds a small chain w a mix of accepted and rejected blocks'''
+        chain = Blockchain(log=log)
+        for user in ('bill', 'bob', 'jane', 'a'): chain.distribute_mining_reward(user)
+        chain.add_block(Block([Transaction('bill', 'jane', 100), Transaction('bob', 'kyle', 2.5)]))
+        chain.add_blocks([Block([Transaction('kyle', 'x', 1)]), Block([Transaction('x', 'y', 1)]), Block([Transaction('jane', 'bill', 1100)])])
+        return chain
+
+    def assert_same_chain(self, chain, other):
+        '''both chains have the same blocks, links and balances'''
+        self.assertEqual(other._blockchain, chain._blockchain)
+        self.assertEqual([b._previous_block_hash for b in other._blockchain], [b._previous_block_hash for b in chain._blockchain])
+        self.assertEqual(dict(other._bc_ledger.balances()), dict(chain._bc_ledger.balances()))
+        self.assertEqual(other.validate_chain(), [])
+
+    def test_replay(self):
+        '''a chain reloaded from its log matches the original, and new blocks can be appended after a restart'''
+        for fsync in ('block', 'batch', 'none'):
+            with self.subTest(fsync=fsync), tempfile.TemporaryDirectory() as directory:
+                with ChainLog(directory, fsync=fsync, segment_size=64) as log:     #tiny segments: roughly one block each
+                    chain = self.make_chain(log)
+                with ChainLog(directory) as log:
+                    reloaded = Blockchain(log=log)
+                    self.assert_same_chain(chain, reloaded)
+                    self.assertTrue(reloaded.add_block(Block([Transaction('a', 'b', 10)])))
+                with ChainLog(directory) as log:
+                    self.assertEqual(len(Blockchain(log=log)._blockchain), len(chain._blockchain) + 1)
+
+    def test_snapshots(self):
+        '''the ledger is rebuilt from the newest snapshot plus the blocks after it'''
+        with ChainLog(self.dir, snapshot_interval=4) as log:
+            chain = self.make_chain(log)
+            self.assertTrue(chain.add_block(Block([Transaction('y', 'bill', 1)])))
+            self.assertEqual(len(log._snapshots), 2)    #only the 2 newest snapshots are kept
+            self.assertEqual(log._snapshot_height, 9)   #snapshots are taken at commits: heights 5 and 9
+        with ChainLog(self.dir, block_cls=ColumnarBlock) as log:
+            reloaded = Blockchain(log=log)
+            self.assertIsInstance(reloaded._blockchain[1], ColumnarBlock)
+            self.assert_same_chain(chain, reloaded)
+
+    def test_repr_users(self):
+        '''users that are not strs or ints (written w their repr) come back from blocks and snapshots as they were'''
+        with ChainLog(self.dir, snapshot_interval=2) as log:
+            chain = Blockchain(log=log)
+            chain.add_block(Block([Transaction('ROOT', ('bill', 1), 100), Transaction('ROOT', None, 5)]))
+            chain.add_block(Block([Transaction(('bill', 1), (2.5, 'x'), 10)]))
+            self.assertEqual(log._snapshot_height, 2)   #the tuple and None accounts are in the snapshot
+        with ChainLog(self.dir) as log:
+            reloaded = Blockchain(log=log)
+            self.assert_same_chain(chain, reloaded)
+        self.assertEqual(dict(reloaded._bc_ledger.balances())[('bill', 1)], 90)
+        self.assertEqual(reloaded._blockchain[2][0].to_user, (2.5, 'x'))
+        with self.assertRaises(ValueError):
+            Transaction.decode(Transaction(object(), 'bob', 1).encode(), 0)
+
+    def test_partial_record(self):
+        '''a half written record at the end of the log (ie: a crash mid-write) is dropped'''
+        with ChainLog(self.dir) as log:
+            chain = self.make_chain(log)
+            segment = log._path(log._segments[-1])
+        with open(segment, 'ab') as f: f.write(b'\xff\x00\x00\x00partial')
+        with ChainLog(self.dir) as log:
+            self.assert_same_chain(chain, Blockchain(log=log))
+
+    def test_bad_fsync(self):
+        '''fsync has to be one of the known policies'''
+        with self.assertRaises(ValueError):
+            ChainLog(self.dir, fsync='sometimes')
+
+class Test_LedgerHistory(unittest.TestCase):
+    '''Tests historical balance queries and rollbacks against the balances recorded while the chain was built'''
+
+    def setUp(self):
+        '''builds a chain w LedgerHistory attached after the genesis block, saving the full ledger at every height'''
+        self.chain = Blockchain()
+        self.history = LedgerHistory(self.chain, interval=3)
+        self.expected = {1: dict(self.chain._bc_ledger.balances())}    #height -> every balance at that height
+
+        def save(): self.expected[len(self.chain._blockchain)] = dict(self.chain._bc_ledger.balances())
+        for user in ('bill', 'bob', 'jane'):
+            self.chain.distribute_mining_reward(user)
+            save()
+        for block in ([Transaction('bill', 'kyle', 100)], [Transaction('kyle', 'bob', 100)], [Transaction('bob', 'x', 1), Transaction('bob', 'y', 1)]):
+            self.chain.add_block(Block(block))
+            save()
+        self.chain.add_blocks([Block([Transaction('jane', 'z', 5)]), Block([Transaction('z', 'bill', 5)]), Block([Transaction('nobody', 'bill', 5)])])
+        save()  #add_blocks only updates the ledger at the end, so height 8 is filled in by test_balance_at
+
+    def test_balance_at(self):
+        '''every user's balance at every height matches what the ledger had'''
+        self.expected[8] = dict(self.expected[7], jane=995, z=5)
+        self.assertEqual(self.history.height, 9)
+        users = set().union(*self.expected.values())
+        for height, balances in self.expected.items():
+            with self.subTest(height=height):
+                self.assertEqual(self.history.balances_at(height), balances)
+                for user in users: self.assertEqual(self.history.balance_at(user, height), balances.get(user))
+        with self.assertRaises(ValueError):
+            self.history.balance_at('bill', 10)
+        with self.assertRaises(ValueError):
+            self.history.balance_at('bill', 0)     #before the history started
+
+    def test_rollback(self):
+        '''rolling back restores the ledger (removing accounts that did not exist yet) and drops the blocks'''
+        tip_blocks = list(self.chain._blockchain)
+        self.history.rollback(5)
+        self.assertEqual(len(self.chain._blockchain), 5)
+        self.assertEqual(dict(self.chain._bc_ledger.balances()), self.expected[5])
+        self.assertFalse('x' in self.chain._bc_ledger._ledger_hashmap)
+        self.assertEqual(self.chain.validate_chain(), [])
+
+        #the same blocks can be added again, and history keeps working
+        self.assertEqual(self.chain.add_blocks(tip_blocks[5:]), [True]*4)
+        self.assertEqual(dict(self.chain._bc_ledger.balances()), self.expected[9])
+        self.assertEqual(self.history.balances_at(7), self.expected[7])
+        self.history.rollback(1)
+        self.assertEqual(dict(self.chain._bc_ledger.balances()), {'ROOT': 999999})
+
+    def test_rollback_tells_listeners(self):
+        '''a rollback undoes blocks thru _unlink, so an index, a mempool and a stake selector all see it'''
+        index, pool, stakes = ChainIndex(self.chain), Mempool(self.chain), StakeSelector(self.chain)
+        self.history.rollback(1)
+        self.assertEqual(dict(self.chain._bc_ledger.balances()), {'ROOT': 999999})
+        self.assertEqual((len(stakes), stakes.total_stake), (0, 0))
+        with self.assertRaises(ValueError): stakes.proposer()   #nobody has an account, so nobody has stake
+        self.assertEqual(list(index.transactions('bill')), [])
+        self.assertEqual(index.locate(Transaction('ROOT', 'bill', 1000)), None)
+        self.assertEqual(pool.pending('ROOT'), 3000)    #the undone rewards are pending again; the rest can't be paid
+        self.assertEqual(len(pool.block_template(10)), 3)
+
+        self.chain.add_block(Block([Transaction('ROOT', 'amy', 50)]))
+        self.assertEqual(list(index.transactions('amy')), [(2, 0, Transaction('ROOT', 'amy', 50))])
+        self.assertEqual(stakes.proposer(), 'amy')
+        self.assertEqual(self.history.balance_at('amy', 2), 50)
+
+    def test_checkpoints_share_shards(self):
+        '''a checkpoint only copies the shards that changed since the previous one'''
+        self.assertEqual(sorted(self.history._checkpoints), [1, 4, 7])
+        first, second = self.history._checkpoints[1], self.history._checkpoints[4]
+        shared = sum(a is b for a, b in zip(first, second))
+        self.assertGreaterEqual(shared, len(first) - 4)     #blocks 2-4 touched ROOT, bill, bob and jane
+
+    def test_max_checkpoints(self):
+        '''old checkpoints and their change records are dropped once there are too many'''
+        chain = Blockchain()
+        history = LedgerHistory(chain, interval=2, max_checkpoints=2)
+        for i in range(10): chain.distribute_mining_reward(f'user{i}')
+        self.assertEqual(sorted(history._checkpoints), [9, 11])
+        self.assertEqual(len(history._changes), 2)
+        self.assertEqual(history.balance_at('user9', 11), 1000)
+        self.assertIsNone(history.balance_at('user9', 10))
+        with self.assertRaises(ValueError):
+            history.balance_at('user0', 8)
+
+class Test_ValidationPipeline(unittest.TestCase):
+    '''Tests that the 2 stage pipeline accepts the same blocks as add_blocks, minus malformed ones'''
+
+    def blocks(self):
+        '''a mix of valid blocks, blocks w malformed transactions, and blocks whose senders lack funds'''
+        bad_user = Transaction('bill', 'jane', 1)
+        bad_user.to_user = None
+        return ([Block([Transaction('ROOT', user, 1000)]) for user in ('bill', 'bob')]
+                + [Block([Transaction('bill', 'jane', 100)]), Block([Transaction('bob', 'jane', -5)]), Block([bad_user]),
+                   Block([Transaction('jane', 'kyle', float('inf'))]), Block([Transaction('kyle', 'x', 1)]),
+                   Block([Transaction('jane', 'kyle', 50), Transaction('bob', 'bill', 1.5)])])
+
+    def test_check_transaction(self):
+        '''stateless checks'''
+        self.assertTrue(check_transaction(('a', 'b', 0)))
+        self.assertTrue(check_transaction(('a', 'b', 2.5)))
+        self.assertFalse(check_transaction(('a', 'b', -1)))
+        self.assertFalse(check_transaction(('a', 'b', True)))
+        self.assertFalse(check_transaction(('', 'b', 1)))
+        self.assertFalse(check_transaction(('a', 7, 1)))
+        self.assertFalse(check_transaction(('a', 'b', float('nan'))))
+
+    def test_pipeline(self):
+        '''inline and pooled pipelines give the same results, and small batches keep the blocks in order'''
+        expected = [True, True, True, False, False, False, False, True]
+        for workers, batch_size in ((0, 64), (2, 3)):
+            with self.subTest(workers=workers):
+                chain = Blockchain()
+                with ValidationPipeline(chain, workers=workers, batch_size=batch_size) as pipeline:
+                    self.assertEqual(pipeline.add_blocks(self.blocks()), expected)
+                self.assertEqual(len(chain._blockchain), 5)
+                self.assertEqual(chain._bc_ledger._ledger_hashmap['kyle'], 50)
+                self.assertEqual(chain._bc_ledger._ledger_hashmap['bill'], 901.5)
+                self.assertEqual(chain.validate_chain(), [])
+
+class Test_Mining(unittest.TestCase):
+    '''Tests proof of work: mining, checking it in add_block/add_blocks, and retargeting'''
+
+    def test_mine_and_add(self):
+        '''mined blocks are accepted; unmined blocks or blocks mined on the wrong tip are not'''
+        chain = Blockchain(difficulty=8)
+        chain.distribute_mining_reward('bill')     #mined inline
+        self.assertEqual(len(chain._blockchain), 2)
+        self.assertTrue(chain._blockchain[1].pow_hash() < bytes([1]))   #8 leading zero bits
+
+        self.assertFalse(chain.add_block(Block([Transaction('bill', 'jane', 1)])))  #no proof of work
+        block = Block([Transaction('bill', 'jane', 1)])
+        stale = Block([Transaction('bill', 'bob', 1)])
+        chain.mine(block)
+        chain.mine(stale)
+        self.assertTrue(chain.add_block(block))
+        self.assertFalse(chain.add_block(stale))    #mined on top of the old tip
+        chain.mine(stale)
+        stale._nonce += 1   #almost certainly breaks the proof of work
+        self.assertEqual(chain.add_blocks([stale]), [stale.pow_hash() < bytes([1])])
+        self.assertEqual(chain.validate_chain(), [])
+
+    def test_rewrite_needs_later_work(self):
+        '''headers link by header hash, so rewriting a block and redoing only its own work (and the next block's)
+        still leaves the block after them pointing at the old header'''
+        chain = Blockchain(difficulty=6)
+        for user in ('bill', 'bob', 'jane', 'kyle', 'sam'): chain.distribute_mining_reward(user)
+        blocks = chain._blockchain
+        blocks[2]._block[0] = Transaction('ROOT', 'mallory', 1000)      #rewritten in place
+        for i in (2, 3):    #re-mines the rewritten block and the one after it
+            blocks[i]._rehash()
+            blocks[i]._prev_hash = blocks[i-1].pow_hash()
+            blocks[i]._nonce = _search_nonces(blocks[i].header_prefix(), _target(blocks[i]._difficulty), 0, 2**64)
+        self.assertEqual(chain.validate_chain(full=True), [blocks[4]])
+
+        blocks[5]._nonce += 1   #almost certainly breaks its proof of work
+        self.assertEqual(chain.validate_chain(full=True), [blocks[4]] + [blocks[5]] * (blocks[5].pow_hash() >= bytes([4])))
+
+    def test_miner_pool(self):
+        '''the multi process miner finds valid nonces and gives up once the nonce space is used up'''
+        chain = Blockchain(difficulty=10)
+        with Miner(workers=2, chunk=256) as miner:
+            for user in ('bill', 'bob'):
+                block = Block([Transaction('ROOT', user, 1000)])
+                chain.mine(block, miner)
+                self.assertTrue(chain.add_block(block))
+            self.assertGreater(miner.hashes, 0)
+            self.assertIsNone(miner.search(b'prefix', 64, stop=1000))  #2**-64 odds per nonce
+        self.assertEqual(chain._bc_ledger._ledger_hashmap['bob'], 1000)
+
+        class Unlucky():    #a miner that used up its nonce space
+            def search(self, prefix, difficulty): return None
+        block = Block([Transaction('bob', 'bill', 1)])
+        with self.assertRaises(RuntimeError): chain.mine(block, Unlucky())
+        self.assertEqual(block._nonce, 0)
+        self.assertFalse(chain.add_block(block))
+
+    def test_retarget(self):
+        '''difficulty moves by log2(expected/actual) bits, at most 2 bits at a time'''
+        self.assertEqual(retarget(10, 100, 100), 10)
+        self.assertEqual(retarget(10, 50, 100), 11)     #blocks came twice as fast: twice the work
+        self.assertEqual(retarget(10, 200, 100), 9)
+        self.assertEqual(retarget(10, 1, 100), 12)      #clamped
+        self.assertEqual(retarget(1, 1000, 1), 1)       #never below 1
+
+        chain = Blockchain(difficulty=4)
+        for i in range(2*chain._RETARGET_INTERVAL - 1): chain.distribute_mining_reward(f'user{i}')
+        self.assertEqual(chain._difficulty, 6)     #blocks 10-19 were mined in way under the target time (genesis has no timestamp)
+
+    def test_chainlog_keeps_pow(self):
+        '''nonce, timestamp and difficulty survive a restart, and so does the difficulty'''
+        with tempfile.TemporaryDirectory() as directory:
+            with ChainLog(directory) as log:
+                chain = Blockchain(log=log, difficulty=4)
+                for i in range(chain._RETARGET_INTERVAL): chain.distribute_mining_reward(f'user{i}')
+            with ChainLog(directory) as log:
+                reloaded = Blockchain(log=log, difficulty=4)
+            self.assertEqual(reloaded._difficulty, chain._difficulty)
+            for a, b in zip(chain._blockchain, reloaded._blockchain):
+                self.assertEqual((a._nonce, a._timestamp, a._difficulty), (b._nonce, b._timestamp, b._difficulty))
+                self.assertEqual(a.pow_hash(), b.pow_hash())
+
+class Test_Network(unittest.TestCase):
+    '''Tests that blocks and transactions reach every node of a simulated network, even w packet loss'''
+
+    def propagate(self, loss):
+        '''builds a small network, sends 3 blocks and a transaction from different nodes, returns the network'''
+        async def run():
+            net = Network(30, degree=4, latency=(0.001, 0.005), bandwidth=1e7, loss=loss, timeout=0.05, seed=3)
+            blocks = [Block([Transaction('ROOT', user, 1000)]) for user in ('bill', 'bob', 'jane')]
+            for i, block in enumerate(blocks):
+                self.assertTrue(net.nodes[i*7].submit_block(block))
+                self.assertEqual(await net.wait_for(block, timeout=10), 29)
+            net.nodes[5].submit_transaction(Transaction('bill', 'bob', 10))
+            await asyncio.sleep(0.5)
+            await net.close()
+            return net, blocks
+        return network.run(run())
+
+    def test_propagation(self):
+        '''every node ends up w the same chain and mempool, and each payload crosses a link at most once w no loss'''
+        for loss in (0.0, 0.1):
+            with self.subTest(loss=loss):
+                net, blocks = self.propagate(loss)
+                tip = net.nodes[0].chain._blockchain[-1].digest()
+                for node in net.nodes:
+                    self.assertEqual(len(node.chain._blockchain), 4)
+                    self.assertEqual(node.chain._blockchain[-1].digest(), tip)
+                    self.assertEqual(node.chain._bc_ledger._ledger_hashmap['jane'], 1000)
+                    self.assertEqual(len(node.mempool), 1)
+                stats = net.stats(blocks[0])
+                self.assertEqual(stats['reached'], 29)
+                self.assertTrue(0 < stats['p50'] <= stats['p90'] <= stats['p99'] <= stats['max'])
+                if loss == 0.0:
+                    links = sum(len(node.peers) for node in net.nodes) // 2
+                    payload = stats['bytes'] - 2 * links * 40   #minus an inv each way on every link
+                    self.assertLessEqual(payload, 29 * (40 + 100) + 29 * 40)    #29 getdata + block transfers
+
+    def test_rejected_block(self):
+        '''a fetched block the chain rejects is dropped: it is not asked for again, kept or passed on'''
+        async def run():
+            net = Network(10, degree=3, latency=(0.001, 0.005), bandwidth=1e7, timeout=0.05, seed=3)
+            bad = Block([Transaction('bill', 'bob', 5)])    #bill has no account
+            bad._prev_hash = net.nodes[0].chain._blockchain[-1].pow_hash()
+            block_id = network._block_id(bad)
+            net.nodes[0]._have(block_id, 'block', network._encode_block(bad), None)    #a peer that serves it anyway
+            await asyncio.sleep(0.5)
+            sent = net.bytes_sent[block_id]
+            await asyncio.sleep(0.5)
+            self.assertEqual(net.bytes_sent[block_id], sent)    #no getdata retries
+            await net.close()
+            return net, block_id
+        net, block_id = network.run(run())
+        for node in net.nodes[1:]:
+            self.assertNotIn(block_id, node._requested)
+            self.assertNotIn(block_id, node._payloads)
+            self.assertEqual(len(node.chain._blockchain), 1)
+        self.assertTrue(any(block_id in node._rejected for node in net.nodes))
+
+    def test_orphan_buffer(self):
+        '''orphans past max_orphans are dropped oldest first; a block that forks off below the tip is dropped w the
+        orphans waiting on it'''
+        def block(user, prev):
+            block = Block([Transaction('ROOT', user, 1)])
+            block._prev_hash = prev
+            return block
+        async def run():
+            net = Network(2, latency=(0.001, 0.005), max_orphans=3)
+            node = net.nodes[1]
+            def deliver(block):
+                net._origin[network._block_id(block)] = net.loop.time()
+                node._on_block(net.nodes[0], network._block_id(block), network._encode_block(block))
+            strays = [block(f'stray{i}', bytes([i + 1]) * 32) for i in range(5)]   #parents that never arrive
+            for stray in strays: deliver(stray)
+            ids = [network._block_id(stray) for stray in strays]
+            self.assertEqual(list(node._orphan_prev), ids[2:])
+            self.assertNotIn(ids[0], node._payloads)
+            self.assertEqual(sum(len(waiting) for waiting in node._orphans.values()), 3)
+
+            genesis = node.chain._blockchain[0].pow_hash()
+            main, fork = block('bill', genesis), block('bob', genesis)
+            child = block('jane', fork.pow_hash())
+            deliver(child)      #waits for fork
+            deliver(main)
+            deliver(fork)       #same parent as main: now below the tip
+            self.assertEqual(node.chain._blockchain[1:], [main])
+            for dropped in (fork, child):
+                self.assertIn(network._block_id(dropped), node._rejected)
+                self.assertNotIn(network._block_id(dropped), node._payloads)
+            self.assertEqual(list(node._orphan_prev), ids[3:])     #child pushed out the oldest stray while it waited
+            await net.close()
+        network.run(run())
+
+    def test_percentile(self):
+        '''nearest rank percentiles'''
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 100), 4)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+
+class Test_Mempool(unittest.TestCase):
+    '''Tests that the mempool only admits fundable transactions and that its block templates are always accepted'''
+
+    def setUp(self):
+        '''a chain where bill and bob have 100 COIN each, and an empty pool'''
+        self.chain = Blockchain()
+        for user in ('bill', 'bob'): self.chain.add_block(Block([Transaction('ROOT', user, 100)]))
+        self.pool = Mempool(self.chain)
+
+    def test_admission(self):
+        '''a sender's pending transactions can never add up to more than their balance'''
+        self.assertTrue(self.pool.add(Transaction('bill', 'jane', 60)))
+        self.assertFalse(self.pool.add(Transaction('bill', 'jane', 50)))    #60 + 50 > 100
+        self.assertTrue(self.pool.add(Transaction('bill', 'kyle', 40)))
+        self.assertFalse(self.pool.add(Transaction('jane', 'kyle', 1)))     #no account yet
+        self.assertFalse(self.pool.add(Transaction('bob', 'kyle', -1)))     #malformed
+        self.assertEqual(self.pool.pending('bill'), 100)
+        self.assertEqual(len(self.pool), 2)
+        self.assertTrue(self.pool.remove(Transaction('bill', 'jane', 60)))
+        self.assertFalse(self.pool.remove(Transaction('bill', 'jane', 60)))
+        self.assertEqual(self.pool.pending('bill'), 40)
+
+    def test_block_template(self):
+        '''templates take the highest priority transactions first (oldest first on ties) and are always accepted'''
+        self.pool.add(Transaction('bill', 'jane', 10), priority=1)
+        self.pool.add(Transaction('bob', 'jane', 10), priority=5)
+        self.pool.add(Transaction('bill', 'kyle', 10), priority=1)
+        self.pool.add(Transaction('bob', 'kyle', 90), priority=0)
+        block = self.pool.block_template(3)
+        self.assertEqual([(t.from_user, t.to_user) for t in block], [('bob', 'jane'), ('bill', 'jane'), ('bill', 'kyle')])
+        self.assertEqual(len(self.pool), 4)     #still pending until the block is added
+        self.assertTrue(self.chain.add_block(block))
+        self.assertEqual(len(self.pool), 1)
+        block = self.pool.block_template(10)
+        self.assertEqual(len(block), 1)
+        self.assertTrue(self.chain.add_block(block))
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(self.chain._bc_ledger._ledger_hashmap['bob'], 0)
+
+    def test_template_skips_missing_account(self):
+        '''a sender whose account was removed w/o telling the pool is left out of the template'''
+        self.pool.add(Transaction('bill', 'jane', 10), priority=2)
+        self.pool.add(Transaction('bob', 'jane', 10), priority=1)
+        self.chain._bc_ledger.remove('bill')
+        self.assertEqual([t.from_user for t in self.pool.block_template(10)], ['bob'])
+        self.assertEqual(len(self.pool), 2)
+
+    def test_outside_spend_evicts(self):
+        '''a block from elsewhere that spends a sender's balance drops their lowest priority transactions'''
+        self.pool.add(Transaction('bill', 'jane', 30), priority=3)
+        self.pool.add(Transaction('bill', 'jane', 30), priority=1)
+        self.pool.add(Transaction('bill', 'kyle', 30), priority=2)
+        self.assertTrue(self.chain.add_block(Block([Transaction('bill', 'bob', 50)])))
+        self.assertEqual(self.pool.pending('bill'), 30)
+        self.assertEqual(self.pool.block_template(10)._block[0].to_user, 'jane')    #the priority 3 one survives
+        self.assertEqual(self.chain.add_blocks([self.pool.block_template(10)]), [True])
+        self.assertEqual(len(self.pool), 0)
+
+    def test_reorg_keeps_priority(self):
+        '''an undone block's transactions come back at the priority they had, and pooled spends of money the undone
+        block paid out are dropped'''
+        tree = BlockTree(self.chain)
+        self.pool.add(Transaction('bill', 'jane', 10), priority=7)
+        self.pool.add(Transaction('bob', 'jane', 10), priority=5)
+        self.assertTrue(tree.add(self.pool.block_template(1)))
+        self.pool.add(Transaction('bill', 'kyle', 90), priority=1)
+        self.assertTrue(self.pool.add(Transaction('jane', 'kyle', 10), priority=9))
+        parent = self.chain._blockchain[-2]
+        for user in ('x', 'y'):     #a heavier branch w/o bill -> jane
+            block = Block([Transaction('ROOT', user, 10)])
+            block._prev_hash = parent.pow_hash()
+            tree.add(block)
+            parent = block
+        self.assertEqual(self.chain._blockchain[-1], parent)
+        self.assertEqual(self.pool.pending('jane'), 0)      #jane's account is gone
+        self.assertEqual(self.pool.pending('bill'), 100)
+        block = self.pool.block_template(3)
+        self.assertEqual([(t.from_user, t.to_user) for t in block], [('bill', 'jane'), ('bob', 'jane'), ('bill', 'kyle')])
+        self.assertTrue(self.chain.add_block(block))
+
+class Test_BlockTree(unittest.TestCase):
+    '''Tests that forks are kept, the heaviest branch wins, and reorgs leave the same ledger as building that branch'''
+
+    def branch(self, parent, users, amount=10):
+        '''blocks (ROOT -> user) built on top of parent, one per user'''
+        blocks = []
+        for user in users:
+            block = Block([Transaction('ROOT', user, amount)])
+            block._prev_hash = parent.pow_hash()
+            blocks.append(block)
+            parent = block
+        return blocks
+
+    def balances(self, chain):
+        '''every balance in chain's ledger'''
+        return dict(chain._bc_ledger.balances())
+
+    def test_reorg(self):
+        '''a longer branch takes over from the common ancestor; the ledger matches a chain built on it directly'''
+        chain = Blockchain()
+        tree = BlockTree(chain)
+        genesis = chain._blockchain[0]
+        main = self.branch(genesis, ['bill', 'bob', 'jane'])
+        for block in main: self.assertTrue(tree.add(block))
+        side = self.branch(main[0], ['kyle', 'x', 'y'])
+        self.assertFalse(tree.add(side[0]))
+        self.assertFalse(tree.add(side[1]))     #same work as main: first seen wins
+        self.assertEqual(chain._blockchain[-1], main[2])
+        self.assertTrue(tree.add(side[2]))      #heavier now: undo bob, jane; apply kyle, x, y
+        self.assertEqual([b for b in chain._blockchain[1:]], [main[0]] + side)
+        self.assertEqual(chain.validate_chain(), [])
+        self.assertEqual(len(tree), 7)
+
+        expected = Blockchain()
+        for user in ('bill', 'kyle', 'x', 'y'): expected.add_block(Block([Transaction('ROOT', user, 10)]))
+        self.assertEqual(self.balances(chain), self.balances(expected))
+        self.assertNotIn('bob', self.balances(chain))   #created on the undone branch only
+
+        back = self.branch(main[2], ['z', 'w'])     #the old branch comes back heavier
+        for block in back: tree.add(block)
+        self.assertEqual(chain._blockchain[1:], main + back)
+        self.assertEqual(self.balances(chain)['bob'], 10)
+
+    def test_orphans_and_invalid(self):
+        '''blocks that arrive before their parent wait for it; a heavier branch w an overspend is not switched to'''
+        chain = Blockchain()
+        tree = BlockTree(chain)
+        blocks = self.branch(chain._blockchain[0], ['bill', 'bob', 'jane'])
+        self.assertFalse(tree.add(blocks[2]))
+        self.assertFalse(tree.add(blocks[1]))
+        self.assertEqual(tree.orphans(), 2)
+        self.assertTrue(tree.add(blocks[0]))
+        self.assertEqual(tree.orphans(), 0)
+        self.assertEqual(chain._blockchain[1:], blocks)
+
+        bad = self.branch(blocks[0], ['kyle', 'x', 'y'])
+        bad[1] = Block([Transaction('kyle', 'x', 1000)])    #kyle only has 10
+        bad[1]._prev_hash = bad[0].pow_hash()
+        bad[2]._prev_hash = bad[1].pow_hash()
+        for block in bad: self.assertFalse(tree.add(block))
+        self.assertEqual(chain._blockchain[1:], blocks)
+        self.assertEqual(self.balances(chain)['jane'], 10)
+        self.assertNotIn('kyle', self.balances(chain))
+        self.assertFalse(tree.add(self.branch(bad[2], ['z'])[0]))   #builds on an invalid block
+
+    def test_same_transactions(self):
+        '''blocks w the same transactions (same digest) are told apart by their header hash, so a fork goes under the
+        parent it names'''
+        chain = Blockchain()
+        tree = BlockTree(chain)
+        main = self.branch(chain._blockchain[0], ['alice', 'alice'])
+        for block in main: self.assertTrue(tree.add(block))
+        self.assertEqual(main[0].digest(), main[1].digest())
+        fork = self.branch(main[0], ['bob', 'kyle'])
+        self.assertFalse(tree.add(fork[0]))     #same work as main[1]
+        self.assertTrue(tree.add(fork[1]))
+        self.assertEqual(chain._blockchain[1:], [main[0]] + fork)
+        self.assertEqual(self.balances(chain)['alice'], 10)
+        self.assertEqual(chain.validate_chain(), [])
+
+    def test_listeners_follow_reorg(self):
+        '''LedgerHistory and Mempool see undone blocks thru block_removed'''
+        chain = Blockchain()
+        tree = BlockTree(chain)
+        history = LedgerHistory(chain, interval=2)
+        pool = Mempool(chain)
+        main = self.branch(chain._blockchain[0], ['bill', 'bob'])
+        for block in main: tree.add(block)
+        pool.add(Transaction('bill', 'jane', 5))
+        included = Block([Transaction('bill', 'jane', 5)])
+        included._prev_hash = main[1].pow_hash()
+        tree.add(included)
+        self.assertEqual(len(pool), 0)
+        for block in self.branch(main[0], ['x', 'y', 'z']): tree.add(block)
+        self.assertEqual(history.height, 5)
+        self.assertIsNone(history.balance_at('bob', 5))
+        self.assertEqual(history.balance_at('z', 5), 10)
+        self.assertEqual(history.balance_at('bill', 5), 10)
+        self.assertEqual(pool.pending('bill'), 5)   #back in the pool, since bill can still pay for it
+        self.assertEqual(pool.pending('ROOT'), 10)  #so is the undone ROOT -> bob
+
+class Test_ChainIndex(unittest.TestCase):
+    '''Tests index lookups against a scan of every block'''
+
+    def setUp(self):
+        '''a chain w a few blocks before the index is made and more after'''
+        self.chain = Blockchain()
+        self.tree = BlockTree(self.chain)
+        for user in ('bill', 'bob'): self.chain.add_block(Block([Transaction('ROOT', user, 100)]))
+        self.index = ChainIndex(self.chain)
+        self.chain.add_block(Block([Transaction('bill', 'jane', 10), Transaction('bob', 'bob', 1)]))
+        self.chain.add_blocks([Block([Transaction('jane', 'bill', 1)]), Block([Transaction('bill', 'jane', 10)])])
+
+    def scan(self, user):
+        '''(height, position) of every transaction involving user, found the slow way'''
+        return [(h, p) for h, block in enumerate(self.chain._blockchain, 1) for p, t in enumerate(block)
+                if user in (t.from_user, t.to_user)]
+
+    def test_user_history(self):
+        '''same locations as a scan, w paging, newest first and height ranges'''
+        for user in ('ROOT', 'bill', 'bob', 'jane', 'nobody'):
+            self.assertEqual([(h, p) for h, p, t in self.index.transactions(user)], self.scan(user))
+            self.assertEqual(self.index.count(user), len(self.scan(user)))
+        bill = self.scan('bill')
+        self.assertEqual([(h, p) for h, p, t in self.index.transactions('bill', start=1, limit=2)], bill[1:3])
+        self.assertEqual([(h, p) for h, p, t in self.index.transactions('bill', limit=2, newest_first=True)], bill[::-1][:2])
+        self.assertEqual([(h, p) for h, p, t in self.index.transactions('bill', min_height=4, max_height=5)], [(4, 0), (5, 0)])
+        self.assertEqual(list(self.index.transactions('bill', start=10)), [])
+        h, p, t = next(self.index.transactions('jane', newest_first=True))
+        self.assertEqual((t.from_user, t.to_user, t.amount), ('bill', 'jane', 10))
+
+    def test_locate(self):
+        '''finds a transaction by value or digest; a repeated transfer is found at its first location'''
+        self.assertEqual(self.index.locate(Transaction('jane', 'bill', 1)), (5, 0))
+        self.assertEqual(self.index.locate(Transaction('bob', 'bob', 1).digest()), (4, 1))
+        self.assertEqual(self.index.locate(Transaction('bill', 'jane', 10)), (4, 0))
+        self.assertIsNone(self.index.locate(Transaction('bill', 'jane', 11)))
+
+    def test_follows_reorg(self):
+        '''undone blocks leave the index'''
+        tree = self.tree
+        parent = self.chain._blockchain[3]
+        for user in ('kyle', 'x', 'y'):     #one block longer than the main branch after the fork
+            block = Block([Transaction('ROOT', user, 5)])
+            block._prev_hash = parent.pow_hash()
+            tree.add(block)
+            parent = block
+        self.assertEqual(self.index.locate(Transaction('jane', 'bill', 1)), None)
+        self.assertEqual(self.index.locate(Transaction('ROOT', 'x', 5)), (6, 0))
+        self.assertEqual([(h, p) for h, p, t in self.index.transactions('bill')], self.scan('bill'))
+
+class Test_Export(unittest.TestCase):
+    '''Tests the streaming iterators and that every exporter writes back the same rows'''
+
+    def setUp(self):
+        '''a chain w int, float and unicode values'''
+        self.chain = Blockchain()
+        self.chain.add_block(Block([Transaction('ROOT', 'bill', 100), Transaction('ROOT', 'zoë', 50.5)]))
+        self.chain.add_block(Block([Transaction('bill', 'zoë', 7), Transaction('zoë', 'bob, jr', 0.25)]))
+        self.rows = [(h, p, (t.from_user, t.to_user, t.amount)) for h, p, t in self.chain.iter_transactions()]
+
+    def test_iterators(self):
+        '''height ranges and filters'''
+        self.assertEqual([h for h, block in self.chain.iter_blocks(2)], [2, 3])
+        self.assertEqual([h for h, block in self.chain.iter_blocks(0, 2)], [1, 2])
+        self.assertEqual(len(self.rows), 5)
+        self.assertEqual([(h, p) for h, p, t in self.chain.iter_transactions(user='zoë')], [(2, 1), (3, 0), (3, 1)])
+        self.assertEqual([(h, p) for h, p, t in self.chain.iter_transactions(2, 2, min_amount=60)], [(2, 0)])
+        self.assertEqual([t.amount for h, p, t in self.chain.iter_transactions(3, max_amount=1)], [0.25])
+
+    def test_round_trips(self):
+        '''CSV, JSON Lines and binary (read back in tiny chunks) give back the same rows'''
+        out = io.StringIO()
+        self.assertEqual(export_csv(self.chain.iter_transactions(), out, chunk_size=10), len(out.getvalue()))
+        lines = list(csv.reader(io.StringIO(out.getvalue())))[1:]
+        self.assertEqual([(int(h), int(p), (f, t, float(a))) for h, p, f, t, a in lines], self.rows)
+
+        out = io.StringIO()
+        export_jsonl(self.chain.iter_transactions(), out, chunk_size=10)
+        objs = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(o['height'], o['position'], (o['from'], o['to'], o['amount'])) for o in objs], self.rows)
+
+        out = io.BytesIO()
+        self.assertEqual(export_binary(self.chain.iter_transactions(), out, chunk_size=10), len(out.getvalue()))
+        out.seek(0)
+        self.assertEqual([(h, p, (t.from_user, t.to_user, t.amount)) for h, p, t in read_binary(out, chunk_size=3)], self.rows)
+        with self.assertRaises(ValueError): list(read_binary(io.BytesIO(out.getvalue()[:-1])))
+
+class Test_Replay(unittest.TestCase):
+    '''Tests bulk replay (w NumPy when it is installed, and w the fallback loop) against the chain's own ledger'''
+
+    def engines(self):
+        '''yields once per replay engine, w replay.np set accordingly'''
+        np = replay.np
+        try:
+            for engine in ([np] if np is not None else []) + [None]:
+                replay.np = engine
+                with self.subTest(numpy=engine is not None): yield
+        finally:
+            replay.np = np
+
+    def chain(self, amounts):
+        '''a chain of random transfers w amounts from amounts, in Blocks and ColumnarBlocks'''
+        rng = random.Random(9)
+        chain = Blockchain()
+        users = [f'user{i}' for i in range(30)]
+        chain.add_block(Block([Transaction('ROOT', user, 100) for user in users]))
+        for i in range(100):
+            cls = Block if i % 2 else ColumnarBlock
+            chain.add_block(cls([Transaction(rng.choice(users), rng.choice(users), rng.choice(amounts)) for j in range(5)]))
+        return chain
+
+    def test_replay_matches_ledger(self):
+        '''same balances as the ledger bit for bit, for int and float amounts, from genesis and from a midpoint'''
+        for amounts in ([1, 5, 20], [0.1, 2.5, 7]):
+            chain = self.chain(amounts)
+            expected = dict(chain._bc_ledger.balances())
+            for _ in self.engines():
+                self.assertEqual(replay.replay_balances(chain), expected)
+                self.assertEqual(replay.audit_supply(chain)[1:], (999999, True))
+                middle = replay.replay_balances(chain, stop=50)
+                self.assertEqual(replay.replay_balances(chain, start=51, balances=middle), expected)
+
+    def test_replay_from_history(self):
+        '''starting balances from LedgerHistory can name users the replayed blocks never touch, and who were never
+        interned before: they still get their own ids, not the mint's'''
+        chain = Blockchain()
+        history = LedgerHistory(chain, interval=4)
+        users = [f'replay_start{i}' for i in range(5)]     #only in the blocks before the replay starts
+        for user in users: chain.add_block(Block([Transaction('ROOT', user, 10)]))
+        for i in range(6): chain.add_block(Block([Transaction('ROOT', 'bill', 1), Transaction(users[0], 'bob', 2)]))
+        n = len(users) + 2
+        expected = dict(chain._bc_ledger.balances())
+        for _ in self.engines():
+            self.assertEqual(replay.replay_balances(chain, start=n, balances=history.balances_at(n - 1)), expected)
+            self.assertIsNone(replay.first_overdraft(chain, start=n, balances=history.balances_at(n - 1)))
+
+    def test_first_overdraft(self):
+        '''2 spends in one block can each pass has_funds and still overdraw the sender'''
+        chain = self.chain([1, 2])
+        for _ in self.engines(): self.assertIsNone(replay.first_overdraft(chain))
+        chain.add_block(Block([Transaction('ROOT', 'bill', 10)]))
+        chain.add_block(Block([Transaction('bill', 'bob', 1), Transaction('bill', 'jane', 6), Transaction('bill', 'kyle', 6)]))
+        height = len(chain._blockchain)
+        for _ in self.engines():
+            self.assertEqual(replay.first_overdraft(chain), (height, 2))
+            self.assertIsNone(replay.first_overdraft(chain, stop=height - 1))
+            self.assertEqual(replay.first_overdraft(chain, start=height, balances={'bill': 10}), (height, 2))
+
+    def test_negative_amounts(self):
+        '''both engines only flag senders: a recipient a negative amount drives below 0 is flagged when they send'''
+        chain = Blockchain()
+        chain.add_block(Block([Transaction('ROOT', 'bill', 10)]))
+        chain.add_block(Block([Transaction('bill', 'bob', -20)]))
+        for _ in self.engines(): self.assertIsNone(replay.first_overdraft(chain))     #bob is at -20, but sent nothing
+        chain.add_block(Block([Transaction('ROOT', 'bob', 30)]))
+        chain.add_block(Block([Transaction('bill', 'bob', -20), Transaction('bob', 'jane', 1)]))
+        height = len(chain._blockchain)
+        for _ in self.engines():
+            self.assertEqual(replay.first_overdraft(chain), (height, 1))
+            self.assertEqual(replay.replay_balances(chain), dict(chain._bc_ledger.balances()))
+
+    def test_int64_overflow(self):
+        '''int amounts whose sums could pass int64 are replayed by the loop, w Python's unbounded ints'''
+        chain = Blockchain()
+        chain.add_block(Block([Transaction('ROOT', 'bill', 10)]))
+        chain.add_block(Block([Transaction('bill', 'bob', -2**62), Transaction('bill', 'bob', -2**62)]))
+        chain.add_block(Block([Transaction('bill', 'jane', 2**62), Transaction('bill', 'jane', 2**62),
+                               Transaction('bill', 'kyle', 11)]))
+        expected = dict(chain._bc_ledger.balances())
+        self.assertEqual((expected['bob'], expected['bill']), (-2**63, -1))
+        for _ in self.engines():
+            self.assertEqual(replay.replay_balances(chain), expected)
+            self.assertEqual(replay.first_overdraft(chain), (4, 2))    #bill's 10 + 2**63 would wrap around in int64
+
+class Test_Metrics(unittest.TestCase):
+    '''Tests that profiling counts operations and rehashes, and leaves nothing wrapped once it is off'''
+
+    def test_profile(self):
+        '''counts, rehash events, dict and Prometheus output; the original methods come back afterwards'''
+        original = Blockchain.__dict__['add_block'], HashMapping.__dict__['_rehash']
+        with profile() as metrics:
+            self.assertIsNot(Blockchain.__dict__['add_block'], original[0])
+            with self.assertRaises(ValueError): Metrics().enable()  #one at a time
+            chain = Blockchain()
+            for i in range(20): chain.add_block(Block([Transaction('ROOT', f'user{i}', 1)]))
+            chain.add_blocks([Block([Transaction('user0', 'user1', 1)])])
+            chain.validate_chain()
+        self.assertEqual((Blockchain.__dict__['add_block'], HashMapping.__dict__['_rehash']), original)
+        chain.add_block(Block([Transaction('ROOT', 'x', 1)]))     #not counted
+
+        stats = metrics.as_dict()
+        ops = stats['operations']
+        self.assertEqual(ops['add_block']['count'], 20)
+        self.assertEqual(ops['add_blocks']['count'], 1)
+        self.assertEqual(ops['validate_chain']['count'], 1)
+        self.assertEqual(ops['ledger_apply']['count'], 20)
+        self.assertEqual(ops['ledger_deposit']['count'], 21)    #genesis + 20 blocks
+        self.assertLessEqual(ops['add_block']['min'], ops['add_block']['p50'])
+        self.assertLessEqual(ops['add_block']['p50'], ops['add_block']['max'])
+        events = stats['rehashes']['events']
+        self.assertEqual([(e['old_buckets'], e['new_buckets']) for e in events], [(8, 16)])    #17 accounts
+        self.assertEqual(stats['rehashes']['count'], 1)
+
+        text = metrics.prometheus()
+        self.assertIn('blockchain_operation_seconds_count{op="add_block"} 20', text)
+        self.assertIn('blockchain_operation_seconds_bucket{op="add_block",le="+Inf"} 20', text)
+        self.assertIn('blockchain_rehash_total 1', text)
+        self.assertIn('blockchain_rehash_last_buckets 16', text)
+
+class Test_Codec(unittest.TestCase):
+    '''Tests the binary codec round trips and the lazy BlockView'''
+
+    def setUp(self):
+        '''a mined block w repeated users, negative, float and huge amounts'''
+        self.chain = Blockchain(difficulty=4)
+        self.chain.distribute_mining_reward('bill')
+        self.block = Block([Transaction('bill', 'jane', 10), Transaction('jane', 'bill', -3), Transaction('bill', 'bob', 2.5),
+                            Transaction(7, 'jane', 10**30), Transaction('bill', 'jane', 10)])
+        self.chain.mine(self.block)
+
+    def test_round_trip(self):
+        '''blocks and transactions come back equal, w the same digest and header hash, as Block or ColumnarBlock'''
+        data = encode_block(self.block)
+        self.assertEqual(data[0], VERSION)
+        for block_cls in (Block, ColumnarBlock):
+            block = decode_block(data, block_cls, verify=True)
+            self.assertIsInstance(block, block_cls)
+            self.assertEqual(block, self.block)
+            self.assertEqual(block.digest(), self.block.digest())
+            self.assertEqual(block.pow_hash(), self.block.pow_hash())
+        genesis = decode_block(encode_block(self.chain._blockchain[0]))
+        self.assertIsNone(genesis._previous_block_hash)
+        self.assertEqual(len(decode_block(encode_block(Block()))), 0)
+        for trans in self.block:
+            self.assertEqual(decode_transaction(encode_transaction(trans)), trans)
+        self.assertEqual(type(decode_transaction(encode_transaction(Transaction('a', 'b', 2.0)))).__name__, 'Transaction')
+        self.assertIsInstance(decode_transaction(encode_transaction(Transaction('a', 'b', 2.0))).amount, float)
+
+    def test_lazy_view(self):
+        '''header fields and pow_hash straight from a memoryview, then transactions on demand'''
+        view = BlockView(memoryview(bytearray(encode_block(self.block))))
+        self.assertIsNone(view._users)      #nothing past the header decoded yet
+        self.assertEqual(view.pow_hash(), self.block.pow_hash())
+        self.assertEqual(view.header_prefix(), self.block.header_prefix())
+        self.assertEqual(view.previous_block_hash, self.block._previous_block_hash)
+        self.assertEqual(view.merkle_root, self.block.digest())
+        self.assertEqual((view.nonce, view.timestamp, view.difficulty),
+                         (self.block._nonce, self.block._timestamp, self.block._difficulty))
+        self.assertIsNone(view._users)
+        self.assertEqual(len(view), 5)
+        self.assertEqual(view[3], Transaction(7, 'jane', 10**30))
+        self.assertEqual(view[-1], self.block[4])
+        with self.assertRaises(IndexError):
+            view[5]
+        self.assertEqual(view.users(), ['bill', 'jane', 'bob', 7])
+        self.assertEqual(list(view), list(self.block))
+        self.assertTrue(view.verify())
+        valid = Block([Transaction('bill', 'jane', 10)])
+        self.chain.mine(valid)
+        self.assertTrue(self.chain.add_block(BlockView(encode_block(valid)).to_block()))   #a block off the wire
+
+    def test_bad_input(self):
+        '''other versions, truncated blocks and tampered transactions are rejected'''
+        data = encode_block(self.block)
+        with self.assertRaises(ValueError):
+            BlockView(bytes([VERSION + 1]) + data[1:])
+        with self.assertRaises(ValueError):
+            BlockView(data[:-1])
+        with self.assertRaises(ValueError):
+            BlockView(b'')
+        tampered = bytearray(data)
+        tampered[-1] ^= 0x02    #changes the last amount
+        self.assertFalse(BlockView(tampered).verify())
+        with self.assertRaises(ValueError):
+            decode_block(tampered, verify=True)
+
+class Test_Workload(unittest.TestCase):
+    '''Tests the workload generator and the benchmark suite on tiny workloads'''
+
+    def test_deterministic(self):
+        '''the same parameters make the same blocks, another seed makes different ones'''
+        def digests(workload): return [block.digest() for block, valid in workload.blocks()]
+        params = dict(num_accounts=50, txs_per_block=20, num_blocks=30, skew=1.2, invalid_fraction=0.01, seed=7)
+        self.assertEqual(digests(Workload(**params)), digests(Workload(**params)))
+        self.assertNotEqual(digests(Workload(**params)), digests(Workload(**dict(params, seed=8))))
+        self.assertEqual(Workload(**params).params(), dict(params, max_amount=10))
+        with self.assertRaises(ValueError):
+            Workload(num_accounts=0)
+        with self.assertRaises(ValueError):
+            Workload(invalid_fraction=1.5)
+
+    def test_expected_validity(self):
+        '''the chain accepts exactly the blocks the generator says it will, in default and strict mode, and the hot 
+        senders send most of the transactions'''
+        workload = Workload(num_accounts=30, txs_per_block=10, num_blocks=60, skew=1.5, invalid_fraction=0.02, seed=1)
+        for strict in (False, True):
+            chain = Blockchain(strict=strict)
+            for block in workload.funding(): self.assertTrue(chain.add_block(block))
+            results = [(chain.add_block(block), valid) for block, valid in workload.blocks()]
+            self.assertEqual([ok for ok, valid in results], [valid for ok, valid in results])
+            self.assertTrue(0 < sum(valid for ok, valid in results) < 60)
+        senders = [t.from_user for block, valid in workload.blocks() for t in block]
+        self.assertTrue(senders.count('user0') > senders.count('user29') * 5)
+
+    def test_suite_and_compare(self):
+        '''run_suite results are JSON-able and cover every operation; compare flags a slower run and refuses to 
+        compare different workloads'''
+        workload = Workload(num_accounts=40, txs_per_block=5, num_blocks=20, invalid_fraction=0.05, seed=2)
+        results = json.loads(json.dumps(run_suite(workload, rewards=5)))
+        self.assertEqual(set(results['operations']), {'add_block', 'validate_chain', 'distribute_mining_reward',
+                                                      'hashmap_insert', 'hashmap_lookup'})
+        add = results['operations']['add_block']
+        self.assertEqual(add['accepted'] + add['rejected'], 20)
+        self.assertTrue(add['p50'] <= add['p99'] <= add['max'])
+        self.assertTrue(results['peak_memory']['chain'] > 0)
+        self.assertEqual(results['fingerprint'], run_suite(workload, rewards=5, memory=False)['fingerprint'])
+
+        self.assertEqual(compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['operations']['add_block']['per_second'] /= 2
+        slower['peak_memory']['chain'] *= 3
+        self.assertEqual([(op, metric) for op, metric, a, b, change in compare(results, slower)],
+                         [('add_block', 'per_second'), ('chain', 'peak_memory')])
+        self.assertEqual(compare(results, slower, threshold=5), [])
+        other = run_suite(Workload(num_accounts=40, txs_per_block=5, num_blocks=20, seed=3), rewards=5, memory=False)
+        with self.assertRaises(ValueError):
+            compare(results, other)
+
+class Test_LightClient(unittest.TestCase):
+    '''Tests transaction and balance proofs served by a FullNode and checked by a LightClient'''
+
+    def setUp(self):
+        '''a chain w blocks of 1 to 7 transactions, half of it made before the full node, and a synced light client'''
+        self.chain = Blockchain(difficulty=2)
+        self.tree = BlockTree(self.chain)
+        for user in ('bill', 'bob', 'jane'): self.chain.distribute_mining_reward(user)
+        self.node = FullNode(self.chain, ChainIndex(self.chain))
+        for n in range(1, 8):
+            block = Block([Transaction('bill', f'user{i}', n) for i in range(n)])
+            self.chain.mine(block)
+            self.assertTrue(self.chain.add_block(block))
+        self.client = LightClient(difficulty=2)
+        self.assertEqual(self.client.add_headers(self.node.headers()), len(self.chain._blockchain))
+
+    def test_transaction_proofs(self):
+        '''every transaction has a valid proof of log2(block size) hashes; the wrong position, height or transaction
+        fails'''
+        for height, block in enumerate(self.chain._blockchain, 1):
+            self.assertEqual(merkle_levels(block)[-1], [block.digest()])
+            for pos, trans in enumerate(block):
+                proof = self.node.transaction_proof(height, pos)
+                self.assertEqual(len(proof), (len(block) - 1).bit_length())
+                self.assertTrue(self.client.verify_transaction(trans, height, pos, proof))
+                self.assertFalse(self.client.verify_transaction(Transaction('bill', 'eve', 1), height, pos, proof))
+                if pos + 1 < len(block): self.assertFalse(self.client.verify_transaction(trans, height, pos + 1, proof))
+                self.assertFalse(self.client.verify_transaction(trans, height - 1, pos, proof))
+        height, pos, proof = self.node.prove_transaction(Transaction('bill', 'user3', 6))
+        self.assertEqual(self.chain._blockchain[height - 1][pos], Transaction('bill', 'user3', 6))
+        self.assertTrue(self.client.verify_transaction(Transaction('bill', 'user3', 6), height, pos, proof))
+        self.assertIsNone(self.node.prove_transaction(Transaction('bill', 'user3', 100)))
+        with self.assertRaises(IndexError):
+            self.node.transaction_proof(2, 1)
+
+    def test_balance_proofs(self):
+        '''balances (and missing accounts) prove against the last state root, which matches the ledger's'''
+        ledger = dict(self.chain._bc_ledger.balances())
+        self.assertEqual(self.node.state_root(), StateTree(ledger.items()).root())
+        for user in list(ledger) + ['nobody', 'eve']:
+            height, balance, proof = self.node.balance_proof(user)
+            self.assertEqual(height, len(self.client))
+            self.assertEqual(balance, ledger.get(user))
+            self.assertTrue(self.client.verify_balance(user, balance, height, proof))
+            self.assertFalse(self.client.verify_balance(user, (balance or 0) + 1, height, proof))
+            self.assertFalse(self.client.verify_balance(user, balance, height - 1, proof))
+        height, balance, proof = self.node.balance_proof('bill')
+        self.assertFalse(verify_balance(self.node.state_root(), 'bob', balance, proof))   #someone else's proof
+
+    def test_headers(self):
+        '''headers round trip thru bytes; headers that don't link up or lack the work are rejected; reorgs roll the 
+        state root back'''
+        headers = self.node.headers()
+        for header, block in zip(headers, self.chain._blockchain):
+            again = Header.decode(header.encode())
+            self.assertEqual(again.pow_hash(), block.pow_hash())
+            self.assertEqual(again.state_root, header.state_root)
+        self.assertEqual(LightClient().add_headers(headers[1:]), 0)    #no genesis
+        client = LightClient(difficulty=2)
+        self.assertEqual(client.add_headers(headers[:3] + headers[4:]), 3)
+        broken = Header.decode(headers[3].encode())
+        while broken.pow_hash() <= _target(broken.difficulty): broken.nonce += 1
+        self.assertFalse(client.add_header(broken))     #links up but lacks the work
+        self.assertTrue(client.add_header(headers[3]))
+
+        roots = list(self.node._state_roots)
+        height = len(self.chain._blockchain)
+        side = []
+        parent = self.chain._blockchain[-3]
+        for user in ('x', 'y', 'z'):    #a heavier branch off height - 2
+            block = Block([Transaction('ROOT', user, 5)])
+            block._prev_hash, block._difficulty = parent.pow_hash(), self.chain._difficulty
+            block._nonce = _search_nonces(block.header_prefix(), _target(block._difficulty), 0, 2**64)
+            side.append(block)
+            parent = block
+        for block in side: self.tree.add(block)
+        self.assertEqual(len(self.chain._blockchain), height + 1)
+        self.assertEqual(self.client.add_headers([Header.from_block(block) for block in side[:2]]), 2)
+        self.assertEqual(self.client.header(height).pow_hash(), headers[-1].pow_hash())    #same work: first seen wins
+        self.assertTrue(self.client.add_header(Header.from_block(side[2])))     #heavier now: the client switches too
+        self.assertEqual(len(self.client), height + 1)
+        self.assertEqual([self.client.header(h).pow_hash() for h in range(height - 2, height + 2)],
+                         [block.pow_hash() for block in self.chain._blockchain[height - 3:]])
+        self.assertEqual(self.node._state_roots[:height - 2], roots[:height - 2])
+        self.assertEqual(self.node.state_root(), StateTree(self.chain._bc_ledger.balances()).root())
+        self.assertEqual(self.node.balance_proof('user6')[1], None)
+
+    def test_retargeted_difficulty(self):
+        '''headers must be mined at the difficulty the chain retargets to; after a checkpoint in the middle of an
+        interval the first retarget can only be bounded'''
+        chain = Blockchain(difficulty=4)
+        for i in range(2*chain._RETARGET_INTERVAL): chain.distribute_mining_reward(f'user{i}')
+        headers = [Header.from_block(block) for block in chain._blockchain]
+        self.assertEqual(headers[-1].difficulty, 6)     #retargeted at height 20
+        client = LightClient(difficulty=4)
+        self.assertEqual(client.add_headers(headers), len(headers))
+        for difficulty in (4, 7):   #real work, but not at the difficulty the chain requires
+            block = Block([Transaction('ROOT', 'eve', 1)], chain._blockchain[-2].pow_hash())
+            block._difficulty = difficulty
+            block._nonce = _search_nonces(block.header_prefix(), _target(difficulty), 0, 2**64)
+            self.assertFalse(client.add_header(Header.from_block(block)))
+        self.assertEqual(LightClient().add_headers(headers), 1)
+        self.assertEqual(LightClient(difficulty=4, checkpoint=(15, headers[14])).add_headers(headers[14:]), 7)
+
+    def test_committed_state_root(self):
+        '''mined blocks commit to their state root under the proof of work; headers w/o enough work are rejected, and
+        a checkpoint can stand in for the genesis header'''
+        headers, height = self.node.headers(), len(self.chain._blockchain)
+        for h, header in enumerate(headers, 1):     #the rewards were mined before the node was there
+            self.assertEqual(header.state_root, self.node.state_root(h) if h > 4 else None)
+        _, balance, proof = self.node.balance_proof('bill')
+        self.assertTrue(self.client.verify_balance('bill', balance, height, proof))
+
+        forged = Header.decode(headers[-1].encode())
+        forged.state_root = StateTree([('bill', 10**6)]).root()
+        self.assertNotEqual(forged.pow_hash(), headers[-1].pow_hash())
+        client = LightClient(difficulty=2)
+        client.add_headers(headers[:-1])
+        while forged.pow_hash() <= _target(forged.difficulty): forged.nonce += 1
+        self.assertFalse(client.add_header(forged))
+        unmined = Header.from_block(Block([Transaction('ROOT', 'eve', 1)], headers[-2].merkle_root))
+        self.assertEqual(unmined.difficulty, 0)
+        self.assertFalse(client.add_header(unmined))
+        self.assertEqual(LightClient(difficulty=3).add_headers(headers), 1)   #height 2 was mined at difficulty 2
+        with self.assertRaises(ValueError): LightClient(difficulty=0)
+
+        client = LightClient(difficulty=2, checkpoint=(6, headers[5]))
+        self.assertEqual(client.add_headers(headers[5:]), height - 5)
+        self.assertEqual(len(client), height)
+        self.assertTrue(client.verify_balance('bill', balance, height, proof))
+        self.assertFalse(client.verify_balance('bill', balance, 5, proof))
+
+        block = self.chain._blockchain[-1]
+        again = decode_block(encode_block(block))
+        self.assertEqual((again._state_root, again.pow_hash()), (block._state_root, block.pow_hash()))
+        with tempfile.TemporaryDirectory() as directory:
+            with ChainLog(directory) as log:
+                chain = Blockchain(difficulty=1, log=log)
+                FullNode(chain)
+                chain.distribute_mining_reward('bill')
+                mined = chain._blockchain[-1]
+            with ChainLog(directory) as log: reloaded = Blockchain(difficulty=1, log=log)._blockchain[-1]
+            self.assertIsNotNone(mined._state_root)
+            self.assertEqual((reloaded._state_root, reloaded.pow_hash()), (mined._state_root, mined.pow_hash()))
+
+class Test_Service(unittest.TestCase):
+    '''Tests the asyncio service over a Unix socket: coalescing, snapshot reads, backpressure and errors'''
+
+    def setUp(self):
+        '''a chain w bill, bob and jane funded, and a socket path in a temp dir'''
+        self.chain = Blockchain()
+        for user in ('bill', 'bob', 'jane'): self.chain.add_block(Block([Transaction('ROOT', user, 100)]))
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'chain.sock')
+
+    def tearDown(self):
+        '''removes the temp dir'''
+        self.tmp.cleanup()
+
+    def serve(self, body, **kwargs):
+        '''runs body(service, client) against a fresh service'''
+        async def main():
+            service = BlockchainService(self.chain, **kwargs)
+            await service.start(self.path)
+            client = await ServiceClient.connect(self.path)
+            try:
+                return await body(service, client)
+            finally:
+                await client.close()
+                await service.close()
+        return asyncio.run(main())
+
+    def test_coalescing(self):
+        '''concurrent transfers go into a few blocks; a sender's overspend is turned away alone'''
+        async def body(service, client):
+            height = len(self.chain._blockchain)
+            results = await asyncio.gather(*[client.submit_transaction('bill', f'user{i}', 1) for i in range(50)],
+                                           *[client.submit_transaction('bob', 'jane', 40) for i in range(3)],
+                                           return_exceptions=True)
+            self.assertEqual(sum(isinstance(r, dict) for r in results), 52)
+            self.assertEqual([str(r) for r in results if isinstance(r, ValueError)], ['insufficient funds'])
+            self.assertTrue(service.batches < 10)
+            self.assertEqual(service.coalesced, 52)
+            self.assertEqual(len(self.chain._blockchain), height + service.batches)
+            self.assertEqual(await client.balance('bill'), (50, len(self.chain._blockchain)))
+            self.assertEqual((await client.balance('jane'))[0], 180)
+            self.assertEqual(await client.balance('nobody'), (None, len(self.chain._blockchain)))
+        self.serve(body)
+        self.assertEqual(self.chain._bc_ledger.balance('user7'), 1)
+
+    def test_blocks_and_validate(self):
+        '''a submitted block is applied in order w the queued transactions; validate_chain runs on the writer'''
+        async def body(service, client):
+            result = await client.submit_block(Block([Transaction('jane', 'kyle', 30)]))
+            self.assertTrue(result['accepted'])
+            self.assertEqual(result['height'], len(self.chain._blockchain))
+            self.assertFalse((await client.submit_block(Block([Transaction('kyle', 'jane', 31)])))['accepted'])
+            self.assertEqual(await client.balance('kyle'), (30, len(self.chain._blockchain)))
+            self.assertEqual(await client.validate(), {'valid': True, 'tampered': 0})
+        self.serve(body)
+
+    def test_backpressure_and_errors(self):
+        '''a full queue answers busy; bad requests get an error, not a hang'''
+        async def body(service, client):
+            results = await asyncio.gather(*[client.submit_transaction('bill', 'bob', 1) for i in range(20)],
+                                           return_exceptions=True)
+            busy = [r for r in results if isinstance(r, ValueError)]
+            self.assertTrue(busy)
+            self.assertTrue(all(str(r) == BUSY for r in busy))
+            self.assertEqual(self.chain._bc_ledger.balance('bob'), 100 + len(results) - len(busy))
+            for op, fields in (('nope', {}), ('balance', {}), ('submit_transaction', {'from': 'bill', 'to': 'bob', 'amount': -1}),
+                               ('submit_transaction', {'from': 'bill', 'to': 'bob', 'amount': 'x'}), ('submit_block', {'block': 'zz'})):
+                with self.assertRaises(ValueError):
+                    await client.request(op, **fields)
+            stats = await load_test(self.path, clients=4, requests=20, users=3)
+            self.assertEqual(stats['requests'], 80)
+        self.serve(body, max_queue=2)
+
+class Test_SharedLedger(unittest.TestCase):
+    '''Tests the shared memory Ledger and its read-only replicas'''
+
+    def setUp(self):
+        '''a chain on a SharedLedger and a replica attached to it'''
+        self.ledger = SharedLedger(1000)
+        self.chain = Blockchain(ledger=self.ledger)
+        self.replica = LedgerReplica(self.ledger.name)
+
+    def tearDown(self):
+        '''closes and frees the shared memory'''
+        self.replica.close()
+        self.ledger.close()
+        self.ledger.unlink()
+
+    def test_chain(self):
+        '''the replica sees the same balances as a chain on the default Ledger, and a new version per block'''
+        plain = Blockchain()
+        for chain in (self.chain, plain):
+            chain.distribute_mining_reward('bill')
+            chain.add_block(Block([Transaction('bill', 'bob', 300), Transaction('bill', 'jane', 200.5)]))
+            self.assertFalse(chain.add_block(Block([Transaction('bob', 'jane', 301)])))
+        self.assertEqual(sorted(self.replica.balances()), sorted(plain._bc_ledger.balances()))
+        self.assertEqual(self.replica.balance('jane'), 200.5)
+        self.assertEqual(self.replica.balance('nobody'), None)
+        self.assertTrue(self.replica.has_funds('bob', 300))
+        self.assertFalse(self.replica.has_funds('bob', 301))
+        self.assertFalse(self.replica.has_funds('nobody', 0))
+        version = self.replica.version
+        self.chain.add_block(Block([Transaction('bob', 'jane', 1)]))
+        self.assertEqual((self.replica.version, self.replica.balance('jane')), (version + 1, 201.5))
+        with self.assertRaises(ValueError): self.replica.deposit('bob', 1)   #replicas are read-only
+
+    def test_other_process(self):
+        '''a replica in another process reads what the writer wrote'''
+        self.chain.add_block(Block([Transaction('ROOT', 'bill', 42)]))
+        code = (f'from sharedledger import LedgerReplica; r = LedgerReplica({self.ledger.name!r}); '
+                f'print(r.balance("bill"), r.version); r.close()')
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.split(), ['42', '2'])
+        self.assertEqual(out.stderr, '')    #no resource tracker warnings: the reader doesn't own the block
+
+    def test_failed_apply(self):
+        '''a block whose writes fail partway leaves the ledger as it was, in one write'''
+        self.chain.add_block(Block([Transaction('ROOT', 'bill', 42)]))
+        balances, version = sorted(self.replica.balances()), self.replica.version
+        for bad in ('x' * 60, 7):   #too long for a slot, not a str
+            with self.assertRaises(ValueError):
+                self.ledger.apply([Transaction('ROOT', 'alice', 10), Transaction('ROOT', bad, 5)])
+        self.assertEqual(sorted(self.replica.balances()), balances)
+        self.assertEqual(self.replica.version, version + 2)
+
+    def test_delete_and_purge(self):
+        '''deleted keys leave tombstones that inserts reuse or purge; the table doesn't grow'''
+        hmap = SharedHashMapping(10)
+        try:
+            for round in range(20):
+                for i in range(10): hmap[f'user{round}_{i}'] = i
+                for i in range(10): del hmap[f'user{round}_{i}']
+            hmap['bill'] = 7
+            self.assertEqual((len(hmap), hmap['bill'], hmap['user0_0'], 'user0_0' in hmap), (1, 7, False, False))
+            with self.assertRaises(KeyError): del hmap['bob']
+            with self.assertRaises(ValueError):
+                for i in range(100): hmap[f'k{i}'] = i
+            self.assertTrue(10 <= len(hmap) < 16)
+            with self.assertRaises(ValueError): hmap['x' * 49] = 1
+            with self.assertRaises(ValueError): hmap[7] = 1
+            with self.assertRaises(OverflowError): hmap['bill'] = 2**63
+            self.assertEqual(sorted(hmap.items()), sorted([('bill', 7)] + [(f'k{i}', i) for i in range(len(hmap) - 1)]))
+        finally:
+            hmap.close()
+            hmap.unlink()
+
+class Test_Stake(unittest.TestCase):
+    '''Tests the Fenwick tree and stake weighted proposer selection'''
+
+    def test_fenwick(self):
+        '''prefix sums and find match a plain list thru random updates and appends'''
+        rng = random.Random(3)
+        weights = [rng.randrange(5) for i in range(37)]
+        tree = FenwickTree(weights)
+        for step in range(300):
+            if step % 10 == 0:
+                weights.append(rng.randrange(5))
+                tree.append(weights[-1])
+            i = rng.randrange(len(weights))
+            weights[i] = rng.randrange(5)
+            tree.set(i, weights[i])
+            n = rng.randrange(len(weights) + 1)
+            self.assertEqual(tree.prefix(n), sum(weights[:n]))
+        self.assertEqual(tree.total, sum(weights))
+        for target in range(tree.total):
+            i = tree.find(target)
+            self.assertTrue(sum(weights[:i]) <= target < sum(weights[:i+1]))
+        with self.assertRaises(ValueError): tree.find(tree.total)
+        with self.assertRaises(ValueError): tree.add(0, -weights[0] - 1)
+
+    def test_follows_chain(self):
+        '''stakes track balances thru blocks and reorgs (ROOT excluded), and freed positions are reused'''
+        chain = Blockchain()
+        for user in ('bill', 'bob'): chain.add_block(Block([Transaction('ROOT', user, 100)]))
+        tree = BlockTree(chain)
+        stakes = StakeSelector(chain, min_stake=5)
+        self.assertEqual((len(stakes), stakes.total_stake, stakes.stake('ROOT')), (2, 200, 0))
+        chain.add_block(Block([Transaction('bill', 'jane', 97.5), Transaction('bob', 'kyle', 4)]))
+        self.assertEqual([stakes.stake(u) for u in ('bill', 'bob', 'jane', 'kyle')], [0, 96, 97, 0])
+        positions = len(stakes._users)
+        chain.add_block(Block([Transaction('bob', 'jane', 92)]))
+        chain.add_block(Block([Transaction('ROOT', 'bill', 5)]))
+        self.assertEqual((len(stakes), len(stakes._users), stakes.stake('bill')), (2, positions, 7))   #bob's position reused
+        chain.add_block(Block([Transaction('jane', 'bob', 92), Transaction('bill', 'bob', 5)]))
+        block = Block([Transaction('jane', 'bill', 50)])
+        block._prev_hash = chain._blockchain[-1].pow_hash()
+        fork = Block([Transaction('ROOT', 'x', 1)])
+        fork._prev_hash = chain._blockchain[-1].pow_hash()
+        fork2 = Block([Transaction('ROOT', 'y', 10)])
+        fork2._prev_hash = fork.pow_hash()
+        tree.add(block)
+        self.assertEqual(stakes.stake('bill'), 52)
+        tree.add(fork)
+        tree.add(fork2)     #undoes jane -> bill
+        self.assertEqual([stakes.stake(u) for u in ('bill', 'jane', 'x', 'y')], [0, 97, 0, 10])
+        self.assertEqual(stakes.total_stake, sum(b for u, b in chain._bc_ledger.balances() if u != 'ROOT' and b >= 5) - 0.5)
+
+    def test_selection(self):
+        '''proposers are deterministic per chain and slot, and picked in proportion to stake'''
+        chain = Blockchain()
+        chain.add_block(Block([Transaction('ROOT', 'bill', 100), Transaction('ROOT', 'bob', 300)]))
+        stakes = StakeSelector(chain)
+        self.assertEqual(stakes.proposer(1), StakeSelector(chain).proposer(1))
+        picks = [stakes.select(i.to_bytes(4, 'little')) for i in range(4000)]
+        self.assertTrue(0.7 < picks.count('bob') / len(picks) < 0.8)
+        proposer = stakes.produce_block()
+        self.assertEqual(chain._bc_ledger.balance(proposer), {'bill': 100, 'bob': 300}[proposer] + 1000)
+        self.assertEqual(stakes.total_stake, 1400)
+        with self.assertRaises(ValueError): StakeSelector(Blockchain()).proposer()
+
 class Test_Blockchain(unittest.TestCase):
     '''Test cases to ensure blockchain get initilized properly and its methods work properly'''
 
@@ -345,7 +1823,7 @@ class Test_Blockchain(unittest.TestCase):
         self.assertEqual(len(chain._blockchain), 11)
 
     def test_prev_block_hash(self):
-        '''makes sure that the 'prev hash' of a block is the previous block's hash value'''
+        '''makes sure that the 'prev hash' of a block is the previous block's header hash'''
         chain = Blockchain()
         chain.distribute_mining_reward('bill')
         chain.distribute_mining_reward('bob')
@@ -357,14 +1835,14 @@ class Test_Blockchain(unittest.TestCase):
 
         self.assertTrue(chain.add_block(self.block1))   #enough COIN available
         self.assertTrue(chain.add_block(self.block11))  #enough COIN available
-        self.assertEqual(hash(chain._blockchain[4]), chain._blockchain[5]._previous_block_hash) #these hash vals should be the same
-        self.assertEqual(hash(self.block1), self.block11._previous_block_hash)  #these hash vals should be the same
+        self.assertEqual(chain._blockchain[4].pow_hash(), chain._blockchain[5]._previous_block_hash) #these hashes should be the same
+        self.assertEqual(self.block1.pow_hash(), self.block11._previous_block_hash)  #these hashes should be the same
 
         self.assertTrue(chain.add_block(self.block2))   #enough COIN available
-        self.assertEqual(hash(self.block11), self.block2._previous_block_hash)  #these hash vals should be the same
+        self.assertEqual(self.block11.pow_hash(), self.block2._previous_block_hash)  #these hashes should be the same
 
         self.assertTrue(chain.add_block(self.block3))   #enough COIN available
-        self.assertEqual(hash(self.block2), self.block3._previous_block_hash)   #these hash vals should be the same
+        self.assertEqual(self.block2.pow_hash(), self.block3._previous_block_hash)   #these hashes should be the same
 
         self.assertFalse(chain.add_block(self.block4))  #a does not have any COIN yet
         self.assertEqual(None, self.block4._previous_block_hash)    #the block is not added so it does not have the prev block hash
@@ -373,10 +1851,10 @@ class Test_Blockchain(unittest.TestCase):
         self.assertEqual(self.block5._previous_block_hash, None)    #the block is not added so it does not have the prev block hash
 
         self.assertTrue(chain.add_block(self.block12))  #enough COIN available
-        self.assertEqual(hash(self.block3), self.block12._previous_block_hash)  #these hash vals should be the same
+        self.assertEqual(self.block3.pow_hash(), self.block12._previous_block_hash)  #these hashes should be the same
 
         for i in range(len(chain._blockchain)-1):#iterates thru each block...
-            self.assertEqual(hash(chain._blockchain[i]), chain._blockchain[i+1]._previous_block_hash)   #these hash vals should be the same
+            self.assertEqual(chain._blockchain[i].pow_hash(), chain._blockchain[i+1]._previous_block_hash)   #these hashes should be the same
 
     def test_validate_chain(self):
         '''tests that validate chain works: if a blocks prev hash is not the hash of the block in front of it, 
@@ -393,30 +1871,172 @@ class Test_Blockchain(unittest.TestCase):
         self.assertTrue(chain.add_block(self.block11))
 
         self.assertEqual(chain.validate_chain(), [])    #no blocks should be invalid yet: i have not begun tampering
-        self.assertEqual(hash(chain._blockchain[3]), chain._blockchain[4]._previous_block_hash)
-        self.assertEqual(hash(chain._blockchain[4]), chain._blockchain[5]._previous_block_hash)
+        self.assertEqual(chain._blockchain[3].pow_hash(), chain._blockchain[4]._previous_block_hash)
+        self.assertEqual(chain._blockchain[4].pow_hash(), chain._blockchain[5]._previous_block_hash)
         
-        self.block1._previous_block_hash = 12345    #changes prevblockhash of block1
-        self.assertNotEqual(hash(chain._blockchain[3]), chain._blockchain[4]._previous_block_hash)
-        self.assertEqual(chain.validate_chain(), [self.block1]) #block1 returned in invalid blocks list
+        self.block1._previous_block_hash = b'\x01' * 32    #changes prevblockhash of block1
+        self.assertNotEqual(chain._blockchain[3].pow_hash(), chain._blockchain[4]._previous_block_hash)
+        self.assertEqual(chain.validate_chain(), [self.block1, self.block11]) #block1 returned in invalid blocks list, and block11 no longer links to it
 
-        self.assertEqual(hash(chain._blockchain[1]), chain._blockchain[2]._previous_block_hash)
-        self.assertEqual(hash(chain._blockchain[2]), chain._blockchain[3]._previous_block_hash)
+        self.assertEqual(chain._blockchain[1].pow_hash(), chain._blockchain[2]._previous_block_hash)
+        self.assertEqual(chain._blockchain[2].pow_hash(), chain._blockchain[3]._previous_block_hash)
         
-        chain._blockchain[2]._previous_block_hash = 0   #changes prevblockhash of 3rd block in chain
-        self.assertEqual(chain.validate_chain(), [Block([Transaction('ROOT','bob',1000)]), self.block1]) #both block1 and 3rd block are returned
+        chain._blockchain[2]._previous_block_hash = bytes(32)   #changes prevblockhash of 3rd block in chain
+        bad = [Block([Transaction('ROOT','bob',1000)]), Block([Transaction('ROOT','person1',1000)]), self.block1, self.block11]
+        self.assertEqual(chain.validate_chain(), bad) #both block1 and 3rd block are returned (and the blocks after them)
 
         self.assertFalse(chain.add_block(self.block4))  #a does not have any COIN yet, block should not be added
-        self.assertEqual(chain.validate_chain(), [Block([Transaction('ROOT','bob',1000)]), self.block1])
+        self.assertEqual(chain.validate_chain(), bad)
 
         self.assertTrue(chain.add_block(self.block12))
         self.assertTrue(chain.add_block(self.block3))
-        self.assertEqual(chain.validate_chain(), [Block([Transaction('ROOT','bob',1000)]), self.block1])    #returned lsit should be same
+        self.assertEqual(chain.validate_chain(), bad)    #returned lsit should be same
         
-        self.block3._previous_block_hash = 9999999
-        self.assertEqual(chain.validate_chain(), [Block([Transaction('ROOT','bob',1000)]), self.block1, self.block3])   #returned list added block3
+        self.block3._previous_block_hash = b'\x09' * 32
+        self.assertEqual(chain.validate_chain(), bad + [self.block3])   #returned list added block3
 
-        self.block12._previous_block_hash = 'heeheehee'
-        self.assertEqual(chain.validate_chain(), [Block([Transaction('ROOT','bob',1000)]), self.block1, self.block12, self.block3])#returned list added block12
+        self.block12._previous_block_hash = b'heeheehee'.ljust(32)
+        self.assertEqual(chain.validate_chain(), bad + [self.block12, self.block3])#returned list added block12
+
+    def test_validate_chain_incremental(self):
+        '''validate_chain only rechecks new blocks, but tampering w blocks below the watermark is still caught'''
+        chain = Blockchain()
+        for user in ('bill', 'bob', 'person1'): chain.distribute_mining_reward(user)
+        self.assertEqual(chain.validate_chain(), [])
+        self.assertEqual(chain._validated, 4)   #all 4 blocks are below the watermark now
+
+        self.assertTrue(chain.add_block(self.block1))
+        self.assertTrue(chain.add_block(self.block11))
+        self.assertEqual(chain.validate_chain(), [])
+        self.assertEqual(chain._validated, 6)
+
+        #edits a transaction in an already validated block: the next block's prev hash no longer matches
+        chain._blockchain[1]._block[0].amount = 5
+        self.assertEqual(chain.validate_chain(), [chain._blockchain[2]])
+        chain._blockchain[1]._block[0].amount = 1000     #undoing the edit makes the chain valid again
+        self.assertEqual(chain.validate_chain(), [])
+
+        #adds a transaction to an already validated block
+        chain._blockchain[4].add_transaction(Transaction('bill', 'bob', 1))
+        self.assertEqual(chain.validate_chain(), [self.block11])
+
+        #invalid blocks below the watermark are still reported after new blocks are added
+        self.assertTrue(chain.add_block(self.block12))
+        self.assertEqual(chain.validate_chain(), [self.block11])
+        self.assertEqual(chain.validate_chain(full=True), [self.block11])
+
+    def test_edits_per_chain(self):
+        '''an edit only drops the watermark of the chain the edited block is in'''
+        chains = [Blockchain(), Blockchain()]
+        for chain in chains:
+            for user in ('bill', 'bob'): chain.distribute_mining_reward(user)
+            self.assertEqual(chain.validate_chain(), [])
+        chains[0]._blockchain[1][0].amount = 5
+        chains[0]._blockchain[2].add_transaction(Transaction('bill', 'bob', 1))
+        self.assertEqual([chain._edits for chain in chains], [2, 0])
+        self.assertEqual(chains[1]._validated_edits, chains[1]._edits)    #its watermark still holds
+        self.assertEqual(chains[0].validate_chain(), [chains[0]._blockchain[2]])
+
+        block = chains[1]._blockchain[-1]
+        removed = chains[1]._unlink({'bob': (None, 1000), 'ROOT': (999999 - 1000, 999999 - 2000)})
+        removed.add_transaction(Transaction('ROOT', 'jane', 1))     #not in a chain anymore
+        self.assertEqual((removed, chains[1]._edits), (block, 0))
+        self.assertIsNone(decode_block(encode_block(block))._chain)
+
+    def test_validate_chain_per_block(self):
+        '''edits only rehash the block holding the Transaction; edits that skip the hooks are caught by full=True'''
+        chain = Blockchain()
+        for user in ('bill', 'bob', 'jane', 'kyle'): chain.distribute_mining_reward(user)
+        self.assertEqual(chain.validate_chain(), [])
+        roots = [block._root for block in chain._blockchain]
+
+        stray = Transaction('x', 'y', 1)    #in a block, but not in the chain
+        Block([stray]).digest()
+        stray.amount = 2
+        self.assertEqual(chain.validate_chain(), [])
+        self.assertEqual(chain._validated, 5)   #the watermark didn't move
+
+        chain._blockchain[2][0].amount = 5     #only that block loses its cached root
+        self.assertEqual([block._root is root for block, root in zip(chain._blockchain, roots)],
+                         [True, True, False, True, True])
+        self.assertEqual(chain.validate_chain(), [chain._blockchain[3]])
+        chain._blockchain[2][0].amount = 1000
+        self.assertEqual(chain.validate_chain(), [])
+
+        chain._blockchain[1]._block[0] = Transaction('ROOT', 'bill', 1)    #replaced in place, no hook sees it
+        self.assertEqual(chain.validate_chain(full=True), [chain._blockchain[2]])
+        chain._blockchain[1]._block[0] = Transaction('ROOT', 'bill', 1000)
+        self.assertEqual(chain.validate_chain(full=True), [])
+        chain._blockchain[3]._block.append(Transaction('ROOT', 'jane', 1))    #appended in place
+        self.assertEqual(chain.validate_chain(full=True), [chain._blockchain[4]])
+
+    def test_strict_mode(self):
+        '''strict chains reject blocks whose spends add up to more than the sender has, w/o touching the ledger, but 
+        let a sender spend what an earlier transaction in the same block paid them'''
+        def chains():
+            for strict in (False, True):
+                yield strict, 'add_block', Blockchain(strict=strict)
+                yield strict, 'add_blocks', Blockchain(strict=strict)
+        double = [Transaction('bill', 'bob', 6), Transaction('bill', 'jane', 6)]
+        relay = [Transaction('bob', 'kyle', 3), Transaction('kyle', 'jane', 2), Transaction('bob', 'bill', 15)]
+        for strict, how, chain in chains():
+            with self.subTest(strict=strict, how=how):
+                add = (lambda block: chain.add_blocks([block])[0]) if how == 'add_blocks' else chain.add_block
+                self.assertTrue(add(Block([Transaction('ROOT', 'bill', 10), Transaction('ROOT', 'bob', 10)])))
+                self.assertEqual(add(Block(double)), not strict)
+                if strict:
+                    self.assertEqual(chain._bc_ledger.balance('bill'), 10)  #nothing applied
+                    self.assertIsNone(chain._bc_ledger.balance('jane'))
+                    self.assertFalse(add(Block(relay)))     #bob would spend 18 of his 10
+                    self.assertTrue(add(Block(relay[:2] + [Transaction('jane', 'bill', 2)])))   #spends what it was paid
+                    self.assertEqual(chain._bc_ledger.balance('kyle'), 1)
+                    self.assertEqual(chain._bc_ledger.balance('jane'), 0)
+                else:
+                    self.assertEqual(chain._bc_ledger.balance('bill'), -2)  #the old check lets it through
+
+    def test_add_blocks(self):
+        '''add_blocks should accept/reject the same blocks as add_block and leave the same balances'''
+        def rewards(*users):
+            return [Block([Transaction('ROOT', user, 1000)]) for user in users]
+
+        def blocks():
+            return (rewards('bill') + [Block([self.trans1]), Block([self.trans1]*3), Block([self.trans1, self.trans2, self.trans3])]
+                    + rewards('bob', 'person1', 'jimmy', 'spongebob', 'a')
+                    + [Block([self.trans1, self.trans2, self.trans3, self.trans4, self.trans5, self.trans6]),
+                       Block([self.trans2, self.trans3, self.trans5, self.trans6]), Block([]),
+                       Block([Transaction('jane', 'bill', 300), Transaction('bill', 'new_user', 10)])])
+
+        serial, batched = Blockchain(), Blockchain()
+        expected = [serial.add_block(block) for block in blocks()]
+        self.assertEqual(batched.add_blocks(blocks()), expected)
+        self.assertEqual(expected, [True, True, True, False, True, True, True, True, True, False, True, True, True])
+
+        self.assertEqual(len(batched._blockchain), len(serial._blockchain))
+        self.assertEqual(dict(batched._bc_ledger._ledger_hashmap.items()), dict(serial._bc_ledger._ledger_hashmap.items()))
+        self.assertEqual(batched.validate_chain(), [])
+        self.assertEqual(batched._bc_ledger._ledger_hashmap['sandy'], 3)    #spongebob sent sandy 0 and a sent 3
+        self.assertEqual(batched.add_blocks([]), [])
+
+    def test_add_blocks_floats(self):
+        '''random float chains: add_blocks gives bit for bit the balances (and listener changes) of add_block'''
+        class Changes():
+            def __init__(self): self.seen = []
+            def block_added(self, chain, block, changes): self.seen.append(changes)
+        for seed in range(30):
+            rng = random.Random(seed)
+            users = [f'user{i}' for i in range(6)]
+            blocks = [Block([Transaction('ROOT', user, rng.random() * 100) for user in users])]
+            for i in range(10):
+                blocks.append(Block([Transaction(rng.choice(users), rng.choice(users + ['new']), rng.random() * 30)
+                                     for j in range(rng.randint(1, 8))]))
+            for strict in (False, True):
+                serial, batched = Blockchain(strict=strict), Blockchain(strict=strict)
+                seen = [Changes(), Changes()]
+                serial.add_listener(seen[0])
+                batched.add_listener(seen[1])
+                self.assertEqual(batched.add_blocks(blocks), [serial.add_block(block) for block in blocks])
+                self.assertEqual(dict(batched._bc_ledger.balances()), dict(serial._bc_ledger.balances()))
+                self.assertEqual(seen[1].seen, seen[0].seen)
+                self.assertEqual(replay.audit_supply(batched), replay.audit_supply(serial))
 
 unittest.main()
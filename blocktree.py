@@ -0,0 +1,143 @@
+'''Tree of every known block for a Blockchain, so competing branches (ie: from other nodes) can be kept and switched to.
+the Blockchain itself always holds the main branch: the one w the most cumulative work (2**difficulty per block, so
+the longest one when proof of work is off). switching to a heavier branch only undoes the main branch's blocks back
+to the common ancestor and applies the new branch's blocks from there, using the balance changes each block recorded
+when it was added, so a reorg costs O(depth) no matter how long the chain is'''
+from blockchain import _target
+
+class _Node():
+    '''one block in the tree, w where it sits and what it did to the ledger when it was last on the main branch'''
+    __slots__ = ('id', 'block', 'parent', 'height', 'work', 'changes', 'difficulty', 'invalid')
+
+    def __init__(self, block_id, block, parent, invalid=False):
+        '''inits a node under parent (None for the genesis block)'''
+        self.id = block_id
+        self.block = block
+        self.parent = parent
+        self.height = parent.height + 1 if parent is not None else 1
+        self.work = (parent.work if parent is not None else 0) + 2**block._difficulty
+        self.changes = None     # {user: (balance before, balance after)} from when the block was added to the chain
+        self.difficulty = None  # the chain's difficulty right after the block was added
+        self.invalid = invalid
+
+class BlockTree():
+    '''Keeps every block handed to add (and every block added to chain directly) indexed by id: the block's header
+    hash (Block.pow_hash), which covers its prev hash: the parent's id. chain's blocks from before the tree was made can't be undone,
+    since their balance changes were never recorded'''
+    def __init__(self, chain):
+        '''indexes chain's current blocks as the main branch and starts listening for new ones'''
+        self._chain = chain
+        self._nodes = {}        # block id -> _Node
+        self._main = []         # ids of the main branch; _main[i] is chain._blockchain[i]
+        self._orphans = {}      # prev hash -> blocks waiting for the parent w that id
+        self._connecting = None # node being added to chain by this tree
+        for block in chain._blockchain: self._main.append(self._index(block, self._tip()).id)
+        self._tip().difficulty = chain._difficulty
+        self._final = len(self._main)   # height of the newest block that can't be undone
+        chain.add_listener(self)
+
+    def __repr__(self):
+        '''simple print statement w the number of blocks, main branch height and orphans'''
+        return f'BlockTree({len(self._nodes)} blocks, height={len(self._main)}, orphans={self.orphans()})'
+
+    def __len__(self):
+        '''number of blocks in the tree'''
+        return len(self._nodes)
+
+    def __contains__(self, block_id):
+        '''checks if a block id is in the tree'''
+        return block_id in self._nodes
+
+    def orphans(self):
+        '''number of blocks waiting for their parent'''
+        return sum(len(blocks) for blocks in self._orphans.values())
+
+    def work(self):
+        '''cumulative work of the main branch'''
+        return self._tip().work
+
+    def add(self, block):
+        '''adds a block whose prev hash is the header hash of its parent (a block w no prev hash goes on the main branch's
+        tip). if the parent is unknown the block is kept as an orphan until it arrives. if the block makes its branch
+        heavier than the main branch, the chain switches to it. returns True if the block ended up on the main branch.
+        blocks from a branch that turns out to spend money a sender doesn't have are marked invalid (w everything built
+        on them) and the chain stays where it was'''
+        if block._prev_hash is None: block._prev_hash = self._tip().block.pow_hash()
+        pending, on_main = [block], False
+        while pending:      #a block can free orphans, which can free orphans...
+            block = pending.pop()
+            block_id = block.pow_hash()
+            if block_id in self._nodes:
+                on_main = on_main or self._on_main(self._nodes[block_id])
+                continue
+            parent = self._nodes.get(block._prev_hash)
+            if parent is None:
+                self._orphans.setdefault(block._prev_hash, []).append(block)
+                continue
+
+            bad_work = bool(block._difficulty) and block_id > _target(block._difficulty)
+            node = self._index(block, parent, parent.invalid or bad_work)
+            if not node.invalid and node.work > self._tip().work: on_main = self._reorg(node) or on_main
+            pending.extend(self._orphans.pop(block_id, ()))
+        return on_main
+
+    def block_added(self, chain, block, changes):
+        '''listener hook called by Blockchain: records the block's changes, indexing it first if it was added to the
+        chain directly instead of thru add'''
+        node = self._connecting
+        if node is None or node.block is not block: node = self._index(block, self._tip())
+        node.changes = changes
+        node.difficulty = chain._difficulty
+        self._main.append(node.id)
+
+    def _tip(self):
+        '''node of the main branch's last block (None before the genesis block is indexed)'''
+        return self._nodes[self._main[-1]] if self._main else None
+
+    def _on_main(self, node):
+        '''checks if node is on the main branch'''
+        return node.height <= len(self._main) and self._main[node.height - 1] == node.id
+
+    def _index(self, block, parent, invalid=False):
+        '''makes a node for block under parent and indexes it'''
+        node = _Node(block.pow_hash(), block, parent, invalid)
+        self._nodes[node.id] = node
+        return node
+
+    def _reorg(self, target):
+        '''makes target's branch the main branch: undoes blocks back to the common ancestor, then adds target's
+        branch from there. if one of its blocks is rejected, that block and the rest of the branch are marked invalid
+        and the old main branch is put back. returns True if target is now the tip'''
+        path, node = [], target
+        while not self._on_main(node):
+            path.append(node)
+            node = node.parent
+        fork = node
+        if fork.height < self._final: return False      #would have to undo blocks whose changes were never recorded
+
+        undone = self._disconnect(fork)
+        for i, node in enumerate(reversed(path)):
+            if not self._connect(node):
+                for bad in path[:len(path) - i]: bad.invalid = True
+                self._disconnect(fork)
+                for old in reversed(undone): self._connect(old)
+                return False
+        return True
+
+    def _disconnect(self, fork):
+        '''undoes main branch blocks until fork is the tip. returns the undone nodes, newest first'''
+        chain, undone = self._chain, []
+        while len(self._main) > fork.height:
+            node = self._nodes[self._main.pop()]
+            chain._unlink(node.changes)
+            undone.append(node)
+        chain._difficulty = fork.difficulty
+        return undone
+
+    def _connect(self, node):
+        '''adds node's block on top of the chain (checking funds and proof of work). returns False if it is rejected'''
+        self._connecting = node
+        try:
+            return self._chain.add_block(node.block)
+        finally:
+            self._connecting = None
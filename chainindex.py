@@ -0,0 +1,106 @@
+'''Optional secondary indexes for a Blockchain: every user's transactions (as block height and position) and where each
+transaction is. both are kept up to date by listening to the chain, so add_block and add_blocks maintain them as they
+go. locations are packed into one int, (height << 32) | position, and each user's locations sit in an array('Q') in
+chain order, so paging thru a user's history is O(1) per page start and finding a height range is a bisect'''
+from array import array
+from bisect import bisect_left
+
+def _pack(height, pos):
+    '''packs a transaction's location into one int'''
+    return (height << 32) | pos
+
+def _unpack(loc):
+    '''returns (height, position) of a packed location'''
+    return loc >> 32, loc & 0xFFFFFFFF
+
+def _key(digest):
+    '''the transaction index keys on the first 8 bytes of a digest (as an int, much smaller than the bytes). keys that
+    collide hold a list of locations, and lookups check the transaction's full digest'''
+    return int.from_bytes(digest[:8], 'big')
+
+class ChainIndex():
+    '''Indexes chain's transactions by user and by digest. heights count blocks like LedgerHistory: the block at height
+    h is chain._blockchain[h-1] (the genesis block is height 1)'''
+    def __init__(self, chain):
+        '''indexes every block already in chain, then starts listening for new ones'''
+        self._chain = chain
+        self._by_user = {}      # user -> array('Q') of packed locations of the transactions they send or receive
+        self._by_digest = {}    # _key(digest) -> packed location, or a list of them if keys collide
+        for height, block in enumerate(chain._blockchain, 1): self._add(height, block)
+        chain.add_listener(self)
+
+    def __repr__(self):
+        '''simple print statement w the number of users and transactions indexed'''
+        return f'ChainIndex({len(self._by_user)} users, {len(self._by_digest)} transactions)'
+
+    def block_added(self, chain, block, changes):
+        '''listener hook called by Blockchain: indexes the new block'''
+        self._add(len(chain._blockchain), block)
+
+    def block_removed(self, chain, block, changes):
+        '''listener hook called by Blockchain when the newest block is undone: drops its entries, which are the last
+        ones in every list they are in'''
+        height = len(chain._blockchain) + 1
+        for pos, trans in enumerate(block):
+            loc = _pack(height, pos)
+            for user in (trans.from_user, trans.to_user):
+                locs = self._by_user.get(user)
+                if locs and locs[-1] == loc:
+                    locs.pop()
+                    if not locs: del self._by_user[user]
+            key = _key(trans.digest())
+            found = self._by_digest.get(key)
+            if isinstance(found, list):
+                found.remove(loc)
+                if len(found) == 1: self._by_digest[key] = found[0]
+            elif found == loc: del self._by_digest[key]
+
+    def count(self, user):
+        '''number of transactions user sent or received (a transaction to themself counts once)'''
+        return len(self._by_user.get(user, ()))
+
+    def transactions(self, user, start=0, limit=None, newest_first=False, min_height=1, max_height=None):
+        '''lazily yields (height, position, Transaction) for user's transactions between min_height and max_height,
+        skipping the first start of them and stopping after limit (so page n is start=n*limit). each page costs
+        O(log n + limit) however long the user's history is'''
+        locs = self._by_user.get(user)
+        if not locs: return
+        lo = bisect_left(locs, _pack(min_height, 0))
+        hi = len(locs) if max_height is None else bisect_left(locs, _pack(max_height + 1, 0))
+        count = hi - lo - start if limit is None else min(limit, hi - lo - start)
+        blocks = self._chain._blockchain
+        for i in range(max(0, count)):
+            loc = locs[hi - 1 - start - i] if newest_first else locs[lo + start + i]
+            height, pos = _unpack(loc)
+            yield height, pos, blocks[height - 1][pos]
+
+    def locate(self, trans):
+        '''returns (height, position) of a transaction (or a digest of one) in the chain, or None if it is not in it.
+        the same transfer made more than once has the same digest: the oldest one is returned'''
+        digest = trans if isinstance(trans, bytes) else trans.digest()
+        found = self._by_digest.get(_key(digest))
+        if found is None: return None
+        blocks = self._chain._blockchain
+        for loc in (found if isinstance(found, list) else (found,)):
+            height, pos = _unpack(loc)
+            if blocks[height - 1][pos].digest() == digest: return height, pos
+        return None
+
+    def _add(self, height, block):
+        '''indexes every transaction in a block at height'''
+        by_user, by_digest = self._by_user, self._by_digest
+        for pos, trans in enumerate(block):
+            loc = _pack(height, pos)
+            frm, to = trans.from_user, trans.to_user
+            locs = by_user.get(frm)
+            if locs is None: locs = by_user[frm] = array('Q')
+            locs.append(loc)
+            if to != frm:
+                locs = by_user.get(to)
+                if locs is None: locs = by_user[to] = array('Q')
+                locs.append(loc)
+            key = _key(trans.digest())
+            found = by_digest.get(key)
+            if found is None: by_digest[key] = loc
+            elif isinstance(found, list): found.append(loc)
+            else: by_digest[key] = [found, loc]
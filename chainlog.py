@@ -0,0 +1,210 @@
+'''Append-only on-disk log for a Blockchain. every accepted block is appended to a segment file as a length prefixed
+record, and the ledger is snapshotted every snapshot_interval blocks, so a restart only has to re-apply the blocks
+after the newest snapshot. segments are read back thru mmap, one record at a time'''
+import mmap
+import os
+import struct
+
+from blockchain import Block, Transaction, _varint, _read_varint, _encode_value, _decode_value
+
+FSYNC_POLICIES = ('block', 'batch', 'none')     # fsync after every block, after every add_block/add_blocks call, or never
+_LEN = struct.Struct('<I')              # length prefix of each record
+_SNAPSHOT_HEADER = struct.Struct('<Q')  # chain height a snapshot was taken at
+_POW = struct.Struct('<dBQ')            # timestamp, difficulty and nonce of a block
+_HAS_STATE_ROOT = 0x40                  # set in a record's prev hash length when a state root follows the prev hash
+
+def _encode_block(block):
+    '''record payload for a block: varint length + prev hash (empty for the genesis block), the block's state root
+    if it has one (flagged in the length), proof of work fields, varint number of transactions, then each
+    Transaction.encode()'''
+    prev = block._previous_block_hash or b''
+    if block._state_root is None: parts = [_varint(len(prev)), prev]
+    else: parts = [_varint(len(prev) | _HAS_STATE_ROOT), prev, block._state_root]
+    parts += [_POW.pack(block._timestamp, block._difficulty, block._nonce), _varint(len(block))]
+    parts.extend(trans.encode() for trans in block)
+    return b''.join(parts)
+
+def _decode_block(buf, pos, block_cls=Block):
+    '''rebuilds a block (as block_cls) from a payload made by _encode_block, starting at pos in buf'''
+    n, pos = _read_varint(buf, pos)
+    has_root, n = n & _HAS_STATE_ROOT, n & ~_HAS_STATE_ROOT
+    prev = bytes(buf[pos:pos+n]) if n else None
+    pos += n
+    state_root = None
+    if has_root:
+        state_root = bytes(buf[pos:pos+32])
+        pos += 32
+    timestamp, difficulty, nonce = _POW.unpack_from(buf, pos)
+    count, pos = _read_varint(buf, pos + _POW.size)
+    txs = []
+    decode = Transaction.decode
+    for i in range(count):
+        trans, pos = decode(buf, pos)
+        txs.append(trans)
+    return block_cls._restore(txs, prev, nonce, timestamp, difficulty, state_root)
+
+class ChainLog():
+    '''on-disk log of a Blockchain, kept in directory. pass it to Blockchain(log=...): a new log gets the genesis block,
+    a log w blocks in it is replayed'''
+    def __init__(self, directory, fsync='batch', segment_size=64*2**20, snapshot_interval=10000, block_cls=Block):
+        '''fsync is one of FSYNC_POLICIES. segments roll over once they reach segment_size bytes. block_cls is the
+        Block class replayed blocks are rebuilt as (ie: ColumnarBlock)'''
+        if fsync not in FSYNC_POLICIES: raise ValueError(f'fsync {fsync!r} must be one of {FSYNC_POLICIES}')
+        os.makedirs(directory, exist_ok=True)
+        self._dir = directory
+        self._fsync = fsync
+        self._segment_size = segment_size
+        self._snapshot_interval = snapshot_interval
+        self._block_cls = block_cls
+        self._file = None           # segment currently being appended to
+        self._file_size = 0
+        self._segments = sorted(name for name in os.listdir(directory) if name.startswith('segment-') and name.endswith('.log'))
+        self._snapshots = sorted(name for name in os.listdir(directory) if name.startswith('snapshot-') and name.endswith('.bin'))
+        self._snapshot_height = int(self._snapshots[-1][9:-4]) if self._snapshots else 0
+        if self._segments: self._repair(self._segments[-1])
+
+    def __repr__(self):
+        '''simple print statement w the directory and number of segments'''
+        return f'ChainLog({self._dir!r}, segments={len(self._segments)})'
+
+    def __enter__(self):
+        '''lets a ChainLog be used in a with statement, which closes it at the end'''
+        return self
+
+    def __exit__(self, *exc_info):
+        '''closes the log'''
+        self.close()
+
+    def is_empty(self):
+        '''returns True if no block has been written to the log yet'''
+        return all(os.path.getsize(self._path(name)) == 0 for name in self._segments)
+
+    def append(self, block):
+        '''appends a block to the newest segment, starting a new segment if it is full'''
+        payload = _encode_block(block)
+        if self._file is None or self._file_size >= self._segment_size: self._roll()
+        self._file.write(_LEN.pack(len(payload)))
+        self._file.write(payload)
+        self._file_size += _LEN.size + len(payload)
+        if self._fsync == 'block': self._sync()
+
+    def commit(self, chain):
+        '''called by Blockchain after each add_block/add_blocks call: flushes (and fsyncs under the 'batch' policy) the
+        appended blocks, then snapshots the ledger if snapshot_interval blocks were added since the last snapshot'''
+        if self._file is not None:
+            if self._fsync == 'batch': self._sync()
+            else: self._file.flush()
+        height = len(chain._blockchain)
+        if height - self._snapshot_height >= self._snapshot_interval: self._write_snapshot(height, chain._bc_ledger)
+
+    def close(self):
+        '''flushes and closes the open segment'''
+        if self._file is not None:
+            if self._fsync != 'none': self._sync()
+            self._file.close()
+            self._file = None
+
+    def replay(self, chain):
+        '''loads every block in the log into chain._blockchain and rebuilds chain's ledger from the newest snapshot plus
+        the blocks after it. blocks are trusted as-is: call chain.validate_chain() to check them'''
+        blocks = chain._blockchain
+        for block in self._read_blocks():
+            block._chain = chain
+            blocks.append(block)
+        if chain._difficulty and blocks[-1]._difficulty:    #picks up the difficulty where proof of work left off
+            chain._difficulty = blocks[-1]._difficulty
+            if len(blocks) % chain._RETARGET_INTERVAL == 0: chain._retarget()
+
+        height, balances = self._read_snapshot()
+        if height > len(blocks): height, balances = 0, {}   #snapshot is newer than the blocks that made it to disk
+        for i in range(height, len(blocks)):
+            for trans in blocks[i]:
+                frm, to, amt = trans.from_user, trans.to_user, trans.amount
+                if i > 0: balances[frm] = balances.get(frm, 0) - amt    #the genesis block only mints COIN
+                balances[to] = balances.get(to, 0) + amt
+        chain._bc_ledger.set_balances(balances)
+
+    def _path(self, name):
+        '''returns the full path of a file in the log directory'''
+        return os.path.join(self._dir, name)
+
+    def _sync(self):
+        '''flushes python's buffer and fsyncs the open segment'''
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _roll(self):
+        '''closes the open segment (if any) and starts appending to the newest one, or a new one if that is full'''
+        if self._file is not None: self.close()
+        if self._segments and os.path.getsize(self._path(self._segments[-1])) < self._segment_size:
+            name = self._segments[-1]
+        else:
+            name = f'segment-{len(self._segments):08d}.log'
+            self._segments.append(name)
+        self._file = open(self._path(name), 'ab')
+        self._file_size = self._file.tell()
+
+    def _records(self, name):
+        '''yields (memoryview, start, end) for every complete record in a segment, reading it thru mmap'''
+        with open(self._path(name), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0: return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    pos = 0
+                    while pos + _LEN.size <= size:
+                        start = pos + _LEN.size
+                        end = start + _LEN.unpack_from(mm, pos)[0]
+                        if end > size: break    #partial record from a crash mid-write
+                        yield view, start, end
+                        pos = end
+                finally:
+                    view.release()
+
+    def _read_blocks(self):
+        '''yields every block in the log, oldest first'''
+        for name in self._segments:
+            for view, start, end in self._records(name): yield _decode_block(view, start, self._block_cls)
+
+    def _repair(self, name):
+        '''truncates a partial record left at the end of a segment by a crash'''
+        end = 0
+        for view, start, end in self._records(name): pass
+        if end < os.path.getsize(self._path(name)):
+            with open(self._path(name), 'r+b') as f: f.truncate(end)
+
+    def _write_snapshot(self, height, ledger):
+        '''writes every balance in ledger to snapshot-<height>.bin (atomically, via a temp file), keeping the previous
+        snapshot in case this one is lost'''
+        items = list(ledger.balances())
+        parts = [_SNAPSHOT_HEADER.pack(height), _varint(len(items))]
+        for user, balance in items:
+            parts.append(_encode_value(user))
+            parts.append(_encode_value(balance))
+
+        name = f'snapshot-{height:012d}.bin'
+        tmp = self._path(name + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(parts))
+            if self._fsync != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, self._path(name))
+
+        self._snapshots.append(name)
+        for old in self._snapshots[:-2]: os.remove(self._path(old))
+        self._snapshots = self._snapshots[-2:]
+        self._snapshot_height = height
+
+    def _read_snapshot(self):
+        '''returns (height, {user: balance}) from the newest snapshot, or (0, {}) if there is none'''
+        if not self._snapshots: return 0, {}
+        with open(self._path(self._snapshots[-1]), 'rb') as f: data = f.read()
+        height = _SNAPSHOT_HEADER.unpack_from(data)[0]
+        count, pos = _read_varint(data, _SNAPSHOT_HEADER.size)
+        balances = {}
+        for i in range(count):
+            user, pos = _decode_value(data, pos)
+            balances[user], pos = _decode_value(data, pos)
+        return height, balances
@@ -0,0 +1,252 @@
+'''Versioned binary codec for Transactions and Blocks, for the wire and for storage. a block is a version byte, then
+three length prefixed sections: the header (prev hash, Merkle root, proof of work fields and the state root if the
+block has one), a dictionary of the block's users (each one stored once), and the transactions as varint user indexes
+into the dictionary and varint amounts. BlockView reads one straight out of a memoryview w/o copying it: the header fields and pow_hash() only touch
+the header section, and the users and Transactions are only decoded when asked for'''
+from hashlib import sha256
+import struct
+
+from blockchain import Block, Transaction, _varint, _read_varint, _encode_value, _decode_value, _HEADER_TAIL
+
+VERSION = 1
+_NONCE = struct.Struct('<Q')
+_FLOAT = struct.Struct('<d')
+_NAMES, _VALUES = 0, 1      # kinds of user dictionary
+
+_SMALL = [bytes((i,)) if i < 0x80 else bytes(((i & 0x7f) | 0x80, i >> 7)) for i in range(16384)]  # 1-2 byte varints
+
+def _zigzag(n):
+    '''maps ints to non-negative ints so small negative amounts stay small varints: 0, -1, 1, -2 ... -> 0, 1, 2, 3 ...'''
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+def _encode_amount(amount):
+    '''varint of the zigzagged int shifted left once (low bit 0), or a varint 1 then 8 bytes for a float'''
+    if isinstance(amount, float): return b'\x01' + _FLOAT.pack(amount)
+    return _varint(_zigzag(int(amount)) << 1)
+
+def _read_amount(buf, pos):
+    '''decodes an amount written by _encode_amount. returns (amount, position after it)'''
+    n = buf[pos]
+    if n < 0x80: pos += 1     #1 byte varint, by far the most common
+    else: n, pos = _read_varint(buf, pos)
+    if n == 1: return _FLOAT.unpack_from(buf, pos)[0], pos + 8
+    n >>= 1
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+def _read_index(buf, pos):
+    '''decodes a varint user index, w the 1 byte case inline. returns (index, position after it)'''
+    n = buf[pos]
+    if n < 0x80: return n, pos + 1
+    return _read_varint(buf, pos)
+
+def _section(buf, pos):
+    '''returns (start, end) of the length prefixed section at pos. raises ValueError if it runs past the end of buf'''
+    length, start = _read_varint(buf, pos)
+    if start + length > len(buf): raise ValueError(f'section at {pos} runs past the end of the buffer')
+    return start, start + length
+
+def _encode_users(users):
+    '''a block's dictionary: varint count, then a kind byte. _NAMES (every user is a str under 128 characters): one 
+    byte of length (in characters) per user, then all of them as one UTF-8 string. _VALUES: each user tagged and 
+    length prefixed like in Transaction.encode'''
+    if all(user.__class__ is str and len(user) < 128 for user in users):
+        return b''.join((_varint(len(users)), bytes((_NAMES,)), bytes(map(len, users)), ''.join(users).encode()))
+    return b''.join((_varint(len(users)), bytes((_VALUES,)), *map(_encode_value, users)))
+
+def _decode_users(buf, start, end):
+    '''decodes a dictionary written by _encode_users from buf[start:end]'''
+    count, pos = _read_varint(buf, start)
+    kind, pos = buf[pos], pos + 1
+    if kind == _NAMES:
+        text = bytes(buf[pos+count:end]).decode()
+        users, at = [], 0
+        for length in buf[pos:pos+count]:
+            users.append(text[at:at+length])
+            at += length
+        return users
+    if kind != _VALUES: raise ValueError(f'unknown user dictionary kind {kind}')
+    users = []
+    for i in range(count):
+        user, pos = _decode_value(buf, pos)
+        users.append(user)
+    return users
+
+def encode_transaction(trans):
+    '''version byte, then from_user and to_user (tagged and length prefixed) and the varint amount'''
+    return bytes((VERSION,)) + _encode_value(trans.from_user) + _encode_value(trans.to_user) + _encode_amount(trans.amount)
+
+def decode_transaction(buf):
+    '''rebuilds a Transaction from bytes made by encode_transaction'''
+    if buf[0] != VERSION: raise ValueError(f'unsupported codec version {buf[0]}')
+    from_user, pos = _decode_value(buf, 1)
+    to_user, pos = _decode_value(buf, pos)
+    return Transaction(from_user, to_user, _read_amount(buf, pos)[0])
+
+def encode_block(block):
+    '''encodes a Block (or ColumnarBlock), proof of work fields, Merkle root and state root included'''
+    prev = block._previous_block_hash or b''
+    header = b''.join((_varint(len(prev)), prev, block.digest(), _HEADER_TAIL.pack(block._timestamp, block._difficulty),
+                       block._state_root or b'', _NONCE.pack(block._nonce)))
+    index = {}      # user -> position in the block's dictionary
+    small = _SMALL
+    parts = []
+    append = parts.append
+    for trans in block:
+        for user in (trans.from_user, trans.to_user):
+            idx = index.get(user)
+            if idx is None: idx = index[user] = len(index)
+            append(small[idx] if idx < 16384 else _varint(idx))
+        amount = trans.amount
+        if amount.__class__ is int and 0 <= amount < 4096: append(small[amount << 2])  #zigzag << 1 of a small amount
+        else: append(_encode_amount(amount))
+    body = b''.join(parts)
+    users = _encode_users(list(index))
+    return b''.join((bytes((VERSION,)), _varint(len(header)), header, _varint(len(users)), users,
+                     _varint(len(block)), _varint(len(body)), body))
+
+def decode_block(buf, block_cls=Block, verify=False):
+    '''rebuilds a block (as block_cls) from bytes made by encode_block. verify=True also checks the transactions
+    against the Merkle root in the header, and raises ValueError if they don't match'''
+    view = BlockView(buf)
+    if verify and not view.verify(): raise ValueError('transactions do not match the Merkle root in the header')
+    return view.to_block(block_cls)
+
+class BlockView():
+    '''Lazy, zero-copy view of an encoded block in buf (bytes, bytearray, mmap or memoryview). only the section
+    boundaries are read up front'''
+    __slots__ = ('_buf', '_header', '_users_at', '_body', '_count', '_users', '_offsets')
+
+    def __init__(self, buf):
+        '''finds the sections. raises ValueError for another codec version or a truncated block'''
+        buf = memoryview(buf)
+        if not len(buf): raise ValueError('empty buffer')
+        if buf[0] != VERSION: raise ValueError(f'unsupported codec version {buf[0]}')
+        try:
+            self._header = _section(buf, 1)
+            self._users_at = _section(buf, self._header[1])
+            self._count, pos = _read_varint(buf, self._users_at[1])
+            self._body = _section(buf, pos)
+        except IndexError:
+            raise ValueError('truncated block') from None
+        self._buf = buf
+        self._users = None      # decoded dictionary, on first use
+        self._offsets = None    # start of each transaction in the body, on first random access
+
+    def __repr__(self):
+        '''simple print statement w the number of transactions and the header hash'''
+        return f'BlockView({self._count} transactions, pow_hash={self.pow_hash().hex()[:16]})'
+
+    def __len__(self):
+        '''returns how many Transactions are in the block'''
+        return self._count
+
+    def _header_fields(self):
+        '''returns (prev hash or None, position of the Merkle root) from the header section'''
+        n, pos = _read_varint(self._buf, self._header[0])
+        return (self._buf[pos:pos+n].tobytes() if n else None), pos + n
+
+    @property
+    def previous_block_hash(self):
+        '''header hash of the previous block (None for the genesis block)'''
+        return self._header_fields()[0]
+
+    @property
+    def merkle_root(self):
+        '''Merkle root of the block's transactions, as stored in the header'''
+        pos = self._header_fields()[1]
+        return self._buf[pos:pos+32].tobytes()
+
+    @property
+    def timestamp(self):
+        '''proof of work timestamp'''
+        return _HEADER_TAIL.unpack_from(self._buf, self._header_fields()[1] + 32)[0]
+
+    @property
+    def difficulty(self):
+        '''proof of work difficulty in bits'''
+        return _HEADER_TAIL.unpack_from(self._buf, self._header_fields()[1] + 32)[1]
+
+    @property
+    def state_root(self):
+        '''ledger state root committed in the header, or None if the block has none'''
+        pos = self._header_fields()[1] + 32 + _HEADER_TAIL.size
+        end = self._header[1] - _NONCE.size
+        return self._buf[pos:end].tobytes() if end > pos else None
+
+    @property
+    def nonce(self):
+        '''proof of work nonce'''
+        return _NONCE.unpack_from(self._buf, self._header[1] - _NONCE.size)[0]
+
+    def header_prefix(self):
+        '''same bytes as Block.header_prefix, straight from the header section'''
+        prev, pos = self._header_fields()
+        return (prev or bytes(32)) + self._buf[pos:self._header[1] - _NONCE.size].tobytes()
+
+    def pow_hash(self):
+        '''same as Block.pow_hash, w/o decoding any transactions'''
+        start, end = self._header
+        prev, pos = self._header_fields()
+        h = sha256(prev or bytes(32))
+        h.update(self._buf[pos:end])    #Merkle root, timestamp, difficulty, state root and nonce
+        return h.digest()
+
+    def users(self):
+        '''list of the users in the block's dictionary, in order of first appearance'''
+        if self._users is None: self._users = _decode_users(self._buf, *self._users_at)
+        return self._users
+
+    def rows(self):
+        '''lazily yields (from_user, to_user, amount) for every transaction w/o making Transaction objects'''
+        buf, users = self._buf, self.users()
+        pos = self._body[0]
+        for i in range(self._count):    #_read_index and _read_amount inlined for the 1 and 2 byte cases
+            n = buf[pos]
+            if n < 0x80: frm, pos = users[n], pos + 1
+            elif buf[pos+1] < 0x80: frm, pos = users[(n & 0x7f) | buf[pos+1] << 7], pos + 2
+            else:
+                n, pos = _read_varint(buf, pos)
+                frm = users[n]
+            n = buf[pos]
+            if n < 0x80: to, pos = users[n], pos + 1
+            elif buf[pos+1] < 0x80: to, pos = users[(n & 0x7f) | buf[pos+1] << 7], pos + 2
+            else:
+                n, pos = _read_varint(buf, pos)
+                to = users[n]
+            amount, pos = _read_amount(buf, pos)
+            yield frm, to, amount
+
+    def __iter__(self):
+        '''yields a new Transaction for each transaction in the block'''
+        for frm, to, amount in self.rows(): yield Transaction(frm, to, amount)
+
+    def __getitem__(self, i):
+        '''returns a new Transaction for the transaction at position i. the first call finds where every transaction
+        starts (one pass over the body w/o decoding amounts into objects)'''
+        if i < 0: i += self._count
+        if not 0 <= i < self._count: raise IndexError(f'transaction index {i} out of range')
+        if self._offsets is None: self._offsets = self._find_offsets()
+        buf, users = self._buf, self.users()
+        frm, pos = _read_index(buf, self._offsets[i])
+        to, pos = _read_index(buf, pos)
+        return Transaction(users[frm], users[to], _read_amount(buf, pos)[0])
+
+    def _find_offsets(self):
+        '''returns the start of every transaction in the body'''
+        buf, pos = self._buf, self._body[0]
+        offsets = []
+        for i in range(self._count):
+            offsets.append(pos)
+            pos = _read_index(buf, _read_index(buf, pos)[1])[1]
+            pos = _read_amount(buf, pos)[1]
+        return offsets
+
+    def verify(self):
+        '''True if the transactions hash to the Merkle root in the header'''
+        return Block(self).digest() == self.merkle_root
+
+    def to_block(self, block_cls=Block):
+        '''decodes the whole block into a block_cls, w its proof of work fields. like a block reloaded from a ChainLog,
+        its Merkle root is only computed when digest() is first called'''
+        return block_cls._restore(self, self.previous_block_hash, self.nonce, self.timestamp, self.difficulty,
+                                  self.state_root)
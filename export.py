@@ -0,0 +1,74 @@
+'''Streaming exporters for (height, position, Transaction) rows, ie: from Blockchain.iter_transactions. rows are
+formatted into a buffer that is written out every chunk_size bytes, so memory stays the same however long the chain is.
+each exporter returns the number of bytes (or characters, for text files) written'''
+import csv
+import io
+import json
+import struct
+
+from blockchain import Transaction, _varint, _read_varint
+
+CSV_HEADER = ('height', 'position', 'from_user', 'to_user', 'amount')
+
+def export_csv(rows, f, chunk_size=1 << 16):
+    '''writes rows to text file f as CSV w a CSV_HEADER line'''
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(CSV_HEADER)
+    written = 0
+    for height, pos, trans in rows:
+        writer.writerow((height, pos, trans.from_user, trans.to_user, trans.amount))
+        if buf.tell() >= chunk_size:
+            written += f.write(buf.getvalue())
+            buf.seek(0)
+            buf.truncate()
+    return written + f.write(buf.getvalue())
+
+def export_jsonl(rows, f, chunk_size=1 << 16):
+    '''writes rows to text file f as JSON Lines: one {"height", "position", "from", "to", "amount"} object per line'''
+    parts, size, written = [], 0, 0
+    dumps = json.dumps
+    for height, pos, trans in rows:
+        line = dumps({'height': height, 'position': pos, 'from': trans.from_user, 'to': trans.to_user,
+                      'amount': trans.amount}) + '\n'
+        parts.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            written += f.write(''.join(parts))
+            parts, size = [], 0
+    return written + f.write(''.join(parts))
+
+def export_binary(rows, f, chunk_size=1 << 16):
+    '''writes rows to binary file f as records of varint height, varint position and Transaction.encode()'''
+    buf, written = bytearray(), 0
+    for height, pos, trans in rows:
+        buf += _varint(height)
+        buf += _varint(pos)
+        buf += trans.encode()
+        if len(buf) >= chunk_size:
+            written += f.write(buf)
+            buf.clear()
+    return written + f.write(buf)
+
+def read_binary(f, chunk_size=1 << 16):
+    '''lazily yields (height, position, Transaction) rows back from a binary file made by export_binary, reading it
+    chunk_size bytes at a time'''
+    buf = b''
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        pos = 0
+        while True:     #decodes every complete record in buf
+            try:
+                height, end = _read_varint(buf, pos)
+                position, end = _read_varint(buf, end)
+                trans, end = Transaction.decode(buf, end)
+            except (IndexError, ValueError, struct.error):
+                break   #record continues in the next chunk
+            if end > len(buf): break    #a value was cut short: same thing
+            yield height, position, trans
+            pos = end
+        buf = buf[pos:]
+        if not chunk:
+            if buf: raise ValueError(f'{len(buf)} bytes of a partial record at the end of the file')
+            return
@@ -10,57 +10,123 @@ class Entry:
         return f"Entry(key={self.key}, value={self.value})"
 
 class HashMapping:
-    '''each Hashmapping hold a collection of Entry objects. rehashes when len of self if 2x the size of the num of buckets'''
-    def __init__(self):
-        '''inits bass num of buckets as 8, inits a len and 8 empty buckets in _L'''
-        self._num_buckets = 8                            #init number of buckets
+    '''each Hashmapping hold a collection of Entry objects. rehashes when len of self is load_factor (default 2) times 
+    the num of buckets. capacity pre-sizes the buckets for that many keys. w incremental=True growing doesn't rebuild 
+    every bucket at once: the old and new lists of buckets are kept side by side and every operation moves the next 
+    few old buckets over, so no single insert pays for the whole O(n) rehash'''
+    _MIGRATE_STEP = 2   #old buckets moved per operation while an incremental rehash is going on
+
+    def __init__(self, load_factor=2, capacity=0, incremental=False):
+        '''inits bass num of buckets as 8 (or the power of 2 that fits capacity keys), inits a len and empty buckets in _L'''
+        if load_factor <= 0: raise ValueError(f'load_factor {load_factor} must be positive!')
+        if capacity < 0: raise ValueError(f'capacity {capacity} must not be negative!')
+        self._load_factor = load_factor                  #avg entries per bucket before rehashing
+        self._num_buckets = self._fit(capacity)          #init number of buckets
         self._len = 0                                    #init len
         self._L = [[] for i in range(self._num_buckets)] # list of buckets
+        self._incremental = incremental
+        self._old = None        #old list of buckets while an incremental rehash is going on
+        self._moved = 0         #old buckets before this one have been moved into _L
 
     def __repr__(self):
         '''simple print statement to print each value pair and their bucket, along w the empty buckets'''
-        return f'{self._L}'
+        return f'{self._L}' if self._old is None else f'{self._old} -> {self._L}'
 
     def __len__(self):
         '''returns how many Entries there are'''
         return self._len
 
+    def __iter__(self):
+        '''iterates thru every key in the HashMapping'''
+        for key, value in self.items(): yield key
+
     def __contains__(self, key):
         '''Returns True (False) if key is (is not) in HashMapping'''
-        idx = self._get_bucket(key) # find bucket
-
-        for entry in self._L[idx]: # scan bucket, return if key is found
+        for entry in self._bucket(key): # scan bucket, return if key is found
             if entry.key == key: return True
 
         return False    # not found- return false
 
     def __setitem__(self, key, value):
         '''Adds key:value pair to HashMapping, or updates hashmap[key] if it already exists'''
-        idx = self._get_bucket(key) #finds index (which bucket the key should be in)
+        bucket = self._bucket(key)  #finds which bucket the key should be in
 
-        for entry in self._L[idx]:  #scans thru bucket
+        for entry in bucket:        #scans thru bucket
             if entry.key == key:    #if entry is in bucket, val is updated
                 entry.value = value
                 return  #returns to skip the rest of the function if val is updated
             
         #if key not found...
-        self._L[idx].append(Entry(key, value))
+        bucket.append(Entry(key, value))
         self._len += 1
 
-        if len(self) > 2*self._num_buckets: self._rehash(2*self._num_buckets)   #rehash if needed!
+        if len(self) > self._load_factor*self._num_buckets: self._grow()   #rehash if needed!
 
     def __getitem__(self, key):
         '''Returns value associated with key. Raises KeyError if key not in HashMapping'''
-        idx = self._get_bucket(key) #finds index (which bucket the key should be in)
-
-        for entry in self._L[idx]:  #scans thru bucket
+        for entry in self._bucket(key):  #scans thru bucket
             if entry.key == key: return entry.value #if key is found, return associated val
         
         return False #return false if key not found
+
+    def __delitem__(self, key):
+        '''Removes key from HashMapping. Raises KeyError if key not in HashMapping'''
+        bucket = self._bucket(key)
+
+        for i, entry in enumerate(bucket):
+            if entry.key == key:
+                bucket.pop(i)
+                self._len -= 1
+                return
+
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        '''Returns value associated with key, or default if key not in HashMapping (one bucket scan)'''
+        for entry in self._bucket(key):
+            if entry.key == key: return entry.value
+        return default
+
+    def items(self):
+        '''iterates thru every (key, value) pair in the HashMapping'''
+        buckets = self._L if self._old is None else self._old + self._L
+        for bucket in buckets:
+            if bucket is None: continue     #an old bucket that moved, or a new one that is not made yet
+            for entry in bucket: yield entry.key, entry.value
+
+    def shrink(self):
+        '''rehashes down to the fewest buckets (a power of 2, at least 8) that hold len of self at the load factor, 
+        ie: after deleting most of the keys. finishes an incremental rehash first'''
+        self._finish()
+        new_buckets = self._fit(self._len)
+        if new_buckets < self._num_buckets: self._rehash(new_buckets)
     
+    def _fit(self, capacity):
+        '''Returns the num of buckets (a power of 2, at least 8) for capacity keys'''
+        num_buckets = 8
+        while capacity > self._load_factor*num_buckets: num_buckets *= 2
+        return num_buckets
+
     def _get_bucket(self, key):
         '''Returns index of bucket key should be in'''
         return hash(key) % self._num_buckets
+
+    def _bucket(self, key):
+        '''Returns the bucket key should be in. while an incremental rehash is going on, moves the next few old 
+        buckets over first, and a key whose old bucket has not been moved yet is still in it'''
+        if self._old is None: return self._L[hash(key) % self._num_buckets]
+        self._migrate(self._MIGRATE_STEP)
+        h = hash(key)
+        if self._old is not None:
+            idx = h % len(self._old)
+            if idx >= self._moved: return self._old[idx]
+        return self._L[h % self._num_buckets]
+
+    def _grow(self):
+        '''doubles the num of buckets, all at once or (incremental) by starting an incremental rehash'''
+        if not self._incremental: return self._rehash(2*self._num_buckets)
+        self._finish()      #only happens if the last one could not keep up (load_factor under 1)
+        self._start_rehash(2*self._num_buckets)
     
     def _rehash(self, new_buckets):
         '''Rehashes to amount of new_buckets'''
@@ -73,3 +139,147 @@ class HashMapping:
                 new_L[idx].append(entry)    #add it to new_L
 
         self._L = new_L # update self._L to new list
+
+    def _start_rehash(self, new_buckets):
+        '''starts an incremental rehash to new_buckets (twice the old num). old bucket i only ever moves into new 
+        buckets i and i + old num, so a new bucket is made when its old bucket moves (until then it is None): the only 
+        up front cost is one list of new_buckets Nones'''
+        self._old, self._moved = self._L, 0
+        self._L = [None] * new_buckets
+        self._num_buckets = new_buckets
+
+    def _migrate(self, count):
+        '''moves the next count old buckets into _L, and ends the incremental rehash after the last one'''
+        old, new_L, num_buckets = self._old, self._L, self._num_buckets
+        size = len(old)
+        stop = min(self._moved + count, size)
+        for i in range(self._moved, stop):
+            low, high = [], []
+            for entry in old[i]:
+                (low if hash(entry.key) % num_buckets == i else high).append(entry)
+            new_L[i], new_L[i + size] = low, high
+            old[i] = None   #lets the entries' old bucket go
+        self._moved = stop
+        if stop == size: self._old = None
+
+    def _finish(self):
+        '''moves every old bucket that is left, if an incremental rehash is going on'''
+        if self._old is not None: self._migrate(len(self._old))
+
+_EMPTY = object()   #marks an unused slot in OpenHashMapping
+
+class OpenHashMapping:
+    '''Same API as HashMapping, but stored as three parallel lists (keys, cached hashes, values) with linear probing 
+    instead of a list of Entry objects per bucket. no per-entry objects, and the cached hashes mean growing never 
+    calls hash() again. resizes when len of self is more than load_factor of the num of slots'''
+    def __init__(self, load_factor=0.6):
+        '''inits 8 empty slots. load_factor must be between 0 and 1 since every key needs its own slot'''
+        if not 0 < load_factor < 1: raise ValueError(f'load_factor {load_factor} must be between 0 and 1!')
+        self._load_factor = load_factor
+        self._len = 0
+        self._alloc(8)
+
+    def __repr__(self):
+        '''simple print statement to print each key:value pair'''
+        return '{' + ', '.join(f'{k}: {v}' for k, v in self.items()) + '}'
+
+    def __len__(self):
+        '''returns how many keys there are'''
+        return self._len
+
+    def __iter__(self):
+        '''iterates thru every key in the OpenHashMapping'''
+        for key in self._keys:
+            if key is not _EMPTY: yield key
+
+    def __contains__(self, key):
+        '''Returns True (False) if key is (is not) in OpenHashMapping'''
+        return self._find(key) >= 0
+
+    def __setitem__(self, key, value):
+        '''Adds key:value pair, or updates the value if key already exists'''
+        h = hash(key)
+        mask, keys, hashes = self._mask, self._keys, self._hashes
+        i = h & mask
+        while True:     #probe until the key or an empty slot is found
+            k = keys[i]
+            if k is _EMPTY: break
+            if hashes[i] == h and (k is key or k == key):
+                self._values[i] = value     #key found- update val
+                return
+            i = (i + 1) & mask
+
+        #key not found, i is the first empty slot in its probe sequence
+        keys[i] = key
+        hashes[i] = h
+        self._values[i] = value
+        self._len += 1
+
+        if self._len > self._max_fill: self._resize(2*len(keys))    #resize if needed!
+
+    def __getitem__(self, key):
+        '''Returns value associated with key. returns False if key not in OpenHashMapping, same as HashMapping'''
+        i = self._find(key)
+        return self._values[i] if i >= 0 else False
+
+    def __delitem__(self, key):
+        '''Removes key. Raises KeyError if key not in OpenHashMapping. later entries in the probe run are shifted 
+        back into the hole so lookups never need tombstones'''
+        i = self._find(key)
+        if i < 0: raise KeyError(key)
+
+        mask, keys, hashes, values = self._mask, self._keys, self._hashes, self._values
+        j = i
+        while True:
+            j = (j + 1) & mask
+            if keys[j] is _EMPTY: break
+            home = hashes[j] & mask
+            #the entry at j can only move into the hole at i if its home slot is not cyclically in (i, j]
+            if (i < home <= j) if i <= j else (home > i or home <= j): continue
+            keys[i], hashes[i], values[i] = keys[j], hashes[j], values[j]
+            i = j
+
+        keys[i] = _EMPTY
+        values[i] = None
+        self._len -= 1
+
+    def get(self, key, default=None):
+        '''Returns value associated with key, or default if key not in OpenHashMapping'''
+        i = self._find(key)
+        return self._values[i] if i >= 0 else default
+
+    def items(self):
+        '''iterates thru every (key, value) pair'''
+        for key, value in zip(self._keys, self._values):
+            if key is not _EMPTY: yield key, value
+
+    def _find(self, key):
+        '''Returns index of the slot holding key, or -1 if key is not in OpenHashMapping'''
+        h = hash(key)
+        mask, keys, hashes = self._mask, self._keys, self._hashes
+        i = h & mask
+        while True:
+            k = keys[i]
+            if k is _EMPTY: return -1
+            if hashes[i] == h and (k is key or k == key): return i
+            i = (i + 1) & mask
+
+    def _alloc(self, num_slots):
+        '''replaces the parallel lists with num_slots empty slots (num_slots must be a power of 2)'''
+        self._mask = num_slots - 1
+        self._keys = [_EMPTY] * num_slots
+        self._hashes = [0] * num_slots
+        self._values = [None] * num_slots
+        self._max_fill = int(num_slots * self._load_factor)
+
+    def _resize(self, num_slots):
+        '''Moves every key to a table of num_slots slots, reusing the cached hashes'''
+        old = zip(self._keys, self._hashes, self._values)
+        self._alloc(num_slots)
+        mask, keys, hashes, values = self._mask, self._keys, self._hashes, self._values
+
+        for key, h, value in old:
+            if key is _EMPTY: continue
+            i = h & mask
+            while keys[i] is not _EMPTY: i = (i + 1) & mask
+            keys[i], hashes[i], values[i] = key, h, value
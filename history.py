@@ -0,0 +1,106 @@
+'''Ledger history for a Blockchain: an immutable checkpoint of every balance each `interval` blocks, plus each block's
+reversible balance changes. a historical balance is read from the nearest checkpoint at or below the height and the
+(at most interval) change records after it, and rolling back undoes blocks from the tip w their change records'''
+
+_NUM_SHARDS = 256   # checkpoints split accounts into this many dicts, so a new checkpoint only copies the changed ones
+
+def _shard(user):
+    '''returns which checkpoint shard user is in'''
+    return hash(user) % _NUM_SHARDS
+
+class LedgerHistory():
+    '''Keeps checkpoints and per-block change records for a Blockchain, starting at the chain's current height.
+    heights count blocks: height h is the ledger right after the first h blocks (the genesis block is height 1)'''
+    def __init__(self, chain, interval=1000, max_checkpoints=None):
+        '''takes the first checkpoint from chain's current ledger and starts listening for new blocks. max_checkpoints
+        limits how many checkpoints are kept: history before the oldest kept one is dropped'''
+        if interval < 1: raise ValueError(f'interval {interval} must be at least 1!')
+        self._chain = chain
+        self._interval = interval
+        self._max_checkpoints = max_checkpoints
+        self._base = len(chain._blockchain)    # height of the oldest checkpoint still kept
+        self._changes = []      # _changes[i] is {user: (balance before, balance after)} for the block at height _base+i+1
+
+        shards = [{} for i in range(_NUM_SHARDS)]
+        for user, balance in chain._bc_ledger.balances(): shards[_shard(user)][user] = balance
+        self._checkpoints = {self._base: tuple(shards)}     # height -> tuple of shard dicts, never modified
+        chain.add_listener(self)
+
+    def __repr__(self):
+        '''simple print statement w the height range and number of checkpoints'''
+        return f'LedgerHistory(heights {self._base}-{self.height}, {len(self._checkpoints)} checkpoints)'
+
+    @property
+    def height(self):
+        '''height of the newest block recorded'''
+        return self._base + len(self._changes)
+
+    def block_added(self, chain, block, changes):
+        '''listener hook called by Blockchain: records the block's changes and takes a checkpoint every interval blocks'''
+        self._changes.append(changes)
+        if (self.height - self._base) % self._interval == 0: self._checkpoint()
+
+    def block_removed(self, chain, block, changes):
+        '''listener hook called by Blockchain when the newest block is undone (ie: by a reorg): forgets its changes and
+        any checkpoint taken right after it'''
+        if self.height == self._base: raise ValueError(f'cannot undo height {self.height}: it is the oldest checkpoint')
+        self._checkpoints.pop(self.height, None)
+        self._changes.pop()
+
+    def balance_at(self, user, height):
+        '''returns user's balance right after the block at height (None if the account did not exist yet). reads the
+        nearest checkpoint at or below height plus at most interval change records'''
+        self._check_height(height)
+        for i in range(height - self._base - 1, self._floor(height) - self._base - 1, -1):  #newest change wins
+            change = self._changes[i].get(user)
+            if change is not None: return change[1]
+        return self._checkpoints[self._floor(height)][_shard(user)].get(user)
+
+    def balances_at(self, height):
+        '''returns a dict of every balance right after the block at height'''
+        self._check_height(height)
+        floor = self._floor(height)
+        balances = {}
+        for shard in self._checkpoints[floor]: balances.update(shard)
+        for changes in self._changes[floor - self._base:height - self._base]:
+            for user, (old, new) in changes.items(): balances[user] = new
+        return balances
+
+    def rollback(self, height):
+        '''undoes every block above height, newest first, thru Blockchain._unlink: each one restores the balances it
+        touched (removing accounts it created) and every listener is told thru block_removed, this one included, which
+        forgets the block's history. costs O(blocks undone)'''
+        self._check_height(height)
+        chain = self._chain
+        if chain._log is not None: raise ValueError('cannot roll back a Blockchain that has a ChainLog')
+        while self.height > height: chain._unlink(self._changes[-1])
+
+    def _floor(self, height):
+        '''height of the newest checkpoint at or below height'''
+        return height - (height - self._base) % self._interval
+
+    def _check_height(self, height):
+        '''raises ValueError if height is outside of the recorded history'''
+        if not self._base <= height <= self.height:
+            raise ValueError(f'height {height} is outside of the recorded history ({self._base}-{self.height})')
+
+    def _checkpoint(self):
+        '''makes a checkpoint at the current height from the previous one, copying only the shards w changed accounts
+        and sharing the rest'''
+        prev = self._checkpoints[self.height - self._interval]
+        shards = list(prev)
+        copied = set()
+        for changes in self._changes[-self._interval:]:
+            for user, (old, new) in changes.items():
+                idx = _shard(user)
+                if idx not in copied:
+                    shards[idx] = dict(prev[idx])
+                    copied.add(idx)
+                shards[idx][user] = new
+        self._checkpoints[self.height] = tuple(shards)
+
+        if self._max_checkpoints is not None and len(self._checkpoints) > self._max_checkpoints:
+            oldest = self._base
+            del self._checkpoints[oldest]
+            self._base = oldest + self._interval
+            del self._changes[:self._interval]
@@ -0,0 +1,431 @@
+'''Light clients and the full node side that serves them. a LightClient keeps only block headers (81 bytes each, 113
+w a state root), follows the branch w the most work and checks that they link up and carry the proof of work the
+chain requires. a FullNode follows a Blockchain and serves
+two kinds of proofs against those headers: Merkle inclusion proofs that a Transaction is in a block (the sibling hashes
+on the path from its leaf to the block's Merkle root), and balance proofs against the ledger state root a block commits
+to in its header (Blockchain.mine asks the FullNode for it before searching for the nonce, so the proof of work covers
+it). the state root is the root of a compact sparse Merkle tree over sha256(user): a subtree w one account in it is just
+that account's leaf, so the tree is only about log2(accounts) deep. both kinds of proof are O(log n) hashes to check'''
+from collections import OrderedDict
+from hashlib import sha256
+import struct
+
+from blockchain import (Block, Blockchain, Transaction, retarget, _merkle_node, _encode_value, _target, _HEADER_TAIL,
+                        _EMPTY_ROOT)
+
+_EMPTY = bytes(32)      # hash of an empty subtree of the state tree
+_HEADER = struct.Struct('<32s32sdBQ')   # prev header hash, Merkle root, timestamp, difficulty, nonce (+ the state root, if any)
+
+def merkle_levels(block):
+    '''every level of block's transaction Merkle tree, leaves first: an odd node out is paired w itself, which gives
+    the same root as Block.digest()'''
+    level = [trans.digest() for trans in block]
+    levels = [level]
+    while len(level) > 1:
+        if len(level) & 1: level = level + [level[-1]]
+        level = [_merkle_node(level[i], level[i+1]) for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+def merkle_proof(levels, pos):
+    '''sibling hashes on the path from leaf pos to the root, from merkle_levels'''
+    siblings = []
+    for level in levels[:-1]:
+        sib = pos ^ 1
+        siblings.append(level[sib] if sib < len(level) else level[pos])
+        pos >>= 1
+    return siblings
+
+def verify_merkle_proof(leaf, pos, siblings, root):
+    '''True if leaf (a Transaction digest) is at position pos of the Merkle tree w that root. like Bitcoin's, the
+    tree pairs an odd node out w itself, so the last leaf's proof also checks out one position past the end: it
+    proves the transaction is in the block, and its position only up to that'''
+    node = leaf
+    for sib in siblings:
+        node = _merkle_node(sib, node) if pos & 1 else _merkle_node(node, sib)
+        pos >>= 1
+    return pos == 0 and node == root
+
+def _account_key(user):
+    '''path of user's account in the state tree: 32 bytes and the same bits as an int'''
+    key = sha256(_encode_value(user)).digest()
+    return key, int.from_bytes(key, 'big')
+
+def _leaf_hash(key, balance):
+    '''hash of an account's leaf. leaves are prefixed w 0x02 and inner nodes w 0x03, apart from the Merkle tree's'''
+    return sha256(b'\x02' + key + _encode_value(balance)).digest()
+
+def _bit(kint, depth):
+    '''the bit of a key that picks the child at depth (0: left)'''
+    return (kint >> (255 - depth)) & 1
+
+class _Leaf():
+    '''one account in the state tree'''
+    __slots__ = ('key', 'kint', 'balance', 'hash')
+
+    def __init__(self, key, kint, balance):
+        '''inits the leaf w its hash not computed yet'''
+        self.key, self.kint, self.balance, self.hash = key, kint, balance, None
+
+class _Inner():
+    '''inner node of the state tree. always has at least 2 accounts below it'''
+    __slots__ = ('left', 'right', 'hash')
+
+    def __init__(self, left, right):
+        '''inits the node w its hash not computed yet'''
+        self.left, self.right, self.hash = left, right, None
+
+def _split(a, b, depth):
+    '''smallest subtree holding leaves a and b (different keys) that starts at depth'''
+    bit_a = _bit(a.kint, depth)
+    if bit_a == _bit(b.kint, depth):
+        child = _split(a, b, depth + 1)
+        return _Inner(None, child) if bit_a else _Inner(child, None)
+    return _Inner(b, a) if bit_a else _Inner(a, b)
+
+def _insert(node, leaf, depth):
+    '''sets leaf's account in the subtree node starting at depth. returns (new subtree, True if the account is new)'''
+    if node is None: return leaf, True
+    if node.__class__ is _Leaf:
+        if node.kint != leaf.kint: return _split(node, leaf, depth), True
+        node.balance, node.hash = leaf.balance, None
+        return node, False
+    node.hash = None
+    if _bit(leaf.kint, depth): node.right, added = _insert(node.right, leaf, depth + 1)
+    else: node.left, added = _insert(node.left, leaf, depth + 1)
+    return node, added
+
+def _delete(node, kint, depth):
+    '''removes the account at kint from the subtree node starting at depth. an inner node left w a single leaf below
+    it collapses into that leaf. returns (new subtree, True if the account was there)'''
+    if node is None: return None, False
+    if node.__class__ is _Leaf: return (None, True) if node.kint == kint else (node, False)
+    if _bit(kint, depth): node.right, removed = _delete(node.right, kint, depth + 1)
+    else: node.left, removed = _delete(node.left, kint, depth + 1)
+    if not removed: return node, False
+    node.hash = None
+    left, right = node.left, node.right
+    if left is None and (right is None or right.__class__ is _Leaf): return right, True
+    if right is None and left.__class__ is _Leaf: return left, True
+    return node, True
+
+def _hash(node):
+    '''hash of a subtree, computing only the ones changed since they were last hashed'''
+    if node is None: return _EMPTY
+    if node.hash is None:
+        if node.__class__ is _Leaf: node.hash = _leaf_hash(node.key, node.balance)
+        else: node.hash = sha256(b'\x03' + _hash(node.left) + _hash(node.right)).digest()
+    return node.hash
+
+class StateTree():
+    '''Compact sparse Merkle tree of account balances. updates only mark their path, and root() rehashes the marked
+    nodes once, so a block's changes share the hashing of the top of the tree'''
+    def __init__(self, balances=()):
+        '''inits the tree w the (user, balance) pairs in balances'''
+        self._root = None
+        self._len = 0
+        for user, balance in balances: self.update(user, balance)
+
+    def __repr__(self):
+        '''simple print statement w the number of accounts and the root'''
+        return f'StateTree({self._len} accounts, root={self.root().hex()[:16]})'
+
+    def __len__(self):
+        '''returns how many accounts are in the tree'''
+        return self._len
+
+    def update(self, user, balance):
+        '''sets user's balance, adding the account if it is new'''
+        key, kint = _account_key(user)
+        self._root, added = _insert(self._root, _Leaf(key, kint, balance), 0)
+        self._len += added
+
+    def remove(self, user):
+        '''removes user's account, if it is in the tree'''
+        self._root, removed = _delete(self._root, _account_key(user)[1], 0)
+        self._len -= removed
+
+    def root(self):
+        '''the state root (32 zero bytes for an empty tree)'''
+        return _hash(self._root)
+
+    def prove(self, user):
+        '''returns (balance or None, proof) for user, where proof is (sibling hashes from the root down, the leaf the
+        path ends at as (key, balance) or None). w a balance of None it proves the account is not in the tree'''
+        key, kint = _account_key(user)
+        node, siblings, depth = self._root, [], 0
+        while node is not None and node.__class__ is _Inner:
+            if _bit(kint, depth):
+                siblings.append(_hash(node.left))
+                node = node.right
+            else:
+                siblings.append(_hash(node.right))
+                node = node.left
+            depth += 1
+        if node is None: return None, (siblings, None)
+        return (node.balance if node.kint == kint else None), (siblings, (node.key, node.balance))
+
+def verify_balance(root, user, balance, proof):
+    '''True if proof (from StateTree.prove) shows user's balance is balance in the state tree w that root (or, w a
+    balance of None, that user has no account in it)'''
+    siblings, leaf = proof
+    key, kint = _account_key(user)
+    depth = len(siblings)
+    if balance is not None: node = _leaf_hash(key, balance)
+    elif leaf is None: node = _EMPTY
+    else:
+        other_key, other_balance = leaf
+        other = int.from_bytes(other_key, 'big')
+        if other == kint or (other ^ kint) >> (256 - depth): return False   #must be another account on the same path
+        node = _leaf_hash(other_key, other_balance)
+    for d in range(depth - 1, -1, -1):
+        sib = siblings[d]
+        node = sha256(b'\x03' + sib + node).digest() if _bit(kint, d) else sha256(b'\x03' + node + sib).digest()
+    return node == root
+
+class Header():
+    '''A block header. state_root is the ledger state root after the block if the block commits to one (None if not):
+    it is part of the hashed header, so it is covered by the proof of work'''
+    __slots__ = ('prev_hash', 'merkle_root', 'timestamp', 'difficulty', 'nonce', 'state_root')
+
+    def __init__(self, prev_hash, merkle_root, timestamp, difficulty, nonce, state_root):
+        '''inits the header fields'''
+        self.prev_hash, self.merkle_root, self.state_root = prev_hash, merkle_root, state_root
+        self.timestamp, self.difficulty, self.nonce = timestamp, difficulty, nonce
+
+    def __repr__(self):
+        '''simple print statement w the header hash'''
+        return f'Header(pow_hash={self.pow_hash().hex()[:16]})'
+
+    @classmethod
+    def from_block(cls, block):
+        '''the header of block'''
+        return cls(block._previous_block_hash, block.digest(), block._timestamp, block._difficulty, block._nonce,
+                   block._state_root)
+
+    def header_prefix(self):
+        '''same bytes as Block.header_prefix'''
+        return ((self.prev_hash or bytes(32)) + self.merkle_root + _HEADER_TAIL.pack(self.timestamp, self.difficulty)
+                + (self.state_root or b''))
+
+    def pow_hash(self):
+        '''same as Block.pow_hash'''
+        return sha256(self.header_prefix() + self.nonce.to_bytes(8, 'little')).digest()
+
+    def encode(self):
+        '''the header as _HEADER.size (81) bytes, plus 32 for the state root if it has one'''
+        return (_HEADER.pack(self.prev_hash or bytes(32), self.merkle_root, self.timestamp, self.difficulty, self.nonce)
+                + (self.state_root or b''))
+
+    @classmethod
+    def decode(cls, buf):
+        '''rebuilds a Header from bytes made by encode()'''
+        if len(buf) not in (_HEADER.size, _HEADER.size + 32): raise ValueError(f'a header is not {len(buf)} bytes')
+        prev, root, timestamp, difficulty, nonce = _HEADER.unpack_from(buf)
+        state_root = bytes(buf[_HEADER.size:]) or None
+        return cls(prev if prev != bytes(32) else None, root, timestamp, difficulty, nonce, state_root)
+
+class FullNode():
+    '''Serves headers and proofs for chain, which it follows as a listener, and fills in the state root of every block
+    chain mines. levels of the Merkle trees of the last cache_blocks blocks that proofs were asked for are kept, so
+    proofs from the same block don't rehash it. blocks added w/o a state root (or from before the node) can't have
+    balances proven against them, and a block that commits to a wrong one just makes the proofs at its height fail'''
+    def __init__(self, chain, index=None, cache_blocks=64):
+        '''replays chain's blocks into a StateTree for the state root of every height, then starts listening. index
+        (a chainindex.ChainIndex) makes prove_transaction a lookup instead of a scan'''
+        self._chain = chain
+        self._index = index
+        self._cache, self._cache_blocks = OrderedDict(), cache_blocks
+        self._state = StateTree()
+        self._state_roots = []  # state root after the block at height h, at h-1
+        balances = {}
+        for height, block in enumerate(chain._blockchain, 1):
+            touched = set()
+            for trans in block:
+                if height > 1:  #the genesis block only mints
+                    balances[trans.from_user] = balances.get(trans.from_user, 0) - trans.amount
+                    touched.add(trans.from_user)
+                balances[trans.to_user] = balances.get(trans.to_user, 0) + trans.amount
+                touched.add(trans.to_user)
+            for user in touched: self._state.update(user, balances[user])
+            self._state_roots.append(self._state.root())
+        chain.add_listener(self)
+
+    def __repr__(self):
+        '''simple print statement w the height and state root'''
+        return f'FullNode(height={len(self._state_roots)}, state_root={self._state.root().hex()[:16]})'
+
+    def commit_state(self, chain, block):
+        '''hook called by Blockchain.mine: sets block's state root to the one the ledger will have after it. the block's
+        balance changes are applied to the state tree (in block order, like Ledger.apply) and then put back'''
+        ledger, state = chain._bc_ledger, self._state
+        after = {}
+        for trans in block:
+            frm, to, amt = trans.from_user, trans.to_user, trans.amount
+            after[frm] = (after[frm] if frm in after else ledger.balance(frm) or 0) - amt
+            after[to] = (after[to] if to in after else ledger.balance(to) or 0) + amt
+        for user, balance in after.items(): state.update(user, balance)
+        block._state_root = state.root()
+        for user in after:
+            before = ledger.balance(user)
+            if before is None: state.remove(user)
+            else: state.update(user, before)
+
+    def block_added(self, chain, block, changes):
+        '''listener hook called by Blockchain: applies the block's balance changes to the state tree'''
+        for user, (before, after) in changes.items(): self._state.update(user, after)
+        self._state_roots.append(self._state.root())
+
+    def block_removed(self, chain, block, changes):
+        '''listener hook called by Blockchain when the newest block is undone: puts the balances back'''
+        for user, (before, after) in changes.items():
+            if before is None: self._state.remove(user)
+            else: self._state.update(user, before)
+        self._state_roots.pop()
+        self._cache.pop(block.digest(), None)
+
+    def state_root(self, height=None):
+        '''state root after the block at height (default: the last block)'''
+        return self._state_roots[(height or len(self._state_roots)) - 1]
+
+    def headers(self, start=1, stop=None):
+        '''Headers of the blocks from height start thru stop (default: the last block)'''
+        return [Header.from_block(block) for height, block in self._chain.iter_blocks(start, stop)]
+
+    def transaction_proof(self, height, pos):
+        '''Merkle proof (sibling hashes) for the transaction at position pos of the block at height'''
+        block = self._chain._blockchain[height - 1]
+        root = block.digest()
+        levels = self._cache.get(root)
+        if levels is None:
+            levels = self._cache[root] = merkle_levels(block)
+            if len(self._cache) > self._cache_blocks: self._cache.popitem(last=False)
+        else: self._cache.move_to_end(root)
+        if not 0 <= pos < len(levels[0]): raise IndexError(f'no transaction {pos} in the block at height {height}')
+        return merkle_proof(levels, pos)
+
+    def prove_transaction(self, trans):
+        '''returns (height, position, proof) of trans in the chain, or None if it is not in it'''
+        if self._index is not None: found = self._index.locate(trans)
+        else:
+            found = next(((h, p) for h, block in enumerate(self._chain._blockchain, 1)
+                          for p, t in enumerate(block) if t == trans), None)
+        if found is None: return None
+        return found[0], found[1], self.transaction_proof(*found)
+
+    def balance_proof(self, user):
+        '''returns (height, balance or None, proof) of user's balance after the last block'''
+        balance, proof = self._state.prove(user)
+        return len(self._state_roots), balance, proof
+
+class _Node():
+    '''one header in a LightClient's header tree, w the work of its branch and the difficulty its children need'''
+    __slots__ = ('header', 'parent', 'height', 'work', 'start', 'difficulty')
+
+    def __init__(self, header, parent, height=None, difficulty=None):
+        '''inits a node under parent, or (parent None) the checkpoint at height, whose children need difficulty. start
+        is the timestamp of the first header of the retarget interval (None if that is before the checkpoint)'''
+        interval = Blockchain._RETARGET_INTERVAL
+        self.header, self.parent = header, parent
+        if parent is None:
+            self.height, self.work, self.difficulty = height, 0, difficulty
+            self.start = header.timestamp if (height - 1) % interval == 0 else None
+            return
+        self.height = parent.height + 1
+        self.work = parent.work + 2**header.difficulty
+        self.start = header.timestamp if (self.height - 1) % interval == 0 else parent.start
+        self.difficulty = header.difficulty
+        if self.height % interval == 0:     #same rule as Blockchain._retarget
+            if self.start is None: self.difficulty = None
+            elif self.start and header.timestamp:
+                expected = Blockchain._TARGET_BLOCK_TIME * (interval - 1)
+                self.difficulty = retarget(header.difficulty, header.timestamp - self.start, expected)
+
+    def allows(self, difficulty):
+        '''checks if a child may be mined at difficulty. if the interval began before the checkpoint, its retarget can't
+        be redone, so any difficulty retarget can step to (2 bits either way) is allowed'''
+        if self.difficulty is not None: return difficulty == self.difficulty
+        return max(1, self.header.difficulty - 2) <= difficulty <= self.header.difficulty + 2
+
+class LightClient():
+    '''Keeps only Headers, in a tree of every branch it has seen, and follows the one w the most cumulative work
+    (2**difficulty per header) like BlockTree does. the first header must be checkpoint, a (height, Header) the client
+    trusts as is (by default the genesis header, which every Blockchain starts w). add_header checks each one after it
+    builds on a known header (prev hash is that header's hash) and has the proof of work for the difficulty the chain
+    requires there, so headers can't be made up w/o out-working the real chain. difficulty is what the chain requires
+    of the block after the checkpoint (the Blockchain's difficulty for the genesis header); from there the client
+    retargets every Blockchain._RETARGET_INTERVAL headers from their timestamps, the same way Blockchain does'''
+    def __init__(self, difficulty=1, checkpoint=None):
+        '''inits w no headers'''
+        if difficulty < 1: raise ValueError(f'difficulty {difficulty} must be at least 1!')
+        if checkpoint is None: checkpoint = (1, _genesis_header())
+        self._difficulty = difficulty
+        self._checkpoint = checkpoint[1].pow_hash()
+        self._base = checkpoint[0] - 1      # height of the block before the first header kept
+        self._nodes = {}        # header hash -> _Node, for every branch
+        self._headers = []      # Headers of the main branch; _headers[i] is at height _base + i + 1
+        self._tip = None        # _Node of the main branch's last header
+
+    def __repr__(self):
+        '''simple print statement w the number of headers'''
+        return f'LightClient({len(self._headers)} headers)'
+
+    def __len__(self):
+        '''returns the height of the chain as far as the client knows'''
+        return self._base + len(self._headers)
+
+    def add_header(self, header):
+        '''adds header under the header it builds on if it is valid, and switches to its branch if that is the heaviest
+        now. returns True if it was added (or was already known)'''
+        header_id = header.pow_hash()
+        if header_id in self._nodes: return True
+        if self._tip is None:
+            if header_id != self._checkpoint: return False
+            node = _Node(header, None, self._base + 1, self._difficulty)
+        else:
+            parent = self._nodes.get(header.prev_hash)
+            if parent is None or not parent.allows(header.difficulty) or header_id > _target(header.difficulty):
+                return False
+            node = _Node(header, parent)
+        self._nodes[header_id] = node
+        if self._tip is None or node.work > self._tip.work: self._switch(node)
+        return True
+
+    def add_headers(self, headers):
+        '''adds headers in order until one is not valid. returns how many were added'''
+        for i, header in enumerate(headers):
+            if not self.add_header(header): return i
+        return len(headers)
+
+    def header(self, height):
+        '''the Header at height on the main branch'''
+        return self._headers[height - 1 - self._base]
+
+    def _switch(self, node):
+        '''makes node's branch the main branch: only the headers after the common ancestor are replaced'''
+        tip, branch = node, []
+        while node is not None and not (node.height <= len(self) and self.header(node.height) is node.header):
+            branch.append(node.header)
+            node = node.parent
+        del self._headers[(node.height if node is not None else self._base) - self._base:]
+        self._headers.extend(reversed(branch))
+        self._tip = tip
+
+    def verify_transaction(self, trans, height, pos, proof):
+        '''True if proof shows trans is at position pos of the block at height'''
+        if not self._base < height <= len(self): return False
+        root = self.header(height).merkle_root
+        if root == _EMPTY_ROOT: return False
+        return verify_merkle_proof(trans.digest(), pos, proof, root)
+
+    def verify_balance(self, user, balance, height, proof):
+        '''True if proof shows user's balance after the block at height is balance (None: user has no account). only
+        blocks that commit to a state root can prove balances'''
+        if not self._base < height <= len(self): return False
+        state_root = self.header(height).state_root
+        return state_root is not None and verify_balance(state_root, user, balance, proof)
+
+def _genesis_header():
+    '''Header of the genesis block every Blockchain starts w'''
+    root = Blockchain._ROOT_BC_USER
+    return Header.from_block(Block([Transaction(root, root, Blockchain._TOTAL_AVAILABLE_TOKENS)]))
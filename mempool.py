@@ -0,0 +1,136 @@
+'''Pool of pending transactions for a Blockchain. a transaction is only admitted if its sender can cover it on top of
+everything the sender already has pending, so any subset of the pool is a valid block. transactions are kept in a heap
+by priority (highest first, then oldest first), so a block template of n transactions costs O(n log m) for m pending'''
+import heapq
+from collections import deque
+
+from blockchain import Block
+from validation import check_transaction
+
+class Mempool():
+    '''Pending transactions for chain, which it listens to: transactions that make it into a block leave the pool, and
+    if a block spends a sender's balance from elsewhere, the sender's lowest priority transactions are dropped until
+    the rest fit again. the priorities of pooled transactions taken by the last reorg_depth blocks are remembered, so
+    undoing one of those blocks puts its transactions back at the priority they had'''
+    def __init__(self, chain, reorg_depth=100):
+        '''inits an empty pool and starts listening for new blocks'''
+        self._chain = chain
+        self._mined = deque(maxlen=reorg_depth)     # (Block, {position: priority}) for blocks that took pooled transactions
+        self._heap = []         # [-priority, seq, Transaction], including entries that were removed since (stale)
+        self._entries = {}      # seq -> heap entry, for every transaction still in the pool
+        self._by_digest = {}    # Transaction digest -> seqs of pooled transactions w that digest
+        self._by_sender = {}    # user -> seqs of pooled transactions they send
+        self._pending = {}      # user -> total amount of their pooled transactions
+        self._seq = 0
+        chain.add_listener(self)
+
+    def __repr__(self):
+        '''simple print statement w the number of pending transactions'''
+        return f'Mempool({len(self._entries)} pending)'
+
+    def __len__(self):
+        '''number of pending transactions'''
+        return len(self._entries)
+
+    def pending(self, user):
+        '''total amount user is spending in pending transactions'''
+        return self._pending.get(user, 0)
+
+    def add(self, trans, priority=0):
+        '''adds a transaction w a priority (ie: its fee). returns False, and leaves the pool as it was, if the
+        transaction is malformed or its sender can't pay for it on top of their pending transactions'''
+        frm, amt = trans.from_user, trans.amount
+        if not check_transaction((frm, trans.to_user, amt)): return False
+        balance = self._chain._bc_ledger.balance(frm)
+        if balance is None or self._pending.get(frm, 0) + amt > balance: return False
+
+        seq = self._seq
+        self._seq += 1
+        entry = [-priority, seq, trans]
+        heapq.heappush(self._heap, entry)
+        self._entries[seq] = entry
+        self._by_digest.setdefault(trans.digest(), []).append(seq)
+        self._by_sender.setdefault(frm, set()).add(seq)
+        self._pending[frm] = self._pending.get(frm, 0) + amt
+        return True
+
+    def remove(self, trans):
+        '''removes a transaction equal to trans from the pool. returns False if there is none'''
+        seqs = self._by_digest.get(trans.digest())
+        if not seqs: return False
+        self._drop(seqs[0])
+        return True
+
+    def block_template(self, max_txs):
+        '''returns a Block of the (up to) max_txs highest priority transactions, which add_block will accept. the
+        transactions stay in the pool until the block is added to the chain'''
+        heap, entries, ledger = self._heap, self._entries, self._chain._bc_ledger
+        taken, chosen, spent = [], [], {}
+        while heap and len(chosen) < max_txs:
+            entry = heapq.heappop(heap)
+            if entry[1] not in entries: continue    #stale entry of a removed transaction
+            taken.append(entry)
+            trans = entry[2]
+            frm = trans.from_user
+            spend = spent.get(frm, 0) + trans.amount
+            balance = ledger.balance(frm)
+            if balance is None or spend > balance: continue     #can only happen if the ledger was changed w/o telling listeners
+            spent[frm] = spend
+            chosen.append(trans)
+        for entry in taken: heapq.heappush(heap, entry)
+        return Block(chosen)
+
+    def block_added(self, chain, block, changes):
+        '''listener hook called by Blockchain: drops the block's transactions from the pool, then drops the lowest
+        priority transactions of any sender whose pending spend no longer fits their balance'''
+        by_digest = self._by_digest
+        if by_digest:
+            taken = {}
+            for pos, trans in enumerate(block):
+                seqs = by_digest.get(trans.digest())
+                if seqs:
+                    taken[pos] = -self._entries[seqs[0]][0]
+                    self._drop(seqs[0])
+            if taken: self._mined.append((block, taken))
+        for user, (old, new) in changes.items(): self._fit(user, new)
+
+    def block_removed(self, chain, block, changes):
+        '''listener hook called by Blockchain when a block is undone (ie: by a reorg): first drops the lowest priority
+        transactions of any sender whose pending spend no longer fits the balance they are back to, then puts the
+        block's transactions back in the pool, at the priority they had when the block took them (else 0), if their
+        senders can still pay for them'''
+        for user, (before, after) in changes.items(): self._fit(user, before)
+        taken = {}
+        if self._mined and self._mined[-1][0] is block: taken = self._mined.pop()[1]
+        for pos, trans in enumerate(block): self.add(trans, taken.get(pos, 0))
+
+    def _fit(self, user, balance):
+        '''drops user's lowest priority (then newest) transactions until their pending spend fits balance (None: the
+        account is gone, so all of them)'''
+        seqs = self._by_sender.get(user)
+        if not seqs: return
+        if balance is None: balance = float('-inf')
+        if self._pending[user] <= balance: return
+        for seq in sorted(seqs, key=self._entries.get, reverse=True):
+            self._drop(seq)
+            if self._pending.get(user, 0) <= balance: break
+
+    def _drop(self, seq):
+        '''removes a transaction from every index. its heap entry is left behind as stale, and the heap is rebuilt once
+        stale entries outnumber live ones'''
+        entry = self._entries.pop(seq)
+        trans = entry[2]
+        frm = trans.from_user
+        digest = trans.digest()
+        seqs = self._by_digest[digest]
+        seqs.remove(seq)
+        if not seqs: del self._by_digest[digest]
+        senders = self._by_sender[frm]
+        senders.discard(seq)
+        if senders: self._pending[frm] -= trans.amount
+        else:
+            del self._by_sender[frm]
+            del self._pending[frm]      #avoids leaving float rounding residue behind
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
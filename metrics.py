@@ -0,0 +1,176 @@
+'''Opt-in instrumentation for chain operations. Metrics.enable() swaps timing wrappers in for add_block, add_blocks,
+validate_chain, the Ledger calls and the hash maps' rehash/resize, and disable() puts the original methods back, so
+when it is off nothing is wrapped and nothing costs anything. every operation gets a count, total time and a latency
+histogram (log-spaced buckets), and every rehash is kept as an event w its bucket counts and pause'''
+from collections import deque
+import time
+
+from blockchain import Blockchain, Ledger
+from hashmap import HashMapping, OpenHashMapping
+
+# upper bounds (seconds) of the latency histogram buckets: 1us to 10s, 4 per decade, then +Inf
+BUCKETS = tuple(10**(e / 4) for e in range(-24, 5)) + (float('inf'),)
+
+# (class, method name, operation name) of everything that gets timed
+_TIMED = ((Blockchain, 'add_block', 'add_block'), (Blockchain, 'add_blocks', 'add_blocks'),
+          (Blockchain, 'validate_chain', 'validate_chain'), (Ledger, 'apply', 'ledger_apply'),
+          (Ledger, 'has_funds', 'ledger_has_funds'), (Ledger, 'deposit', 'ledger_deposit'),
+          (Ledger, 'transfer', 'ledger_transfer'), (Ledger, 'balance', 'ledger_balance'))
+_REHASHES = ((HashMapping, '_rehash', 'HashMapping', '_num_buckets'),
+             (HashMapping, '_start_rehash', 'HashMapping incremental', '_num_buckets'),   #pause is just the start
+             (OpenHashMapping, '_resize', 'OpenHashMapping', '_mask'))
+
+class _Histogram():
+    '''count, total, min, max and bucket counts of one operation's latencies'''
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        '''inits an empty histogram'''
+        self.count, self.total, self.min, self.max = 0, 0.0, float('inf'), 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        '''records one latency'''
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min: self.min = seconds
+        if seconds > self.max: self.max = seconds
+        i = 0
+        while seconds > BUCKETS[i]: i += 1
+        self.buckets[i] += 1
+
+    def quantile(self, q):
+        '''upper bound of the bucket that holds the q-th quantile (0-1), capped at the max seen'''
+        rank, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank and n: return min(bound, self.max)
+        return self.max
+
+class Metrics():
+    '''Collects timings while enabled. only one Metrics can be enabled at a time. keeps the last max_events rehashes'''
+    _active = None      # the enabled Metrics, if any
+
+    def __init__(self, max_events=1000):
+        '''inits empty metrics'''
+        self.ops = {}       # operation name -> _Histogram
+        self.rehashes = deque(maxlen=max_events)  # (map class name, old buckets, new buckets, entries, seconds)
+        self.rehash_count = 0
+        self.rehash_pauses = _Histogram()
+        self._originals = []    # (class, method name, original function) to put back on disable
+        self._started = self._stopped = None
+
+    def __repr__(self):
+        '''simple print statement w the operations seen and whether it is enabled'''
+        return f'Metrics({sorted(self.ops)}, enabled={Metrics._active is self})'
+
+    def __enter__(self):
+        '''enables the metrics for the body of a with statement'''
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        '''disables the metrics'''
+        self.disable()
+
+    def enable(self):
+        '''wraps every timed method and rehash. raises ValueError if another Metrics is enabled'''
+        if Metrics._active is not None: raise ValueError('another Metrics is already enabled')
+        Metrics._active = self
+        for cls, name, op in _TIMED: self._wrap(cls, name, self._timed(getattr(cls, name), op))
+        for cls, name, map_name, size_attr in _REHASHES:
+            self._wrap(cls, name, self._rehash_timed(getattr(cls, name), map_name, size_attr))
+        self._started, self._stopped = time.perf_counter(), None
+
+    def disable(self):
+        '''puts the original methods back'''
+        for cls, name, original in reversed(self._originals): setattr(cls, name, original)
+        self._originals = []
+        if Metrics._active is self:
+            Metrics._active = None
+            self._stopped = time.perf_counter()
+
+    def _wrap(self, cls, name, wrapper):
+        '''replaces cls.name w wrapper, remembering the original'''
+        self._originals.append((cls, name, cls.__dict__[name]))
+        wrapper.__name__, wrapper.__doc__ = name, getattr(cls, name).__doc__
+        setattr(cls, name, wrapper)
+
+    def _timed(self, method, op):
+        '''wraps method to record its latency under op'''
+        hist = self.ops.setdefault(op, _Histogram())
+        clock = time.perf_counter
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                hist.observe(clock() - start)
+        return timed
+
+    def _rehash_timed(self, method, map_name, size_attr):
+        '''wraps a hash map's rehash/resize to record it as an event'''
+        clock = time.perf_counter
+        def rehash(hmap, new_size):
+            old_size = getattr(hmap, size_attr) + (size_attr == '_mask')   #_mask is slots - 1
+            start = clock()
+            method(hmap, new_size)
+            pause = clock() - start
+            self.rehash_count += 1
+            self.rehash_pauses.observe(pause)
+            self.rehashes.append((map_name, old_size, new_size, len(hmap), pause))
+        return rehash
+
+    def elapsed(self):
+        '''seconds the metrics have been (or were) enabled'''
+        if self._started is None: return 0.0
+        return (self._stopped or time.perf_counter()) - self._started
+
+    def as_dict(self):
+        '''returns {'elapsed', 'operations': {op: {count, total, mean, min, max, p50, p90, p99, per_second}},
+        'rehashes': {count, pause stats, events}}'''
+        elapsed = self.elapsed()
+        def stats(hist):
+            return {'count': hist.count, 'total': hist.total, 'mean': hist.total / hist.count if hist.count else 0.0,
+                    'min': hist.min if hist.count else 0.0, 'max': hist.max, 'p50': hist.quantile(0.5),
+                    'p90': hist.quantile(0.9), 'p99': hist.quantile(0.99),
+                    'per_second': hist.count / elapsed if elapsed else 0.0}
+        events = [{'map': name, 'old_buckets': old, 'new_buckets': new, 'entries': entries, 'seconds': pause}
+                  for name, old, new, entries, pause in self.rehashes]
+        return {'elapsed': elapsed, 'operations': {op: stats(hist) for op, hist in self.ops.items() if hist.count},
+                'rehashes': dict(stats(self.rehash_pauses), count=self.rehash_count, events=events)}
+
+    def prometheus(self, prefix='blockchain'):
+        '''returns the metrics in Prometheus text exposition format'''
+        lines = [f'# HELP {prefix}_operation_seconds Latency of chain operations.',
+                 f'# TYPE {prefix}_operation_seconds histogram']
+        for op, hist in sorted(self.ops.items()):
+            if hist.count: lines.extend(_histogram_lines(f'{prefix}_operation_seconds', hist, f'op="{op}"'))
+        lines += [f'# HELP {prefix}_rehash_total Hash map rehashes/resizes.', f'# TYPE {prefix}_rehash_total counter',
+                  f'{prefix}_rehash_total {self.rehash_count}',
+                  f'# HELP {prefix}_rehash_pause_seconds Time spent in each rehash/resize.',
+                  f'# TYPE {prefix}_rehash_pause_seconds histogram']
+        lines.extend(_histogram_lines(f'{prefix}_rehash_pause_seconds', self.rehash_pauses, ''))
+        if self.rehashes:
+            lines += [f'# HELP {prefix}_rehash_last_buckets Buckets (or slots) after the last rehash.',
+                      f'# TYPE {prefix}_rehash_last_buckets gauge',
+                      f'{prefix}_rehash_last_buckets {self.rehashes[-1][2]}']
+        return '\n'.join(lines) + '\n'
+
+def _histogram_lines(name, hist, labels):
+    '''Prometheus lines for one histogram: cumulative buckets, sum and count'''
+    sep = ',' if labels else ''
+    lines, seen = [], 0
+    for bound, n in zip(BUCKETS, hist.buckets):
+        seen += n
+        le = '+Inf' if bound == float('inf') else f'{bound:.6g}'
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{le}"}} {seen}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {hist.total!r}')
+    lines.append(f'{name}_count{suffix} {hist.count}')
+    return lines
+
+def profile(max_events=1000):
+    '''returns a new Metrics to use as a context manager for a scoped profiling run:
+    with profile() as metrics: ... then metrics.as_dict() or metrics.prometheus()'''
+    return Metrics(max_events)
@@ -0,0 +1,65 @@
+'''Multi-process proof of work. the nonce space is split into chunks handed out round robin to the workers of a
+process pool; the first worker to find a nonce sets a shared Event and the others stop at the end of their chunk'''
+import multiprocessing
+import os
+
+from blockchain import _search_nonces, _target
+
+_found = None   # the pool's shared "a nonce was found" Event, set in each worker by _init_worker
+
+def _init_worker(found):
+    '''pool initializer: keeps the shared Event in the worker'''
+    global _found
+    _found = found
+
+def _search(prefix, target, first_chunk, stride, chunk, stop):
+    '''worker: searches chunks first_chunk, first_chunk+stride, ... of the nonce space below stop. returns (nonce or
+    None, how many nonces were tried). stops early once any worker has set the Event'''
+    tried = 0
+    for start in range(first_chunk*chunk, stop, stride*chunk):
+        if _found.is_set(): break
+        end = min(start + chunk, stop)
+        nonce = _search_nonces(prefix, target, start, end)
+        if nonce is not None:
+            _found.set()
+            return nonce, tried + nonce - start + 1
+        tried += end - start
+    return None, tried
+
+class Miner():
+    '''Searches for proof of work nonces on a pool of worker processes. pass it to Blockchain.mine'''
+    def __init__(self, workers=None, chunk=2**14):
+        '''starts workers processes (default: one per cpu). each worker checks for cancellation every chunk nonces'''
+        self._workers = workers or os.cpu_count()
+        self._chunk = chunk
+        self._found = multiprocessing.Event()
+        self._pool = multiprocessing.Pool(self._workers, _init_worker, (self._found,))
+        self.hashes = 0     # nonces tried so far, for hash rate measurements
+
+    def __repr__(self):
+        '''simple print statement w the number of workers'''
+        return f'Miner(workers={self._workers})'
+
+    def __enter__(self):
+        '''lets a Miner be used in a with statement, which stops the pool at the end'''
+        return self
+
+    def __exit__(self, *exc_info):
+        '''stops the pool'''
+        self.close()
+
+    def close(self):
+        '''stops the worker processes'''
+        self._pool.terminate()
+        self._pool.join()
+
+    def search(self, prefix, difficulty, stop=2**64):
+        '''returns a nonce below stop whose header hash (prefix + nonce) has difficulty leading zero bits, or None if
+        there is none. waits for every worker to stop before returning, so the next search starts clean'''
+        self._found.clear()
+        target = _target(difficulty)
+        jobs = [self._pool.apply_async(_search, (prefix, target, k, self._workers, self._chunk, stop)) for k in range(self._workers)]
+        results = [job.get() for job in jobs]
+        self.hashes += sum(tried for nonce, tried in results)
+        found = [nonce for nonce, tried in results if nonce is not None]
+        return min(found) if found else None
@@ -0,0 +1,267 @@
+'''In-process simulation of a P2P network of Blockchain nodes, for load testing block and transaction propagation.
+every node owns a Blockchain and an asyncio.Queue inbox. messages are delivered w call_later after a delay made of the
+sender's upload time (size / bandwidth, queued behind what it is already sending) plus the link latency, and some are
+dropped. the network runs on a VirtualTimeLoop, whose clock jumps straight to the next scheduled delivery, so delays
+are exact no matter how long the nodes take to process messages, and idle time costs nothing. blocks and transactions spread by inventory announcements: a node announces the ids it has ('inv'), a peer
+that lacks one asks for it ('getdata') and gets the full payload back, so each payload crosses each link at most once'''
+import asyncio
+import random
+
+from blockchain import Blockchain, Transaction
+from chainlog import _encode_block, _decode_block
+
+_ID_SIZE = 32       # bytes of a block/transaction id
+_MSG_OVERHEAD = 8   # bytes of framing (type, length) added to every message
+
+def _block_id(block):
+    '''id of a block on the network: its header hash, which covers the prev hash, so equal blocks on different
+    parents get different ids'''
+    return block.pow_hash()
+
+def percentile(values, pct):
+    '''returns the pct-th percentile (0-100) of values by the nearest rank method'''
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+class _VirtualSelector():
+    '''wraps a loop's selector: polls it w/o blocking, and when nothing is ready moves the loop's clock forward by the
+    time it would have slept'''
+    def __init__(self, loop, selector):
+        '''wraps selector for loop'''
+        self._loop = loop
+        self._selector = selector
+
+    def __getattr__(self, name):
+        '''everything but select goes to the real selector'''
+        return getattr(self._selector, name)
+
+    def select(self, timeout=None):
+        '''returns the ready events; if there are none, skips ahead to when the next callback is due'''
+        events = self._selector.select(0)
+        if not events and timeout: self._loop._now += timeout
+        return events
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    '''asyncio event loop w a simulated clock that starts at 0 and only moves when every task is waiting'''
+    def __init__(self):
+        '''inits the loop and swaps its selector for a _VirtualSelector'''
+        super().__init__()
+        self._now = 0.0
+        self._selector = _VirtualSelector(self, self._selector)
+
+    def time(self):
+        '''the simulated time in seconds'''
+        return self._now
+
+def run(main):
+    '''runs the coroutine main on a new VirtualTimeLoop and returns its result, like asyncio.run'''
+    loop = VirtualTimeLoop()
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        loop.close()
+
+class Node():
+    '''One peer in a Network: its own Blockchain, its peers, and the ids it has or has asked for'''
+    def __init__(self, network, node_id):
+        '''inits an empty node; the Network connects it to peers'''
+        self.id = node_id
+        self.chain = Blockchain()
+        self.peers = []
+        self.inbox = asyncio.Queue()
+        self.mempool = {}           # transaction id -> Transaction
+        self._network = network
+        self._payloads = {}         # id -> ('block' or 'tx', payload bytes) for everything this node can serve
+        self._announcers = {}       # id -> peers that announced it, in the order they will be asked
+        self._requested = set()     # ids asked for and not received yet
+        self._rejected = set()      # ids of blocks this node's chain rejected or can't link, which it won't ask for again
+        self._orphans = {}          # prev hash -> (sender, id, payload) of blocks that arrived before their parent
+        self._orphan_prev = {}      # orphan id -> its prev hash, oldest first
+        self._linked = {_block_id(self.chain._blockchain[0])}     # ids of the blocks on this node's chain
+        self._upload_free_at = 0.0  # when this node's uplink is done sending what is already queued
+
+    def __repr__(self):
+        '''simple print statement w the node id and chain length'''
+        return f'Node({self.id}, height={len(self.chain._blockchain)})'
+
+    async def run(self):
+        '''handles messages from the inbox until cancelled'''
+        while True:
+            sender, kind, item_id, payload = await self.inbox.get()
+            if kind == 'inv': self._on_inv(sender, item_id)
+            elif kind == 'getdata': self._on_getdata(sender, item_id)
+            elif kind == 'block': self._on_block(sender, item_id, payload)
+            elif kind == 'tx': self._on_tx(sender, item_id, payload)
+
+    def submit_block(self, block):
+        '''adds a block made on this node (ie: a miner) and announces it. returns False if the chain rejects it'''
+        if not self.chain.add_block(block): return False
+        block_id = _block_id(block)
+        self._linked.add(block_id)
+        self._network._origin[block_id] = self._network.loop.time()
+        self._have(block_id, 'block', _encode_block(block), None)
+        return True
+
+    def submit_transaction(self, trans):
+        '''adds a transaction made on this node to its mempool and announces it'''
+        tx_id = trans.digest()
+        self.mempool[tx_id] = trans
+        self._have(tx_id, 'tx', trans.encode(), None)
+
+    def _send(self, peer, kind, item_id, payload=b''):
+        '''queues a message on this node's uplink: it arrives after the upload time plus latency, unless it is lost'''
+        net = self._network
+        size = _MSG_OVERHEAD + _ID_SIZE + len(payload)
+        net.bytes_sent[item_id] = net.bytes_sent.get(item_id, 0) + size
+        now = net.loop.time()
+        self._upload_free_at = max(now, self._upload_free_at) + size / net.bandwidth
+        if net.rng.random() < net.loss: return      #dropped on the way (still used the uplink)
+        delay = self._upload_free_at - now + net.rng.uniform(*net.latency)
+        net.loop.call_later(delay, peer.inbox.put_nowait, (self, kind, item_id, payload))
+
+    def _have(self, item_id, kind, payload, source):
+        '''stores a new block/transaction payload and announces it to every peer except the one it came from'''
+        self._payloads[item_id] = (kind, payload)
+        self._requested.discard(item_id)
+        self._announcers.pop(item_id, None)
+        for peer in self.peers:
+            if peer is not source: self._send(peer, 'inv', item_id)
+
+    def _on_inv(self, sender, item_id):
+        '''asks the first peer that announces an unknown id for it; later announcers are kept in case that fails'''
+        if item_id in self._payloads or item_id in self._rejected: return
+        self._announcers.setdefault(item_id, []).append(sender)
+        if item_id not in self._requested: self._request(item_id)
+
+    def _request(self, item_id):
+        '''sends getdata to the next peer that announced item_id, and retries w another one after a timeout. peers that
+        were already asked go to the back of the line, since a lost message is no reason to give up on them'''
+        announcers = self._announcers[item_id]
+        peer = announcers.pop(0)
+        announcers.append(peer)
+        self._requested.add(item_id)
+        self._send(peer, 'getdata', item_id)
+        self._network.loop.call_later(self._network.timeout, self._retry, item_id)
+
+    def _retry(self, item_id):
+        '''timeout: the getdata or its answer was lost, so ask someone else'''
+        if item_id in self._requested: self._request(item_id)
+
+    def _on_getdata(self, sender, item_id):
+        '''answers a getdata w the payload'''
+        if item_id in self._payloads:
+            kind, payload = self._payloads[item_id]
+            self._send(sender, kind, item_id, payload)
+
+    def _on_block(self, sender, block_id, payload):
+        '''adds a received block if it extends this node's tip, buffering it if its parent has not arrived yet. a block
+        whose parent is already below the tip forks off at or below the tip, which a node can't switch to, so it is
+        dropped w any orphans waiting on it. past the network's max_orphans, the oldest orphan is dropped'''
+        if block_id in self._payloads: return
+        block = _decode_block(payload, 0)
+        if block._prev_hash != self.chain._blockchain[-1].pow_hash():
+            self._requested.discard(block_id)
+            self._announcers.pop(block_id, None)
+            if block._prev_hash in self._linked:
+                self._reject(block_id)
+                return
+            self._orphans.setdefault(block._prev_hash, []).append((sender, block_id, payload))
+            self._orphan_prev[block_id] = block._prev_hash
+            self._payloads[block_id] = ('block', payload)   #known, but announced only once connected
+            if len(self._orphan_prev) > self._network.max_orphans: self._drop_orphan(next(iter(self._orphan_prev)))
+            return
+        self._connect(sender, block_id, block, payload)
+
+    def _connect(self, sender, block_id, block, payload):
+        '''adds a block on top of the tip, records its arrival, announces it, then connects any orphans waiting on it.
+        a rejected block is forgotten (so it is neither retried nor served) and its id is not asked for again'''
+        if not self.chain.add_block(block):
+            self._requested.discard(block_id)
+            self._announcers.pop(block_id, None)
+            self._payloads.pop(block_id, None)      #an orphan's payload was kept when it arrived
+            self._reject(block_id)
+            return
+        self._linked.add(block_id)
+        net = self._network
+        net.arrivals.setdefault(block_id, []).append(net.loop.time() - net._origin[block_id])
+        self._have(block_id, 'block', payload, sender)
+        for orphan_sender, orphan_id, orphan_payload in self._orphans.pop(block_id, []):
+            del self._orphan_prev[orphan_id]
+            self._connect(orphan_sender, orphan_id, _decode_block(orphan_payload, 0), orphan_payload)
+
+    def _reject(self, block_id):
+        '''marks a block that can't be linked as rejected, and drops the orphans waiting on it (they can't be either)'''
+        self._rejected.add(block_id)
+        for sender, orphan_id, payload in list(self._orphans.get(block_id, ())): self._drop_orphan(orphan_id, True)
+
+    def _drop_orphan(self, orphan_id, reject=False):
+        '''forgets an orphan and every orphan waiting on it. reject=True also keeps them from being asked for again'''
+        prev = self._orphan_prev.pop(orphan_id)
+        waiting = [orphan for orphan in self._orphans[prev] if orphan[1] != orphan_id]
+        if waiting: self._orphans[prev] = waiting
+        else: del self._orphans[prev]
+        self._payloads.pop(orphan_id, None)
+        if reject: self._rejected.add(orphan_id)
+        for sender, child_id, payload in list(self._orphans.get(orphan_id, ())): self._drop_orphan(child_id, reject)
+
+    def _on_tx(self, sender, tx_id, payload):
+        '''adds a received transaction to the mempool and passes it on'''
+        if tx_id in self._payloads: return
+        self.mempool[tx_id] = Transaction.decode(payload)[0]
+        self._have(tx_id, 'tx', payload, sender)
+
+class Network():
+    '''A simulated network of num_nodes Nodes. each node is connected to a ring neighbour plus random peers up to about
+    degree peers. latency is a (min, max) range in seconds, bandwidth is each node's upload rate in bytes/second, loss
+    is the chance a message is dropped, timeout is how long a node waits before asking another peer and max_orphans is
+    how many blocks w/o a known parent each node buffers (the oldest is dropped first). must be
+    created inside a running event loop: use run() for simulated time, asyncio.run() for wall clock time'''
+    def __init__(self, num_nodes, degree=8, latency=(0.01, 0.05), bandwidth=1e6, loss=0.0, timeout=0.5, seed=0,
+                 max_orphans=1000):
+        '''builds the nodes and the random topology and starts every node's message loop'''
+        self.loop = asyncio.get_running_loop()
+        self.rng = random.Random(seed)
+        self.latency, self.bandwidth, self.loss, self.timeout = latency, bandwidth, loss, timeout
+        self.max_orphans = max_orphans
+        self.arrivals = {}      # block id -> seconds after its origin that each other node connected it
+        self.bytes_sent = {}    # block/transaction id -> bytes of every message about it
+        self._origin = {}       # block id -> loop time it was submitted
+        self.nodes = [Node(self, i) for i in range(num_nodes)]
+
+        edges = set()
+        for i in range(num_nodes):
+            if num_nodes > 1: edges.add(frozenset((i, (i + 1) % num_nodes)))    #ring keeps the graph connected
+            for j in self.rng.sample(range(num_nodes), min(degree // 2, num_nodes - 1)):
+                if j != i: edges.add(frozenset((i, j)))
+        for edge in edges:
+            if len(edge) < 2: continue
+            a, b = edge
+            self.nodes[a].peers.append(self.nodes[b])
+            self.nodes[b].peers.append(self.nodes[a])
+        self._tasks = [asyncio.ensure_future(node.run()) for node in self.nodes]
+
+    def __repr__(self):
+        '''simple print statement w the number of nodes'''
+        return f'Network({len(self.nodes)} nodes)'
+
+    async def close(self):
+        '''stops every node's message loop'''
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def wait_for(self, block, timeout=30.0):
+        '''waits until every other node has connected block (or timeout seconds pass). returns how many did'''
+        block_id = _block_id(block)
+        deadline = self.loop.time() + timeout
+        while len(self.arrivals.get(block_id, ())) < len(self.nodes) - 1 and self.loop.time() < deadline:
+            await asyncio.sleep(0.005)
+        return len(self.arrivals.get(block_id, ()))
+
+    def stats(self, block):
+        '''propagation stats for a block: nodes reached, p50/p90/p99/max latency in seconds and total bytes sent'''
+        block_id = _block_id(block)
+        times = self.arrivals.get(block_id, [])
+        stats = {'reached': len(times), 'bytes': self.bytes_sent.get(block_id, 0)}
+        for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)):
+            stats[name] = percentile(times, pct) if times else None
+        return stats
@@ -0,0 +1,171 @@
+'''Bulk ledger replay: rebuilds balances from a range of blocks w/o going thru Ledger.deposit/transfer one transaction at
+a time. the blocks are flattened into from/to user id and amount columns (ColumnarBlocks hand theirs over as-is), and
+w NumPy the balances come from one scatter-add over the interleaved debits and credits. each account still gets its
+updates in chain order, so the balances are the same as the serial replay bit for bit. overdrafts (a running balance
+going below 0 partway thru a block) are found w a per-account prefix sum (int amounts only: float prefix sums taken
+across accounts would round differently, so those use the loop, as do int amounts large enough to overflow int64).
+w/o NumPy both fall back to a plain loop over the columns, which is still a few times faster than going thru the
+Ledger. pulling the columns out of Blocks (an attribute lookup per Transaction) costs more than the NumPy math, so
+the full speedup needs ColumnarBlocks'''
+from array import array
+from bisect import bisect_right
+from operator import attrgetter
+
+from blockchain import ColumnarBlock, _intern_user, _user_ids, _user_names
+
+try:
+    import numpy as np
+except ImportError:     #optional: everything works w/o it, just slower
+    np = None
+
+_from_user, _to_user, _amount = attrgetter('from_user'), attrgetter('to_user'), attrgetter('amount')
+
+def _columns(chain, start, stop):
+    '''flattens the blocks from height start thru stop into (from ids, to ids, amounts, starts) where starts[i] is
+    the index of the first transaction of the i-th block. the genesis block only mints, so its transactions get the
+    from id -1. the transactions of a run of Blocks are pulled out together w map, so there is no Python level loop
+    per transaction (or per Block)'''
+    frm, to, amounts, starts = array('q'), array('q'), [], []
+    txs = []    # transactions of the Blocks since the last ColumnarBlock
+    for height, block in chain.iter_blocks(start, stop):
+        starts.append(len(to) + len(txs))
+        if height == 1:
+            frm.fromlist([-1] * len(block))
+            to.fromlist(_ids(list(map(_to_user, block))))
+            amounts.extend(map(_amount, block))
+        elif isinstance(block, ColumnarBlock):
+            _extend(frm, to, amounts, txs)
+            frm.fromlist(block._from_ids.tolist())    #'I' arrays can't extend a 'q' array directly
+            to.fromlist(block._to_ids.tolist())
+            amounts.extend(block._amounts)
+        else: txs.extend(block)
+    _extend(frm, to, amounts, txs)
+    return frm, to, amounts, starts
+
+def _extend(frm, to, amounts, txs):
+    '''appends the columns of a list of Transactions, then clears it'''
+    frm.fromlist(_ids(list(map(_from_user, txs))))
+    to.fromlist(_ids(list(map(_to_user, txs))))
+    amounts.extend(map(_amount, txs))
+    txs.clear()
+
+def _ids(users):
+    '''interned ids of a list of users, interning them one by one only if one of them is new'''
+    try:
+        return list(map(_user_ids.__getitem__, users))
+    except KeyError:
+        return list(map(_intern_user, users))
+
+def _numpy_amounts(amounts):
+    '''amounts as a NumPy array: int64 if they are all ints that fit, float64 if there is a float (the same math a
+    Python int + float does, as long as the amounts stay under 2**53). None if NumPy can't hold them exactly'''
+    try:
+        vals = np.array(amounts)
+    except OverflowError:   #an int too big for int64
+        return None
+    if vals.dtype == np.int64: return vals
+    if vals.dtype == np.float64 and (not len(vals) or np.abs(vals).max() <= 2**53): return vals
+    return None     #bools, huge ints or floats past 2**53 (where an int in the mix may have been rounded)
+
+def _fits_int64(vals, initial):
+    '''checks that int64 math on vals can't overflow: no account's running balance can get further from 0 than its
+    starting balance plus twice the largest amount per transaction (a transfer to oneself is a debit and a credit)'''
+    if vals.dtype != np.int64 or not len(vals): return True
+    largest = max(int(vals.max()), -int(vals.min()))
+    start = max((abs(b) for b in initial.values()), default=0)
+    return start + 2 * len(vals) * largest < 2**63
+
+def _interleaved(frm, to, vals):
+    '''account ids and signed amounts of every debit and credit in chain order: the debit of transaction i is at 2*i
+    and its credit at 2*i+1. mints (from id -1) debit a spare account past the last real one, so every user (the
+    starting balances' ones included) has to be interned before this is called'''
+    sink = len(_user_names)
+    ids = np.empty(2 * len(to), dtype=np.int64)
+    ids[0::2] = np.frombuffer(frm, dtype=np.int64)
+    ids[1::2] = np.frombuffer(to, dtype=np.int64)
+    ids[ids < 0] = sink
+    signed = np.empty(2 * len(vals), dtype=vals.dtype)
+    signed[0::2] = -vals
+    signed[1::2] = vals
+    return ids, signed, sink
+
+def _start_ids(balances):
+    '''starting balances (a {user: balance} dict) as {user id: balance}. interns their users, some of which may not
+    be in the replayed blocks'''
+    return {_intern_user(user): balance for user, balance in (balances or {}).items()}
+
+def _initial(initial, size, dtype):
+    '''starting balances (a {user id: balance} dict) as a NumPy array indexed by user id'''
+    start = np.zeros(size, dtype=dtype)
+    for uid, balance in initial.items(): start[uid] = balance
+    return start
+
+def replay_balances(chain, start=1, stop=None, balances=None):
+    '''returns {user: balance} after applying the blocks from height start thru stop (default: the last block) on top
+    of balances (the balances right before height start; empty for a replay from the genesis block). blocks are
+    trusted as-is, like ChainLog.replay'''
+    frm, to, amounts, starts = _columns(chain, start, stop)
+    initial = _start_ids(balances)
+    vals = _numpy_amounts(amounts) if np is not None else None
+    if vals is None or not _fits_int64(vals, initial): return _replay_loop(frm, to, amounts, initial)[0]
+
+    ids, signed, sink = _interleaved(frm, to, vals)
+    if any(isinstance(b, float) for b in initial.values()): signed = signed.astype(np.float64)
+    final = _initial(initial, sink + 1, signed.dtype)
+    np.add.at(final, ids, signed)   #unbuffered: repeated ids are added one after the other, in order
+
+    counts = np.bincount(ids, minlength=sink + 1)
+    counts[sink] = 0
+    touched = set(np.flatnonzero(counts).tolist())
+    touched.update(initial)
+    names, values = _user_names, final.tolist()
+    return {names[uid]: values[uid] for uid in touched}
+
+def first_overdraft(chain, start=1, stop=None, balances=None):
+    '''returns (height, position) of the first transaction after which its sender's running balance is below 0
+    (replaying the blocks from height start thru stop on top of balances), or None if there is none. add_block checks
+    every transaction vs the balance before the block, so 2 spends in one block can overdraw an account. only
+    senders are checked: a recipient a negative amount drives below 0 is caught when they next send'''
+    frm, to, amounts, starts = _columns(chain, start, stop)
+    initial = _start_ids(balances)
+    vals = _numpy_amounts(amounts) if np is not None else None
+    if vals is not None and vals.dtype == np.float64: vals = None   #float prefix sums per account would not be exact
+    if any(isinstance(b, float) for b in initial.values()): vals = None
+    if vals is not None and not _fits_int64(vals, initial): vals = None
+    if vals is None: idx = _replay_loop(frm, to, amounts, initial)[1]
+    else:
+        ids, signed, sink = _interleaved(frm, to, vals)
+        order = np.argsort(ids, kind='stable')  #groups each account's updates, keeping them in chain order
+        ids_sorted = ids[order]
+        running = np.cumsum(signed[order])
+        first = np.flatnonzero(np.r_[True, ids_sorted[1:] != ids_sorted[:-1]])  #where each account's group starts
+        before = np.r_[0, running[:-1]][first]      #running total right before each group
+        sizes = np.diff(np.r_[first, len(ids_sorted)])
+        running = running - np.repeat(before, sizes) + _initial(initial, sink + 1, running.dtype)[ids_sorted]
+        neg = np.flatnonzero((running < 0) & (order % 2 == 0) & (ids_sorted != sink))     #debits only, like the loop
+        idx = int(order[neg].min()) // 2 if len(neg) else None
+    if idx is None: return None
+    block = bisect_right(starts, idx) - 1
+    return max(start, 1) + block, idx - starts[block]
+
+def _replay_loop(frm, to, amounts, initial):
+    '''the same replay as a plain Python loop over the columns, on top of initial ({user id: balance}). returns
+    ({user: balance}, index of the first transaction that overdraws its sender or None)'''
+    bal = dict(initial)
+    get = bal.get
+    overdraft = None
+    for i, (f, t, amt) in enumerate(zip(frm, to, amounts)):
+        if f >= 0:
+            b = get(f, 0) - amt
+            bal[f] = b
+            if b < 0 and overdraft is None: overdraft = i
+        bal[t] = get(t, 0) + amt
+    names = _user_names
+    return {names[uid]: b for uid, b in bal.items()}, overdraft
+
+def audit_supply(chain):
+    '''replays the whole chain and returns (total supply, expected supply, True if the replayed balances match chain's
+    ledger). mining rewards are paid out of ROOT's balance, so the supply should always be _TOTAL_AVAILABLE_TOKENS'''
+    balances = replay_balances(chain)
+    ledger = dict(chain._bc_ledger.balances())
+    return sum(balances.values()), chain._TOTAL_AVAILABLE_TOKENS, balances == ledger
@@ -0,0 +1,295 @@
+'''asyncio front end for a Blockchain over a local socket (a Unix socket path, or a (host, port) pair for TCP). the
+protocol is one JSON object per line: {"id", "op", ...} in, {"id", "ok", "result" or "error"} out, and a client can
+have many requests in flight on one connection (responses come back as they finish, matched by id).
+
+every write (submit_transaction, submit_block, validate) goes thru one bounded queue, and a single writer drains it:
+transactions that are waiting together are coalesced into one Block and one add_block call, which runs on a worker
+thread so the loop keeps serving. a full queue answers "busy" right away instead of queueing more (backpressure).
+balance reads never wait for the writer: they are served from a snapshot of the ledger that the loop updates w each
+block's balance changes once the block is in, so a read always sees the state after some whole block'''
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import time
+
+from blockchain import Block, Transaction
+from validation import check_transaction
+from codec import encode_block, decode_block
+from network import percentile
+
+BUSY = 'busy'   # error of a request turned away because the write queue is full. retry later
+
+class BlockchainService():
+    '''Serves chain. max_batch caps the transactions coalesced into one block, max_queue the writes waiting. the
+    service is the only writer: blocks added to chain directly would not show up in the balance snapshot'''
+    def __init__(self, chain, max_batch=1000, max_queue=10000):
+        '''inits the service; start() opens the socket'''
+        self._chain = chain
+        self._max_batch = max_batch
+        self._queue = asyncio.Queue(max_queue)    # (kind, payload, future) writes for the writer
+        self._snapshot = dict(chain._bc_ledger.balances())  # balances as of self._height
+        self._height = len(chain._blockchain)
+        self._changes = []      # balance changes of blocks the writer added that the snapshot doesn't have yet
+        self._executor = ThreadPoolExecutor(1)    # the writer thread: add_block and validate_chain run here, in order
+        self._server = self._writer_task = None
+        self._tasks = set()     # request handlers still running
+        self.batches = self.coalesced = 0   # add_block calls for transactions, and transactions they carried
+        chain.add_listener(self)
+
+    def __repr__(self):
+        '''simple print statement w the height and queue length'''
+        return f'BlockchainService(height={self._height}, queued={self._queue.qsize()})'
+
+    def block_added(self, chain, block, changes):
+        '''listener hook called by Blockchain (on the writer thread): keeps the changes for the snapshot'''
+        self._changes.append(changes)
+
+    async def start(self, address):
+        '''listens on address: a path for a Unix socket, or (host, port) for TCP (port 0 picks a free one). returns
+        the address actually listened on'''
+        if isinstance(address, str):
+            self._server = await asyncio.start_unix_server(self._serve, address, limit=2**24)
+        else:
+            self._server = await asyncio.start_server(self._serve, address[0], address[1], limit=2**24)
+            address = self._server.sockets[0].getsockname()[:2]
+        self._writer_task = asyncio.get_running_loop().create_task(self._write_loop())
+        return address
+
+    async def close(self):
+        '''stops listening, stops the writer and shuts its thread down'''
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown()
+
+    async def _serve(self, reader, writer):
+        '''reads one connection's requests and answers each one as soon as it is done'''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                task = asyncio.get_running_loop().create_task(self._answer(line, writer))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _answer(self, line, writer):
+        '''handles one request line and writes the response line'''
+        req_id = None
+        try:
+            request = json.loads(line)
+            req_id = request.get('id')
+            response = {'id': req_id, 'ok': True, 'result': await self.handle(request)}
+        except ValueError as e:     #json errors are ValueErrors too
+            response = {'id': req_id, 'ok': False, 'error': str(e)}
+        except (KeyError, TypeError) as e:
+            response = {'id': req_id, 'ok': False, 'error': f'bad request: {e!r}'}
+        except Exception as e:     #anything else still gets an answer, so the client isn't left waiting
+            response = {'id': req_id, 'ok': False, 'error': f'internal error: {e!r}'}
+        if writer.is_closing(): return
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+
+    async def handle(self, request):
+        '''runs one request (a dict w an "op") and returns its result. raises ValueError w the error message'''
+        op = request['op']
+        if op == 'balance':
+            return {'balance': self._snapshot.get(request['user']), 'height': self._height}
+        if op == 'height':
+            return {'height': self._height}
+        if op == 'submit_transaction':
+            trans = Transaction(request['from'], request['to'], request['amount'])
+            if not check_transaction((trans.from_user, trans.to_user, trans.amount)):
+                raise ValueError('malformed transaction')
+            return await self._enqueue('tx', trans)
+        if op == 'submit_block':
+            return await self._enqueue('block', decode_block(bytes.fromhex(request['block'])))
+        if op == 'validate':
+            return await self._enqueue('validate', None)
+        raise ValueError(f'unknown op {op!r}')
+
+    async def _enqueue(self, kind, payload):
+        '''queues a write and waits for its result. raises ValueError(BUSY) if the queue is full'''
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((kind, payload, future))
+        except asyncio.QueueFull:
+            raise ValueError(BUSY) from None
+        return await future
+
+    async def _write_loop(self):
+        '''the writer: takes everything that is queued (up to max_batch transactions) and applies it in order'''
+        queue, loop = self._queue, asyncio.get_running_loop()
+        while True:
+            items = [await queue.get()]
+            while not queue.empty() and len(items) < self._max_batch: items.append(queue.get_nowait())
+            i = 0
+            while i < len(items):
+                kind, payload, future = items[i]
+                if kind != 'tx':
+                    await self._write_one(loop, kind, payload, future)
+                    i += 1
+                    continue
+                j = i
+                while j < len(items) and items[j][0] == 'tx': j += 1
+                await self._write_batch(loop, items[i:j])
+                i = j
+
+    async def _write_batch(self, loop, items):
+        '''coalesces queued transactions into one block. a transaction its sender can't cover (on top of the ones
+        before it in the batch) is turned away alone, so it doesn't sink the whole block'''
+        try:
+            accepted, height = await loop.run_in_executor(self._executor, self._add_transactions,
+                                                          [trans for kind, trans, future in items])
+        except Exception as e:
+            for kind, trans, future in items:
+                if not future.done(): future.set_exception(e)
+            return
+        self._publish()
+        self.batches += 1
+        self.coalesced += sum(accepted)
+        for ok, (kind, trans, future) in zip(accepted, items):
+            if future.done(): continue
+            if ok: future.set_result({'height': height})
+            else: future.set_exception(ValueError('insufficient funds'))
+
+    def _add_transactions(self, transactions):
+        '''writer thread: returns ([True if each transaction made it into the block], height of the block)'''
+        ledger = self._chain._bc_ledger
+        spent, keep = {}, []
+        for trans in transactions:
+            frm, amt = trans.from_user, trans.amount
+            balance = ledger.balance(frm)
+            ok = balance is not None and spent.get(frm, 0) + amt <= balance
+            if ok: spent[frm] = spent.get(frm, 0) + amt
+            keep.append(ok)
+        block = Block([trans for trans, ok in zip(transactions, keep) if ok])
+        if not len(block): return keep, None
+        if not self._chain.add_block(block): return [False] * len(transactions), None
+        return keep, len(self._chain._blockchain)
+
+    async def _write_one(self, loop, kind, payload, future):
+        '''applies a submitted block or runs validate_chain on the writer thread'''
+        try:
+            if kind == 'block':
+                ok = await loop.run_in_executor(self._executor, self._chain.add_block, payload)
+                result = {'accepted': ok, 'height': len(self._chain._blockchain) if ok else None}
+            else:
+                bad = await loop.run_in_executor(self._executor, self._chain.validate_chain)
+                result = {'valid': not bad, 'tampered': len(bad)}
+        except Exception as e:
+            if not future.done(): future.set_exception(e)
+            return
+        self._publish()
+        if not future.done(): future.set_result(result)
+
+    def _publish(self):
+        '''loop thread: brings the snapshot up to the writer's last block'''
+        snapshot = self._snapshot
+        for changes in self._changes:
+            for user, (before, after) in changes.items(): snapshot[user] = after
+        self._changes = []
+        self._height = len(self._chain._blockchain)
+
+class ServiceClient():
+    '''Client for a BlockchainService. requests can be made from many tasks at once: they share the connection and
+    each waits for its own response'''
+    def __init__(self, reader, writer):
+        '''use ServiceClient.connect'''
+        self._reader, self._writer = reader, writer
+        self._next_id = 0
+        self._waiting = {}      # request id -> future of its response
+        self._read_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def connect(cls, address):
+        '''connects to a service at address (a Unix socket path or (host, port))'''
+        if isinstance(address, str): reader, writer = await asyncio.open_unix_connection(address, limit=2**24)
+        else: reader, writer = await asyncio.open_connection(address[0], address[1], limit=2**24)
+        return cls(reader, writer)
+
+    async def close(self):
+        '''closes the connection'''
+        self._writer.close()
+        self._read_task.cancel()
+        try:
+            await self._read_task
+        except asyncio.CancelledError:
+            pass
+
+    async def _read_loop(self):
+        '''hands each response to the request waiting for it'''
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line: break
+                response = json.loads(line)
+                future = self._waiting.pop(response['id'], None)
+                if future is not None and not future.done(): future.set_result(response)
+        finally:
+            for future in self._waiting.values():
+                if not future.done(): future.set_exception(ConnectionError('connection closed'))
+
+    async def request(self, op, **fields):
+        '''sends a request and returns its result. raises ValueError w the service's error message'''
+        req_id = self._next_id
+        self._next_id += 1
+        future = self._waiting[req_id] = asyncio.get_running_loop().create_future()
+        self._writer.write(json.dumps(dict(fields, id=req_id, op=op)).encode() + b'\n')
+        await self._writer.drain()
+        response = await future
+        if not response['ok']: raise ValueError(response['error'])
+        return response['result']
+
+    async def submit_transaction(self, from_user, to_user, amount):
+        '''returns {"height"} of the block the transaction went into'''
+        return await self.request('submit_transaction', **{'from': from_user, 'to': to_user, 'amount': amount})
+
+    async def submit_block(self, block):
+        '''returns {"accepted", "height"}'''
+        return await self.request('submit_block', block=encode_block(block).hex())
+
+    async def balance(self, user):
+        '''returns (balance or None, height of the snapshot it was read from)'''
+        result = await self.request('balance', user=user)
+        return result['balance'], result['height']
+
+    async def validate(self):
+        '''returns {"valid", "tampered"}'''
+        return await self.request('validate')
+
+async def load_test(address, clients=32, requests=200, users=1000, read_fraction=0.5, seed=0):
+    '''clients connections each make requests requests one after the other: balance reads (read_fraction of them)
+    and transfers of 1 between random users0 .. users-1. returns {requests, seconds, per_second, p50, p90, p99, max,
+    errors: {message: count}}'''
+    latencies, errors = [], {}
+    async def client(n):
+        rng = random.Random(seed * 100003 + n)
+        conn = await ServiceClient.connect(address)
+        try:
+            for i in range(requests):
+                start = time.perf_counter()
+                try:
+                    if rng.random() < read_fraction: await conn.balance(f'user{rng.randrange(users)}')
+                    else: await conn.submit_transaction(f'user{rng.randrange(users)}', f'user{rng.randrange(users)}', 1)
+                except ValueError as e:
+                    errors[str(e)] = errors.get(str(e), 0) + 1
+                latencies.append(time.perf_counter() - start)
+        finally:
+            await conn.close()
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in range(clients)))
+    seconds = time.perf_counter() - start
+    return {'requests': len(latencies), 'seconds': seconds, 'per_second': len(latencies) / seconds,
+            'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90), 'p99': percentile(latencies, 99),
+            'max': max(latencies), 'errors': errors}
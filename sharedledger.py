@@ -0,0 +1,331 @@
+'''Ledger in shared memory, for read replicas in other processes. the balances live in a fixed-width open addressing
+hash table in one multiprocessing.shared_memory block: a 64 byte header, then slots of (tag, key length, 8 byte value,
+key_size bytes of zero padded UTF-8 user name), probed linearly from a crc32 of the name (hash() is salted per
+process).
+one process writes thru a SharedLedger; any number of LedgerReplicas attach by name and read w/o locks under a seqlock:
+the writer makes the sequence number odd while it writes and even again after, and a reader retries if the number was
+odd or changed while it read. a whole block is one write, so replicas see the balances before or after a block, never
+halfway. the table can't grow (readers map a fixed size), so it is made w the capacity it will need. the seqlock
+relies on the writer's stores becoming visible in order, which x86 guarantees'''
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+import struct
+import time
+from zlib import crc32
+
+from blockchain import Ledger
+
+_MAGIC = b'SHLEDGR1'
+_HEADER = struct.Struct('<8sQQQQQ')     # magic, seq, num slots, key_size, live entries, used slots (live + deleted)
+_HEADER_SIZE = 64
+_SEQ = struct.Struct('<Q')              # the seqlock's sequence number, at offset 8
+_INT, _FLOAT = struct.Struct('<q'), struct.Struct('<d')
+_EMPTY, _IS_INT, _IS_FLOAT, _DELETED = 0, 1, 2, 3   # slot tags
+_MAX_FILL = 0.75    # used slots (deleted ones too) past this share of the table: purge deleted ones or it is full
+_MISSING = object()
+
+def _slot_size(key_size):
+    '''bytes per slot: tag, key length, 6 pad bytes, value, key; rounded up to 8 so values stay aligned'''
+    return -(-(16 + key_size) // 8) * 8
+
+def _pack_value(value):
+    '''(tag, 8 value bytes) of a balance. raises OverflowError for an int that does not fit in 64 bits'''
+    if isinstance(value, float): return _IS_FLOAT, _FLOAT.pack(value)
+    if not -2**63 <= value < 2**63: raise OverflowError(f'balance {value} does not fit in a 64 bit slot')
+    return _IS_INT, _INT.pack(value)
+
+def _attach(name):
+    '''maps an existing block w/o registering it w the resource tracker, which would otherwise unlink it (and warn
+    of a leak) when this process exits. Python 3.13+ has track=False; before that, register is skipped for the call'''
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+class SharedHashMapping():
+    '''Same API as HashMapping (missing keys return False), over a shared memory block. SharedHashMapping(capacity)
+    creates the block; SharedHashMapping.attach(name) maps an existing one read-only, from any process. keys must be
+    str of at most key_size bytes as UTF-8, values ints (64 bit) or floats'''
+    def __init__(self, capacity=1 << 16, key_size=48, name=None):
+        '''creates a block w room for capacity keys (name: None picks a free one)'''
+        if capacity < 1 or key_size < 1 or key_size > 255:
+            raise ValueError('capacity must be positive and key_size between 1 and 255')
+        slots = 8
+        while capacity > _MAX_FILL * slots: slots *= 2
+        self._shm = shared_memory.SharedMemory(name, create=True, size=_HEADER_SIZE + slots * _slot_size(key_size))
+        self._shm.buf[:_HEADER_SIZE] = bytes(_HEADER_SIZE)
+        _HEADER.pack_into(self._shm.buf, 0, _MAGIC, 0, slots, key_size, 0, 0)
+        self._setup(read_only=False)
+
+    @classmethod
+    def attach(cls, name):
+        '''maps the block called name read-only. the attaching process doesn't own it: it is not unlinked when this
+        process exits'''
+        hmap = cls.__new__(cls)
+        hmap._shm = _attach(name)
+        if bytes(hmap._shm.buf[:8]) != _MAGIC:
+            hmap._shm.close()
+            raise ValueError(f'shared memory {name!r} is not a SharedHashMapping')
+        hmap._setup(read_only=True)
+        return hmap
+
+    def _setup(self, read_only):
+        '''reads the table's shape from the header'''
+        magic, seq, slots, key_size, live, used = _HEADER.unpack_from(self._shm.buf, 0)
+        self._buf = self._shm.buf
+        self._mask = slots - 1
+        self._key_size = key_size
+        self._slot_size = _slot_size(key_size)
+        self._slot = struct.Struct(f'<BB6x8s{key_size}s')     # (tag, key length, value bytes, padded key)
+        self._read_only = read_only
+        self._depth = 0     # nesting of writing() sections
+
+    def __repr__(self):
+        '''simple print statement w the block's name and how full it is'''
+        return f'SharedHashMapping({self.name!r}, {len(self)} keys in {self._mask + 1} slots)'
+
+    @property
+    def name(self):
+        '''name of the shared memory block, for attach'''
+        return self._shm.name
+
+    @property
+    def version(self):
+        '''number of writes finished so far (a reader can tell whether anything changed)'''
+        return _SEQ.unpack_from(self._buf, 8)[0] // 2
+
+    def __len__(self):
+        '''returns how many keys there are'''
+        return _HEADER.unpack_from(self._buf, 0)[4]
+
+    def __iter__(self):
+        '''iterates thru every key'''
+        for key, value in self.items(): yield key
+
+    def __contains__(self, key):
+        '''Returns True (False) if key is (is not) in the table'''
+        return self._read(key) is not _MISSING
+
+    def __getitem__(self, key):
+        '''Returns value associated w key, or False if key is not in the table, same as HashMapping'''
+        value = self._read(key)
+        return False if value is _MISSING else value
+
+    def get(self, key, default=None):
+        '''Returns value associated w key, or default if key is not in the table'''
+        value = self._read(key)
+        return default if value is _MISSING else value
+
+    def __setitem__(self, key, value):
+        '''Adds key:value pair, or updates the value if key already exists'''
+        tag, packed = _pack_value(value)
+        kbytes, n = self._encode(key)
+        with self.writing():
+            found, free = self._probe(kbytes)
+            buf = self._buf
+            if found >= 0:
+                off = _HEADER_SIZE + found * self._slot_size
+                buf[off+8:off+16] = packed
+                buf[off] = tag
+                return
+            magic, seq, slots, key_size, live, used = _HEADER.unpack_from(buf, 0)
+            if buf[_HEADER_SIZE + free * self._slot_size] == _EMPTY:    #not reusing a deleted slot
+                if used + 1 > _MAX_FILL * slots:
+                    if live == used: raise ValueError(f'{self!r} is full: make it w a larger capacity')
+                    self._purge()
+                    self[key] = value
+                    return
+                used += 1
+            off = _HEADER_SIZE + free * self._slot_size
+            buf[off+16:off+16+self._key_size] = kbytes     #padding clears what a deleted key left
+            buf[off+8:off+16] = packed
+            buf[off+1] = n
+            buf[off] = tag
+            _HEADER.pack_into(buf, 0, magic, seq, slots, key_size, live + 1, used)
+
+    def __delitem__(self, key):
+        '''Removes key. Raises KeyError if key is not in the table'''
+        kbytes, n = self._encode(key)
+        with self.writing():
+            found, free = self._probe(kbytes)
+            if found < 0: raise KeyError(key)
+            self._buf[_HEADER_SIZE + found * self._slot_size] = _DELETED    #keeps later keys in the probe run findable
+            magic, seq, slots, key_size, live, used = _HEADER.unpack_from(self._buf, 0)
+            _HEADER.pack_into(self._buf, 0, magic, seq, slots, key_size, live - 1, used)
+
+    def items(self):
+        '''iterates thru every (key, value) pair. a reader gets them all from one consistent version'''
+        if not self._read_only: return iter(self._scan())
+        while True:
+            seq = self._wait_even()
+            pairs = self._scan()
+            if _SEQ.unpack_from(self._buf, 8)[0] == seq: return iter(pairs)
+
+    @contextmanager
+    def writing(self):
+        '''makes everything done inside one write for readers: they see all of it or none of it. can be nested'''
+        if self._read_only: raise ValueError(f'{self!r} is read-only')
+        if self._depth == 0: _SEQ.pack_into(self._buf, 8, _SEQ.unpack_from(self._buf, 8)[0] + 1)     #odd: writing
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if self._depth == 0: _SEQ.pack_into(self._buf, 8, _SEQ.unpack_from(self._buf, 8)[0] + 1)     #even again
+
+    def close(self):
+        '''unmaps the block in this process'''
+        self._buf = None
+        self._shm.close()
+
+    def unlink(self):
+        '''frees the block once every process has closed it. only the creator should call this'''
+        self._shm.unlink()
+
+    def _encode(self, key):
+        '''(key as UTF-8 paded w zeros to key_size bytes, its unpadded length). raises ValueError if it is not a str
+        or too long for a slot'''
+        if not isinstance(key, str): raise ValueError(f'key {key!r} must be a str')
+        kbytes = key.encode()
+        n = len(kbytes)
+        if n > self._key_size: raise ValueError(f'key {key!r} is longer than {self._key_size} bytes')
+        return kbytes.ljust(self._key_size, b'\0'), n
+
+    def _home(self, kbytes):
+        '''first slot of kbytes' probe run. stable across processes, unlike hash()'''
+        return crc32(kbytes) & self._mask  #tables past 2**32 slots (256 GB) would only use the first 2**32
+
+    def _probe(self, kbytes):
+        '''returns (slot of kbytes or -1, slot to insert it in: the first deleted or empty one on its probe run)'''
+        unpack, buf, mask, size = self._slot.unpack_from, self._buf, self._mask, self._slot_size
+        i, free = self._home(kbytes), -1
+        for step in range(mask + 1):
+            tag, n, value, key = unpack(buf, _HEADER_SIZE + i * size)
+            if tag == _EMPTY: return -1, (i if free < 0 else free)
+            if tag == _DELETED:
+                if free < 0: free = i
+            elif key == kbytes: return i, free
+            i = (i + 1) & mask
+        return -1, free
+
+    def _lookup(self, kbytes):
+        '''value of kbytes, or _MISSING. may see a half-done write: _read checks the seqlock around it'''
+        unpack, buf, mask, size = self._slot.unpack_from, self._buf, self._mask, self._slot_size
+        i = self._home(kbytes)
+        for step in range(mask + 1):
+            tag, n, value, key = unpack(buf, _HEADER_SIZE + i * size)
+            if tag == _EMPTY: return _MISSING
+            if key == kbytes and tag != _DELETED: return (_INT if tag == _IS_INT else _FLOAT).unpack(value)[0]
+            i = (i + 1) & mask
+        return _MISSING
+
+    def _read(self, key):
+        '''value of key or _MISSING. the writer reads directly; readers retry until no write overlapped the read'''
+        try:
+            kbytes = self._encode(key)[0]
+        except ValueError:
+            return _MISSING     #can't be in the table
+        if not self._read_only: return self._lookup(kbytes)
+        buf, seq_at = self._buf, _SEQ.unpack_from
+        while True:
+            seq = seq_at(buf, 8)[0]
+            if seq & 1:
+                time.sleep(0)   #a write is going on: let the writer run
+                continue
+            value = self._lookup(kbytes)
+            if seq_at(buf, 8)[0] == seq: return value
+
+    def _wait_even(self):
+        '''returns the sequence number once no write is going on'''
+        while True:
+            seq = _SEQ.unpack_from(self._buf, 8)[0]
+            if not seq & 1: return seq
+            time.sleep(0)
+
+    def _scan(self):
+        '''list of every live (key, value) pair'''
+        buf, size, pairs = self._buf, self._slot_size, []
+        for i in range(self._mask + 1):
+            off = _HEADER_SIZE + i * size
+            tag = buf[off]
+            if tag == _IS_INT or tag == _IS_FLOAT:
+                key = bytes(buf[off+16:off+16+buf[off+1]]).decode()
+                pairs.append((key, (_INT if tag == _IS_INT else _FLOAT).unpack_from(buf, off + 8)[0]))
+        return pairs
+
+    def _purge(self):
+        '''rebuilds the table in place w/o its deleted slots (inside the caller's write)'''
+        pairs = self._scan()
+        size = self._slot_size
+        self._buf[_HEADER_SIZE:_HEADER_SIZE + (self._mask + 1) * size] = bytes((self._mask + 1) * size)
+        magic, seq, slots, key_size, live, used = _HEADER.unpack_from(self._buf, 0)
+        _HEADER.pack_into(self._buf, 0, magic, seq, slots, key_size, 0, 0)
+        for key, value in pairs: self[key] = value
+
+class SharedLedger(Ledger):
+    '''Ledger whose balances are in a SharedHashMapping, for one writer process. each apply (a whole block) and
+    set_balances is one write for the replicas. Blockchain(ledger=SharedLedger(capacity)) keeps it up to date'''
+    def __init__(self, capacity=1 << 16, key_size=48, name=None):
+        '''creates the shared table w room for capacity accounts'''
+        self._ledger_hashmap = SharedHashMapping(capacity, key_size, name)
+
+    @property
+    def name(self):
+        '''name of the shared memory block, for LedgerReplica'''
+        return self._ledger_hashmap.name
+
+    def apply(self, transactions, strict=False):
+        '''Ledger.apply as a single write, so replicas never see half a block. if a write fails partway (a user name
+        that doesn't fit a slot, a full table, a balance past 64 bits) the block's earlier writes are undone, inside
+        the same write, before the error is raised'''
+        hmap = self._ledger_hashmap
+        with hmap.writing():
+            before = {}     # user -> balance before the block (_MISSING: no account)
+            for trans in transactions:
+                for user in (trans.from_user, trans.to_user):
+                    if user not in before: before[user] = hmap.get(user, _MISSING)
+            try:
+                return Ledger.apply(self, transactions, strict)
+            except Exception:
+                for user, balance in before.items():
+                    if balance is not _MISSING: hmap[user] = balance
+                    elif user in hmap: del hmap[user]
+                raise
+
+    def set_balances(self, balances):
+        '''sets the balance of every user in the balances dict, as a single write'''
+        with self._ledger_hashmap.writing(): Ledger.set_balances(self, balances)
+
+    def close(self):
+        '''unmaps the table in this process'''
+        self._ledger_hashmap.close()
+
+    def unlink(self):
+        '''frees the shared memory block (after closing it)'''
+        self._ledger_hashmap.unlink()
+
+class LedgerReplica(Ledger):
+    '''Read-only view of a SharedLedger from any process: balance, has_funds and balances, w/o locks or a copy'''
+    def __init__(self, name):
+        '''attaches to the SharedLedger whose block is called name'''
+        self._ledger_hashmap = SharedHashMapping.attach(name)
+
+    @property
+    def version(self):
+        '''number of writes the SharedLedger has finished (every block applied or turned away is one)'''
+        return self._ledger_hashmap.version
+
+    def has_funds(self, user, amount):
+        '''checks if the user has enough funds to make the transaciton, in a single read'''
+        balance = self._ledger_hashmap.get(user)
+        return balance is not None and balance >= amount
+
+    def close(self):
+        '''unmaps the table in this process'''
+        self._ledger_hashmap.close()
@@ -0,0 +1,173 @@
+'''Proof of stake block production. StakeSelector follows a chain as a listener and keeps every account's stake (its
+balance in whole tokens) in a Fenwick tree, so picking a proposer w probability stake / total stake is one O(log n)
+descent of the tree, and a block only costs an O(log n) update for each balance it changed (nothing is rebuilt per
+slot). the proposer of a slot is drawn from the hash of the last block and the slot number, so every node following
+the same chain picks the same one'''
+from hashlib import sha256
+
+from blockchain import Blockchain
+
+class FenwickTree():
+    '''Binary indexed tree over non-negative int weights: point updates, prefix sums and finding the position a
+    running total falls in, each in O(log n). ints keep every sum exact, which float stakes would not'''
+    def __init__(self, weights=()):
+        '''builds the tree over weights in O(n)'''
+        self._weights = list(weights)
+        n = len(self._weights)
+        tree = [0] + self._weights     # 1-based: tree[i] sums weights (i - lowbit(i), i]
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n: tree[parent] += tree[i]
+        self._tree = tree
+        self.total = sum(self._weights)
+
+    def __repr__(self):
+        '''simple print statement w the size and total weight'''
+        return f'FenwickTree({len(self)} weights, total={self.total})'
+
+    def __len__(self):
+        '''returns how many weights there are'''
+        return len(self._weights)
+
+    def __getitem__(self, i):
+        '''returns weight i'''
+        return self._weights[i]
+
+    def add(self, i, delta):
+        '''adds delta to weight i'''
+        if self._weights[i] + delta < 0: raise ValueError(f'weight {i} can not go below 0')
+        self._weights[i] += delta
+        self.total += delta
+        tree, n = self._tree, len(self._weights)
+        i += 1
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
+
+    def set(self, i, weight):
+        '''sets weight i'''
+        self.add(i, weight - self._weights[i])
+
+    def append(self, weight):
+        '''adds a weight at the end, in O(log n): the new node covers (n + 1 - lowbit(n + 1), n + 1]'''
+        if weight < 0: raise ValueError('weights can not be negative')
+        self._weights.append(weight)
+        n = len(self._weights)
+        self._tree.append(weight + self.prefix(n - 1) - self.prefix(n - (n & -n)))
+        self.total += weight
+
+    def prefix(self, i):
+        '''returns the sum of the first i weights'''
+        tree, total = self._tree, 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, target):
+        '''returns the position i whose weight covers target: prefix(i) <= target < prefix(i + 1). target must be
+        in [0, total)'''
+        if not 0 <= target < self.total: raise ValueError(f'target {target} out of range [0, {self.total})')
+        tree, n, pos = self._tree, len(self._weights), 0
+        step = 1 << (n.bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= target:
+                pos = nxt
+                target -= tree[nxt]
+            step >>= 1
+        return pos
+
+class StakeSelector():
+    '''Picks block proposers for chain weighted by stake. an account's stake is its balance rounded down to whole
+    tokens, or 0 below min_stake. the users in exclude never stake (by default ROOT, which holds the unissued tokens).
+    positions of accounts whose stake drops to 0 are reused by the next new staker, so the tree only grows w the
+    number of accounts staking at once'''
+    def __init__(self, chain, min_stake=1, exclude=(Blockchain._ROOT_BC_USER,)):
+        '''builds the tree from chain's current balances, then starts listening'''
+        self._chain = chain
+        self._min_stake = min_stake
+        self._exclude = frozenset(exclude)
+        self._users = []    # user at each position of the tree (None for a free one)
+        self._index = {}    # user -> position
+        self._free = []     # free positions
+        weights = []
+        for user, balance in chain._bc_ledger.balances():
+            stake = self._stake(user, balance)
+            if not stake: continue
+            self._index[user] = len(self._users)
+            self._users.append(user)
+            weights.append(stake)
+        self._tree = FenwickTree(weights)
+        chain.add_listener(self)
+
+    def __repr__(self):
+        '''simple print statement w the number of stakers and the total stake'''
+        return f'StakeSelector({len(self)} stakers, total_stake={self.total_stake})'
+
+    def __len__(self):
+        '''returns how many accounts have stake'''
+        return len(self._index)
+
+    @property
+    def total_stake(self):
+        '''sum of every stake'''
+        return self._tree.total
+
+    def stake(self, user):
+        '''returns user's stake (0 if they have none)'''
+        i = self._index.get(user)
+        return 0 if i is None else self._tree[i]
+
+    def _stake(self, user, balance):
+        '''stake of user w balance'''
+        if balance is None or user in self._exclude or balance < self._min_stake: return 0
+        return int(balance)
+
+    def _update(self, user, balance):
+        '''sets user's stake from their new balance (None: the account is gone)'''
+        stake = self._stake(user, balance)
+        i = self._index.get(user)
+        if i is not None:
+            self._tree.set(i, stake)
+            if not stake:   #frees the position
+                del self._index[user]
+                self._users[i] = None
+                self._free.append(i)
+        elif stake:
+            if self._free:
+                i = self._free.pop()
+                self._tree.set(i, stake)
+                self._users[i] = user
+            else:
+                i = len(self._users)
+                self._tree.append(stake)
+                self._users.append(user)
+            self._index[user] = i
+
+    def block_added(self, chain, block, changes):
+        '''listener hook called by Blockchain: updates the stakes of the users the block touched'''
+        for user, (before, after) in changes.items(): self._update(user, after)
+
+    def block_removed(self, chain, block, changes):
+        '''listener hook called by Blockchain when the newest block is undone: puts the stakes back'''
+        for user, (before, after) in changes.items(): self._update(user, before)
+
+    def select(self, seed):
+        '''returns the staker that seed (bytes) picks, each w probability stake / total stake. raises ValueError if
+        nobody has stake'''
+        if not self._tree.total: raise ValueError('no account has stake')
+        target = int.from_bytes(sha256(seed).digest(), 'big') % self._tree.total
+        return self._users[self._tree.find(target)]
+
+    def proposer(self, slot=0):
+        '''returns the proposer of the next block for slot (a retry number: if a proposer misses their turn, the
+        next slot picks another one). the same on every node w the same chain'''
+        return self.select(self._chain._blockchain[-1].digest() + slot.to_bytes(8, 'little'))
+
+    def produce_block(self, slot=0):
+        '''the proof of stake version of distribute_mining_reward: the slot's proposer gets the block reward. returns
+        the proposer'''
+        user = self.proposer(slot)
+        self._chain.distribute_mining_reward(user)
+        return user
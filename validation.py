@@ -0,0 +1,66 @@
+'''Two stage block validation. the stateless stage (well-formed users, amount type and range, signatures) only looks at
+one transaction at a time, so it runs on a process pool. the stateful stage applies balances thru Blockchain.add_blocks
+on one thread, in order, while the pool is already checking the next batches'''
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import pbkdf2_hmac
+import math
+
+def check_transaction(row):
+    '''stateless checks for one (from_user, to_user, amount) row: both users are non-empty strings and amount is a
+    finite, non-negative int or float'''
+    frm, to, amt = row
+    if not (isinstance(frm, str) and isinstance(to, str) and frm and to): return False
+    if isinstance(amt, bool) or not isinstance(amt, (int, float)): return False
+    return amt >= 0 and math.isfinite(amt)
+
+def simulated_signature_check(row):
+    '''stand-in for an ECDSA verify that costs about as much CPU as one. always passes for well-formed rows'''
+    pbkdf2_hmac('sha256', repr(row).encode(), b'salt', 200)
+    return True
+
+def _check_blocks(blocks, verifier):
+    '''worker: returns True/False for each block (a list of rows): every row passes check_transaction and verifier'''
+    return [all(check_transaction(row) and (verifier is None or verifier(row)) for row in rows) for rows in blocks]
+
+class ValidationPipeline():
+    '''Validates and adds blocks to a Blockchain in 2 stages. workers=0 runs the stateless stage inline (no pool).
+    verifier is an optional picklable function(row) -> bool, ie: a signature check'''
+    def __init__(self, chain, workers=None, verifier=None, batch_size=64):
+        '''starts the process pool. batch_size is how many blocks are sent to a worker at a time'''
+        self._chain = chain
+        self._verifier = verifier
+        self._batch_size = batch_size
+        self._pool = ProcessPoolExecutor(workers) if workers != 0 else None
+
+    def __repr__(self):
+        '''simple print statement w the pool and batch size'''
+        return f'ValidationPipeline(pool={self._pool}, batch_size={self._batch_size})'
+
+    def __enter__(self):
+        '''lets a ValidationPipeline be used in a with statement, which shuts the pool down at the end'''
+        return self
+
+    def __exit__(self, *exc_info):
+        '''shuts the pool down'''
+        self.close()
+
+    def close(self):
+        '''shuts the process pool down'''
+        if self._pool is not None: self._pool.shutdown()
+
+    def add_blocks(self, blocks):
+        '''validates blocks and adds the valid ones to the chain in order. returns True/False for each block, like
+        Blockchain.add_blocks: False if any transaction failed the stateless checks or the sender lacked funds'''
+        blocks = list(blocks)
+        size = self._batch_size
+        batches = [blocks[i:i+size] for i in range(0, len(blocks), size)]
+        rows = ([[(t.from_user, t.to_user, t.amount) for t in block] for block in batch] for batch in batches)
+
+        if self._pool is None: checked = (_check_blocks(batch, self._verifier) for batch in rows)
+        else: checked = self._pool.map(_check_blocks, rows, [self._verifier]*len(batches))
+
+        results = []
+        for batch, ok in zip(batches, checked):     #stage 2 runs while the pool works on later batches
+            applied = iter(self._chain.add_blocks([block for block, good in zip(batch, ok) if good]))
+            results.extend(next(applied) if good else False for good in ok)
+        return results
@@ -0,0 +1,185 @@
+'''Seedable synthetic workloads and a benchmark suite that runs them against the whole chain. a Workload is every
+parameter of a run (accounts, transactions per block, Zipfian sender skew, fraction of invalid transactions, seed), and
+the same Workload makes the same blocks on every machine: everything is drawn from one random.Random(seed), and the
+generator tracks balances itself so it knows which blocks the chain will accept. run_suite times add_block,
+validate_chain, distribute_mining_reward and HashMapping inserts/lookups and returns a JSON-able dict. compare flags
+the measurements that got worse between two of those dicts'''
+from hashlib import sha256
+from itertools import accumulate
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+from blockchain import Transaction, Block, Blockchain
+from hashmap import HashMapping
+from network import percentile
+
+class Workload():
+    '''Parameters of a synthetic workload. sender i is picked w weight 1/(i+1)**skew (skew=0: uniform) and receivers
+    uniformly. each transaction is invalid (sent from an account that does not exist) w probability invalid_fraction,
+    which gets its whole block rejected. valid amounts are 1 thru max_amount, capped by what the sender has left'''
+    def __init__(self, num_accounts=10000, txs_per_block=100, num_blocks=1000, skew=1.0, invalid_fraction=0.0,
+                 max_amount=10, seed=0):
+        '''checks and keeps the parameters'''
+        if not 0 < num_accounts <= Blockchain._TOTAL_AVAILABLE_TOKENS:
+            raise ValueError(f'num_accounts {num_accounts} must be between 1 and {Blockchain._TOTAL_AVAILABLE_TOKENS}')
+        if not 0 <= invalid_fraction <= 1: raise ValueError(f'invalid_fraction {invalid_fraction} must be between 0 and 1')
+        if txs_per_block < 1 or num_blocks < 0 or skew < 0 or max_amount < 1:
+            raise ValueError('txs_per_block and max_amount must be positive, num_blocks and skew not negative')
+        self.num_accounts, self.txs_per_block, self.num_blocks = num_accounts, txs_per_block, num_blocks
+        self.skew, self.invalid_fraction, self.max_amount, self.seed = skew, invalid_fraction, max_amount, seed
+
+    def __repr__(self):
+        '''simple print statement w every parameter'''
+        return f'Workload({", ".join(f"{k}={v!r}" for k, v in self.params().items())})'
+
+    def params(self):
+        '''the parameters as a dict (what Workload(**params) takes)'''
+        return {'num_accounts': self.num_accounts, 'txs_per_block': self.txs_per_block, 'num_blocks': self.num_blocks,
+                'skew': self.skew, 'invalid_fraction': self.invalid_fraction, 'max_amount': self.max_amount,
+                'seed': self.seed}
+
+    def accounts(self):
+        '''names of the workload's accounts, hottest sender first'''
+        return [f'user{i}' for i in range(self.num_accounts)]
+
+    def funding(self):
+        '''blocks that send every account an equal share of ROOT's tokens (ROOT keeps the remainder for mining
+        rewards), in blocks of at most 10000 transactions'''
+        share = Blockchain._TOTAL_AVAILABLE_TOKENS // self.num_accounts // 2 or 1
+        txs = [Transaction(Blockchain._ROOT_BC_USER, user, share) for user in self.accounts()]
+        return [Block(txs[i:i+10000]) for i in range(0, len(txs), 10000)]
+
+    def blocks(self):
+        '''lazily yields (block, True if the chain should accept it) for num_blocks blocks, after the funding blocks'''
+        rng = random.Random(self.seed)    #same numbers for the same seed on every platform
+        users = self.accounts()
+        share = Blockchain._TOTAL_AVAILABLE_TOKENS // self.num_accounts // 2 or 1
+        balances = dict.fromkeys(users, share)
+        cum_weights = list(accumulate(1 / (i + 1)**self.skew for i in range(self.num_accounts)))
+        n, max_amount, invalid = self.txs_per_block, self.max_amount, self.invalid_fraction
+        for b in range(self.num_blocks):
+            senders = rng.choices(users, cum_weights=cum_weights, k=n)
+            spent = {}  #what each sender already spent in this block: amounts are capped by the balance before it
+            txs, valid = [], True
+            for i, frm in enumerate(senders):
+                to = users[rng.randrange(len(users))]
+                if invalid and rng.random() < invalid:
+                    txs.append(Transaction(f'ghost{b}_{i}', to, 1))
+                    valid = False
+                    continue
+                left = balances[frm] - spent.get(frm, 0)
+                amount = rng.randint(1, min(left, max_amount)) if left > 0 else 0
+                spent[frm] = spent.get(frm, 0) + amount
+                txs.append(Transaction(frm, to, amount))
+            if valid:
+                for trans in txs:
+                    balances[trans.from_user] -= trans.amount
+                    balances[trans.to_user] += trans.amount
+            yield Block(txs), valid
+
+def _stats(latencies, count, seconds):
+    '''throughput and latency percentiles (seconds) of count operations timed one by one'''
+    return {'count': count, 'seconds': seconds, 'per_second': count / seconds if seconds else 0.0,
+            'p50': percentile(latencies, 50) if latencies else 0.0, 'p90': percentile(latencies, 90) if latencies else 0.0,
+            'p99': percentile(latencies, 99) if latencies else 0.0, 'max': max(latencies, default=0.0)}
+
+def _run_chain(workload, hashmap_cls, rewards):
+    '''builds a chain from the workload: funding, every block thru add_block w an incremental validate_chain after
+    each one, then rewards calls to distribute_mining_reward. returns (add_block, validate_chain,
+    distribute_mining_reward) latencies, accepted and rejected counts, and a digest of every block in order'''
+    clock = time.perf_counter
+    chain = Blockchain(hashmap_cls)
+    for block in workload.funding(): chain.add_block(block)
+    add, validate, reward = [], [], []
+    accepted = rejected = mismatched = 0
+    fingerprint = sha256()
+    for block, expected in workload.blocks():
+        start = clock()
+        ok = chain.add_block(block)
+        add.append(clock() - start)
+        start = clock()
+        chain.validate_chain()
+        validate.append(clock() - start)
+        accepted += ok
+        rejected += not ok
+        mismatched += ok != expected
+        fingerprint.update(block.digest())
+    for i in range(rewards):
+        start = clock()
+        chain.distribute_mining_reward(f'user{i % workload.num_accounts}')
+        reward.append(clock() - start)
+    if mismatched: raise RuntimeError(f'{mismatched} blocks were not accepted/rejected as the workload expected')
+    return add, validate, reward, accepted, rejected, fingerprint.hexdigest()
+
+def _run_hashmap(workload, hashmap_cls):
+    '''inserts every account into a fresh hash map, then looks up as many Zipf-distributed senders as the workload
+    has transactions. returns (insert latencies, lookup latencies)'''
+    clock = time.perf_counter
+    rng = random.Random(workload.seed)
+    users = workload.accounts()
+    cum_weights = list(accumulate(1 / (i + 1)**workload.skew for i in range(len(users))))
+    lookups = rng.choices(users, cum_weights=cum_weights, k=workload.num_blocks * workload.txs_per_block)
+    hmap, insert, lookup = hashmap_cls(), [], []
+    for i, user in enumerate(users):
+        start = clock()
+        hmap[user] = i
+        insert.append(clock() - start)
+    for user in lookups:
+        start = clock()
+        hmap[user]
+        lookup.append(clock() - start)
+    return insert, lookup
+
+def run_suite(workload, hashmap_cls=HashMapping, rewards=200, memory=True):
+    '''runs every benchmark of the suite on workload and returns the results as a JSON-able dict: the workload and
+    its fingerprint (a digest of every block, the same on every machine), the environment, and for each operation its
+    count, throughput and p50/p90/p99/max latency. memory=True reruns the chain and the hash map under tracemalloc
+    (separately, so tracing doesn't slow the timed runs) for their peak traced bytes'''
+    txs = workload.num_blocks * workload.txs_per_block
+    add, validate, reward, accepted, rejected, fingerprint = _run_chain(workload, hashmap_cls, rewards)
+    insert, lookup = _run_hashmap(workload, hashmap_cls)
+    operations = {'add_block': _stats(add, len(add), sum(add)),
+                  'validate_chain': _stats(validate, len(validate), sum(validate)),
+                  'distribute_mining_reward': _stats(reward, len(reward), sum(reward)),
+                  'hashmap_insert': _stats(insert, len(insert), sum(insert)),
+                  'hashmap_lookup': _stats(lookup, len(lookup), sum(lookup))}
+    operations['add_block'].update(txs_per_second=txs / sum(add) if add else 0.0, accepted=accepted, rejected=rejected)
+    results = {'workload': workload.params(), 'fingerprint': fingerprint, 'hashmap': hashmap_cls.__name__,
+               'environment': {'python': sys.version.split()[0], 'implementation': platform.python_implementation(),
+                               'machine': platform.machine(), 'system': platform.system()},
+               'operations': operations}
+    if memory:
+        peaks = {}
+        for name, run in (('chain', lambda: _run_chain(workload, hashmap_cls, rewards)),
+                          ('hashmap', lambda: _run_hashmap(workload, hashmap_cls))):
+            tracemalloc.start()
+            run()
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results['peak_memory'] = peaks
+    results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss     #whole process, for reference
+    return results
+
+def compare(old, new, threshold=0.1):
+    '''returns the regressions from results old to new (both from run_suite) as a list of (operation, metric, old
+    value, new value, relative change): throughput down or p99 latency or peak memory up by more than threshold.
+    raises ValueError if the two runs were not of the same workload'''
+    if old['workload'] != new['workload'] or old['fingerprint'] != new['fingerprint']:
+        raise ValueError('the runs are of different workloads, so they can not be compared')
+    regressions = []
+    def check(op, metric, before, after, higher_is_worse):
+        if not before: return
+        change = (after - before) / before
+        if (change > threshold) if higher_is_worse else (change < -threshold):
+            regressions.append((op, metric, before, after, change))
+    for op, stats in old['operations'].items():
+        if op not in new['operations']: continue
+        check(op, 'per_second', stats['per_second'], new['operations'][op]['per_second'], False)
+        check(op, 'p99', stats['p99'], new['operations'][op]['p99'], True)
+    for name, peak in old.get('peak_memory', {}).items():
+        if name in new.get('peak_memory', {}): check(name, 'peak_memory', peak, new['peak_memory'][name], True)
+    return regressions